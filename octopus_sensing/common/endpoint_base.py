@@ -19,13 +19,21 @@ import io
 import http.server
 import pickle
 import json
+import socket
+import base64
+import struct
 import urllib.parse
+import zlib
 
-from typing import Callable, Optional, Any, Dict, List
+from typing import Callable, Optional, Any, Dict, Iterator, List
 
 import msgpack
 import numpy
 
+from octopus_sensing.common.ndarray_encoding import \
+    NDARRAY_CONTENT_TYPE, encode_ndarray_response, msgpack_ext_default
+from octopus_sensing.common.websocket import WebSocket, get_accept_key
+
 
 class EndpointClientError(Exception):
     pass
@@ -33,98 +41,311 @@ class EndpointClientError(Exception):
 class _NumpyJSONEncoder(json.JSONEncoder):
     """Helper class for encoding Numpy types to JSON"""
     def default(self, obj):
-        if isinstance(obj, (numpy.int_, numpy.intc, numpy.intp, numpy.int8,
-                            numpy.int16, numpy.int32, numpy.int64, numpy.uint8,
-                            numpy.uint16, numpy.uint32, numpy.uint64)):
+        if isinstance(obj, numpy.integer):
             return int(obj)
-        elif isinstance(obj, (numpy.float_, numpy.float16, numpy.float32,
-                              numpy.float64)):
+        elif isinstance(obj, numpy.floating):
             return float(obj)
         elif isinstance(obj, (numpy.ndarray,)):
             return obj.tolist()
+        elif isinstance(obj, bytes):
+            # E.g. encoded images
+            return base64.b64encode(obj).decode("ascii")
         return json.JSONEncoder.default(self, obj)
 
 def _numpy_msgpack_encoder(obj):
     """Helper function for encoding Numpy types to msgpack"""
-    if isinstance(obj, (numpy.int_, numpy.intc, numpy.intp, numpy.int8,
-                        numpy.int16, numpy.int32, numpy.int64, numpy.uint8,
-                        numpy.uint16, numpy.uint32, numpy.uint64)):
+    if isinstance(obj, numpy.integer):
         return int(obj)
-    elif isinstance(obj, (numpy.float_, numpy.float16, numpy.float32,
-                          numpy.float64)):
+    elif isinstance(obj, numpy.floating):
         return float(obj)
     elif isinstance(obj, (numpy.ndarray,)):
         return obj.tolist()
     return obj
 
 
-def make_handler(get_callback: Optional[Callable[[io.BufferedIOBase], Any]], post_callback: Optional[Callable[[Any], Any]]):
+# Responses smaller than this are not worth compressing
+COMPRESSION_MIN_SIZE = 1024
+# Idle keep-alive connections are closed after this many seconds
+KEEP_ALIVE_TIMEOUT = 60
+
+_CONTENT_TYPES = {
+    "pickle": "application/python-pickle",
+    "json": "application/json",
+    "msgpack": "application/msgpack",
+    NDARRAY_CONTENT_TYPE: NDARRAY_CONTENT_TYPE,
+}
+
+# Each frame of a streaming response starts with its length, as a little-endian uint32
+STREAM_FRAME_HEADER = struct.Struct("<I")
+SSE_CONTENT_TYPE = "text/event-stream"
+
+# Window bits of zlib for each Content-Encoding
+_COMPRESSIONS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS,
+}
+
+
+def _get_serialization(encoding_type: Optional[str]) -> Optional[str]:
+    '''Finds the serialization the client asked for in its Accept header'''
+    if encoding_type is None or "pickle" in encoding_type:
+        return "pickle"
+    elif NDARRAY_CONTENT_TYPE in encoding_type:
+        return NDARRAY_CONTENT_TYPE
+    elif "json" in encoding_type:
+        return "json"
+    elif "msgpack" in encoding_type:
+        return "msgpack"
+    return None
+
+
+def serialize_response(response: Any, encoding_type: Optional[str]) -> Optional[List[Any]]:
+    '''
+    Serializes the response according to the Accept header.
+    Returns a list of buffers, or None if the encoding type is unknown.
+    '''
+    serialization = _get_serialization(encoding_type)
+    if serialization == "pickle":
+        return [pickle.dumps(response)]
+    elif serialization == NDARRAY_CONTENT_TYPE:
+        # Arrays' buffers are views on their memory, so they are written to
+        # the socket without copying
+        return encode_ndarray_response(response)
+    elif serialization == "json":
+        return [json.dumps(response, cls=_NumpyJSONEncoder).encode('UTF-8')]
+    elif serialization == "msgpack":
+        assert encoding_type is not None
+        if "ndarray=ext" in encoding_type:
+            return [msgpack.packb(response, default=msgpack_ext_default)]
+        return [msgpack.packb(response, default=_numpy_msgpack_encoder)]
+    return None
+
+
+def read_stream_frames(stream: io.BufferedIOBase) -> Iterator[bytes]:
+    '''
+    Reads the frames of a streaming response (except Server-Sent Events). Each frame is
+    one serialized response, and should be deserialized the same way a GET response is.
+
+    Parameters
+    ----------
+    stream: io.BufferedIOBase
+        Body of the response, e.g. an `http.client.HTTPResponse`
+
+    Returns
+    -------
+    Iterator[bytes]
+        Frames, until the stream is closed
+
+    Example
+    -------
+    >>> http_client.request("GET", "/stream", headers={"Accept": "application/msgpack"})
+    >>> for frame in read_stream_frames(http_client.getresponse()):
+    ...     data = msgpack.unpackb(frame)
+    '''
+    while True:
+        length_bytes = stream.read(STREAM_FRAME_HEADER.size)
+        if len(length_bytes) < STREAM_FRAME_HEADER.size:
+            return
+        length, = STREAM_FRAME_HEADER.unpack(length_bytes)
+        frame = stream.read(length)
+        if len(frame) < length:
+            return
+        yield frame
+
+
+def _choose_compression(accept_encoding: Optional[str]) -> Optional[str]:
+    '''Picks one of the _COMPRESSIONS that the client accepts, or None'''
+    if not accept_encoding:
+        return None
+    accepted = set()
+    for item in accept_encoding.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            accepted.add(coding.lower())
+    for coding in _COMPRESSIONS:
+        if coding in accepted:
+            return coding
+    return None
+
+
+def make_handler(get_callback: Optional[Callable[[io.BufferedIOBase], Any]],
+                 post_callback: Optional[Callable[[Any], Any]],
+                 stream_callback: Optional[Callable[[Dict[str, List[Any]]], Iterator[Any]]] = None,
+                 stop_event: Optional[threading.Event] = None,
+                 websocket_callback: Optional[Callable[[WebSocket, Dict[str, List[Any]]], None]] = None):
     class Handler(http.server.BaseHTTPRequestHandler):
+        # Keeps connections open between requests. So clients that poll the endpoint, or
+        # send many messages, don't open a new connection for each request.
+        protocol_version = "HTTP/1.1"
+        timeout = KEEP_ALIVE_TIMEOUT
 
         def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            if url.query:
+                query_params = urllib.parse.parse_qs(url.query)
+            else:
+                query_params = {}
+
+            if websocket_callback is not None and \
+                    self.headers.get("Upgrade", "").lower() == "websocket":
+                self._websocket(query_params)
+                return
+
+            if url.path.rstrip("/") == "/stream" and stream_callback is not None:
+                self._stream(query_params)
+                return
+
             if get_callback is None:
                 self.send_error(
                     400,
                     message="This endpoint does not support GET requests")
-                self.end_headers()
                 return
 
-            query_string = urllib.parse.urlparse(self.path).query
-            if query_string:
-                query_params = urllib.parse.parse_qs(query_string)
-            else:
-                query_params = {}
-
             try:
                 response = get_callback(self.rfile, query_params)
             except EndpointClientError as client_error:
                 self.send_error(
                     400,
-                    message=client_error.message)
-                self.end_headers()
+                    message=str(client_error))
                 return
 
             encoding_type = self.headers.get("Accept")
-            if encoding_type is None or "pickle" in encoding_type:
-                serialized_response = pickle.dumps(response)
-            elif "json" in encoding_type:
-                serialized_response = json.dumps(response, cls=_NumpyJSONEncoder).encode('UTF-8')
-            elif "msgpack" in encoding_type:
-                serialized_response = msgpack.packb(response, default=_numpy_msgpack_encoder)
-            else:
+            buffers = serialize_response(response, encoding_type)
+            if buffers is None:
+                self._send_unknown_content_type_error()
+                return
+
+            self._send_body(buffers, _CONTENT_TYPES[_get_serialization(encoding_type)])
+
+        def _stream(self, query_params):
+            '''
+            Sends the responses of the stream_callback, one frame each, until the client
+            disconnects or the endpoint stops
+            '''
+            assert stream_callback is not None
+            encoding_type = self.headers.get("Accept")
+            server_sent_events = encoding_type is not None and SSE_CONTENT_TYPE in encoding_type
+            serialization = _get_serialization(encoding_type)
+            if not server_sent_events and serialization is None:
+                self._send_unknown_content_type_error()
+                return
+
+            try:
+                responses = stream_callback(query_params)
+            except EndpointClientError as client_error:
                 self.send_error(
                     400,
-                    message="Unknown content type. Should be one of 'json', 'msgpack', or 'pickle'")
-                self.end_headers()
+                    message=str(client_error))
                 return
 
             self.send_response(200)
+            if server_sent_events:
+                self.send_header("Content-Type", SSE_CONTENT_TYPE)
+                self.send_header("Cache-Control", "no-cache")
+            else:
+                self.send_header("Content-Type", _CONTENT_TYPES[serialization])
+            self.send_header("Transfer-Encoding", "chunked")
             self.end_headers()
-            self.wfile.write(serialized_response)
+            # The stream only ends by closing the connection
+            self.close_connection = True
+
+            try:
+                for response in responses:
+                    if server_sent_events:
+                        buffers = [b"data: ",
+                                   json.dumps(response, cls=_NumpyJSONEncoder).encode('UTF-8'),
+                                   b"\n\n"]
+                    else:
+                        buffers = serialize_response(response, encoding_type)
+                        buffers.insert(0, STREAM_FRAME_HEADER.pack(
+                            sum(len(buffer) for buffer in buffers)))
+                    self._write_chunk(buffers)
+                    if stop_event is not None and stop_event.is_set():
+                        break
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # Client is disconnected
+                pass
+            finally:
+                if hasattr(responses, "close"):
+                    responses.close()
+
+        def _websocket(self, query_params):
+            '''Accepts a WebSocket connection, and passes it to the websocket_callback'''
+            assert websocket_callback is not None
+            key = self.headers.get("Sec-WebSocket-Key")
+            if key is None or self.headers.get("Sec-WebSocket-Version") != "13":
+                self.send_error(
+                    400,
+                    message="Invalid WebSocket handshake")
+                return
+
+            self.send_response(101)
+            self.send_header("Upgrade", "websocket")
+            self.send_header("Connection", "Upgrade")
+            self.send_header("Sec-WebSocket-Accept", get_accept_key(key))
+            self.end_headers()
+            self.close_connection = True
+            # Messages are small and should be delivered right away
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # The connection stays open for as long as the client wants
+            self.connection.settimeout(None)
+
+            websocket = WebSocket(self.rfile, self.wfile)
+            try:
+                websocket_callback(websocket, query_params)
+            except Exception:
+                print("Error in WebSocket connection", file=sys.stderr)
+                traceback.print_exc()
+            finally:
+                websocket.close()
+
+        def _write_chunk(self, buffers: List[Any]) -> None:
+            '''Writes the buffers as one chunk of a chunked response'''
+            length = sum(len(buffer) for buffer in buffers)
+            self.wfile.write("{0:X}\r\n".format(length).encode("ascii"))
+            for buffer in buffers:
+                self.wfile.write(buffer)
+            self.wfile.write(b"\r\n")
+
+        def _send_unknown_content_type_error(self) -> None:
+            self.send_error(
+                400,
+                message="Unknown content type. Should be one of 'json', 'msgpack', "
+                        "'pickle', or '{0}'".format(NDARRAY_CONTENT_TYPE))
 
         def do_POST(self):
+            # The body should be read in any case, or it will be mistaken for the next
+            # request on this connection
+            content_length = int(self.headers.get("Content-Length", "0"))
+            serialized_body = self.rfile.read(content_length)
+
             if post_callback is None:
                 self.send_error(
                     400,
                     message="This endpoint does not support POST requests")
-                self.end_headers()
                 return
 
-            content_length = int(self.headers.get("Content-Length", "-1"))
-            serialized_body = self.rfile.read(content_length)
-
             encoding_type = self.headers.get("Accept")
-            if encoding_type is None or "pickle" in encoding_type:
+            serialization = _get_serialization(encoding_type)
+            if serialization == "pickle":
                 body = pickle.loads(serialized_body)
-            elif "json" in encoding_type:
+            elif serialization == "json":
                 body = json.loads(serialized_body)
-            elif "msgpack" in encoding_type:
+            elif serialization == "msgpack":
                 body = msgpack.unpackb(serialized_body)
             else:
                 self.send_error(
                     400,
                     message="Unknown content type. Should be one of 'json', 'msgpack', or 'pickle'")
-                self.end_headers()
                 return
 
             try:
@@ -133,27 +354,52 @@ def make_handler(get_callback: Optional[Callable[[io.BufferedIOBase], Any]], pos
                 self.send_error(
                     400,
                     message=str(client_error))
-                self.end_headers()
                 return
 
-            # We already check that encoding_type is one of these values
-            if encoding_type is None or "pickle" in encoding_type:
+            # We already check that serialization is one of these values
+            if serialization == "pickle":
                 serialized_response = pickle.dumps(response)
-            elif "json" in encoding_type:
+            elif serialization == "json":
                 serialized_response = json.dumps(response).encode('UTF-8')
-            elif "msgpack" in encoding_type:
+            elif serialization == "msgpack":
                 serialized_response = msgpack.packb(response)
 
+            self._send_body([serialized_response], _CONTENT_TYPES[serialization])
+
+        def _send_body(self, buffers: List[Any], content_type: str) -> None:
+            '''
+            Sends a successful response, with its headers. The body is compressed if the
+            client accepts it and it's large enough.
+            '''
+            content_encoding = None
+            if sum(len(buffer) for buffer in buffers) >= COMPRESSION_MIN_SIZE:
+                content_encoding = _choose_compression(self.headers.get("Accept-Encoding"))
+                if content_encoding is not None:
+                    # Realtime responses are sent many times a second, so speed matters
+                    # more than the size
+                    compressor = zlib.compressobj(1, zlib.DEFLATED,
+                                                  _COMPRESSIONS[content_encoding])
+                    buffers = [compressor.compress(buffer) for buffer in buffers]
+                    buffers.append(compressor.flush())
+
             self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(sum(len(buffer) for buffer in buffers)))
+            self.send_header("Vary", "Accept-Encoding")
+            if content_encoding is not None:
+                self.send_header("Content-Encoding", content_encoding)
             self.end_headers()
-            self.wfile.write(serialized_response)
+            for buffer in buffers:
+                self.wfile.write(buffer)
 
     return Handler
 
 
 class EndpointBase(threading.Thread):
 
-    def __init__(self, endpoint_name: str, port: int, get_callback: Optional[Callable[[io.BufferedIOBase, Dict[str, List[Any]]], Any]] = None, post_callback: Optional[Callable[[Any], Any]] = None):
+    def __init__(self, endpoint_name: str, port: int, get_callback: Optional[Callable[[io.BufferedIOBase, Dict[str, List[Any]]], Any]] = None, post_callback: Optional[Callable[[Any], Any]] = None,
+                 stream_callback: Optional[Callable[[Dict[str, List[Any]]], Iterator[Any]]] = None,
+                 websocket_callback: Optional[Callable[[WebSocket, Dict[str, List[Any]]], None]] = None):
         '''
         This class shouldn't be used directly. Use one of the implementations instead.
 
@@ -167,28 +413,59 @@ class EndpointBase(threading.Thread):
                         This will be called when a POST request received by the endpoint.
                         It should accept one parameter, which is the deserialized version
                         of the request's body.
+        stream_callback : Function
+                          This will be called when a GET request to `/stream` received by
+                          the endpoint. It should accept one parameter, the query parameters,
+                          and return an iterator of responses. Each response is sent to the
+                          client as soon as the iterator yields it.
+        websocket_callback : Function
+                             This will be called when a WebSocket connection is opened. It
+                             should accept two parameters, the WebSocket and the query
+                             parameters, and return when it's done with the connection.
 
         Notes
         -----
         If callbacks raise EndpointClientError, it will be send back to the client as a
         BadRequest status.
+
+        Responses of GET requests are serialized according to the request's Accept header:
+        pickle (default), json, msgpack, or `application/x-octopus-ndarray`. The last one
+        sends NumPy arrays as raw bytes (see `octopus_sensing.common.ndarray_encoding`).
+        msgpack clients can also receive arrays as raw bytes by adding `ndarray=ext` to the
+        Accept header. In json, `bytes` (e.g. encoded images) are sent as base64 strings.
+
+        Connections are kept alive (HTTP/1.1), so clients should reuse them for their next
+        requests. Responses are compressed with gzip or deflate if the client asks for it
+        in the Accept-Encoding header.
+
+        Streaming responses are sent with chunked transfer encoding. Each response is a frame
+        that starts with its length as a little-endian uint32 (see `read_stream_frames`).
+        If the client accepts `text/event-stream`, responses are sent as Server-Sent Events
+        in JSON instead.
         '''
         super().__init__(daemon=True, name=endpoint_name)
         self._server = None
         self._port = port
         self._get_callback = get_callback
         self._post_callback = post_callback
+        self._stream_callback = stream_callback
+        self._websocket_callback = websocket_callback
+        self._stop_event = threading.Event()
 
     def run(self):
         try:
-            self._server = http.server.ThreadingHTTPServer(
-                ('0.0.0.0', self._port), make_handler(self._get_callback, self._post_callback))
+            handler = make_handler(self._get_callback, self._post_callback,
+                                   self._stream_callback, self._stop_event,
+                                   self._websocket_callback)
+            self._server = http.server.ThreadingHTTPServer(('0.0.0.0', self._port), handler)
             self._server.serve_forever()
         except Exception as ex:
             print("Error in {}".format(self.name), file=sys.stderr)
             traceback.print_exc()
 
     def stop(self):
+        self._stop_event.set()
         if self._server is not None:
             self._server.shutdown()
+            self._server.server_close()
             self._server = None
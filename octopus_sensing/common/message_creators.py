@@ -110,7 +110,7 @@ def save_message(experiment_id: str):
     Creates a message to inform device of saving the data in the file
     This message is used when the data is saved in a continuous mode for partial save of data several times during the experiment.
     After receiving this message, the device will save the data in a file with the name and clear the data in memory.
-    It will takes some time to save the data in the file, so after sending a message, wait for a short time to make sure IO is done.
+    Devices save the data in background and continue recording meanwhile. To make sure IO is done, call DeviceCoordinator.wait_until_saved after sending the message.
     it is recommended to use this message several times in the long duration experiments to avoid losing data in case of unexpected termination of the program.
     The device will continue data recording by sending the next start message.
     
@@ -132,6 +132,7 @@ def save_message(experiment_id: str):
 
     >>> message = save_message("study_1_p10")
     >>> device_coordinator.dispatch(message)
+    >>> device_coordinator.wait_until_saved()
 
     '''
 
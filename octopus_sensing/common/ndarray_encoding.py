@@ -0,0 +1,197 @@
+# This file is part of Octopus Sensing <https://octopus-sensing.nastaran-saffar.me/>
+# Copyright © Nastaran Saffaryazdi 2020-2026
+#
+# Octopus Sensing is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation,
+#  either version 3 of the License, or (at your option) any later version.
+#
+# Octopus Sensing is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Octopus Sensing.
+# If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Binary encodings of NumPy arrays for endpoints and their clients.
+
+`application/x-octopus-ndarray` format:
+
+- 4 bytes: the magic `b"OCND"`
+- 4 bytes: length of the header, little-endian uint32
+- The header: UTF-8 JSON of the response, in which each array is replaced by
+  `{"__ndarray__": <index>, "dtype": <numpy dtype string>, "shape": [...]}`.
+  It is padded with spaces to a multiple of 8 bytes. `bytes` objects (e.g. encoded
+  images) are encoded as uint8 arrays.
+- Raw (C order) bytes of the arrays, in the order of their indexes. Each one is padded with
+  zeros to a multiple of 8 bytes, so they can be viewed as typed arrays without a copy.
+
+msgpack: arrays are encoded as an ext type (`MSGPACK_NDARRAY_EXT_TYPE`). Its data is
+1 byte length of the dtype string, the dtype string, 1 byte number of dimensions, one
+little-endian uint64 for each dimension, and then the raw bytes of the array.
+Use `msgpack_ext_hook` to decode them.
+
+Example
+-------
+Decoding a response of an endpoint:
+
+>>> http_client.request("GET", "/", headers={"Accept": NDARRAY_CONTENT_TYPE})
+>>> data = decode_ndarray_response(http_client.getresponse().read())
+'''
+
+import json
+import struct
+from typing import Any, List, Union
+
+import msgpack
+import numpy
+
+NDARRAY_CONTENT_TYPE = "application/x-octopus-ndarray"
+MSGPACK_NDARRAY_EXT_TYPE = 1
+
+_MAGIC = b"OCND"
+_ALIGNMENT = 8
+
+
+def _is_raw_array(obj: Any) -> bool:
+    '''Arrays that their memory can be sent as is'''
+    return isinstance(obj, numpy.ndarray) and obj.dtype.kind in "biufc"
+
+
+def _padding(size: int) -> bytes:
+    return b"\0" * (-size % _ALIGNMENT)
+
+
+def encode_ndarray_response(response: Any) -> List[Union[bytes, memoryview]]:
+    '''
+    Encodes the response in the `application/x-octopus-ndarray` format
+
+    Parameters
+    ----------
+    response: Any
+        A JSON serializable object, that can have NumPy arrays and scalars in it
+
+    Returns
+    -------
+    buffers: List[Union[bytes, memoryview]]
+        The encoded response is these buffers one after another. Arrays' buffers are
+        views on their memory (if they are contiguous), so they should be written
+        before changing the arrays.
+    '''
+    arrays: List[numpy.ndarray] = []
+
+    def default(obj):
+        if isinstance(obj, bytes):
+            obj = numpy.frombuffer(obj, dtype=numpy.uint8)
+        if _is_raw_array(obj):
+            array = numpy.ascontiguousarray(obj)
+            arrays.append(array)
+            return {"__ndarray__": len(arrays) - 1,
+                    "dtype": array.dtype.str,
+                    "shape": array.shape}
+        elif isinstance(obj, numpy.ndarray):
+            return obj.tolist()
+        elif isinstance(obj, numpy.generic):
+            return obj.item()
+        raise TypeError("Object of type {0} is not JSON serializable".format(
+            obj.__class__.__name__))
+
+    header = json.dumps(response, default=default).encode("UTF-8")
+    header += b" " * (-len(header) % _ALIGNMENT)
+
+    buffers: List[Union[bytes, memoryview]] = \
+        [_MAGIC + struct.pack("<I", len(header)), header]
+    for array in arrays:
+        buffers.append(array.data.cast("B") if array.size > 0 else b"")
+        buffers.append(_padding(array.nbytes))
+    return buffers
+
+
+def decode_ndarray_response(data: bytes) -> Any:
+    '''
+    Decodes a response in the `application/x-octopus-ndarray` format
+
+    Parameters
+    ----------
+    data: bytes
+        Body of the response
+
+    Returns
+    -------
+    response: Any
+        The decoded response. Arrays are read-only views on `data`.
+    '''
+    if data[:4] != _MAGIC:
+        raise ValueError("Not an {0} response".format(NDARRAY_CONTENT_TYPE))
+    header_length, = struct.unpack_from("<I", data, 4)
+    header_end = 8 + header_length
+
+    # Finding where each array starts, by their order
+    array_infos: List[Any] = []
+
+    def object_hook(obj):
+        if "__ndarray__" in obj:
+            array_infos.append(obj)
+        return obj
+
+    response = json.loads(bytes(data[8:header_end]).decode("UTF-8"), object_hook=object_hook)
+
+    offset = header_end
+    arrays = {}
+    for info in sorted(array_infos, key=lambda info: info["__ndarray__"]):
+        dtype = numpy.dtype(info["dtype"])
+        count = int(numpy.prod(info["shape"]))
+        arrays[info["__ndarray__"]] = \
+            numpy.frombuffer(data, dtype=dtype, count=count, offset=offset) \
+                 .reshape(info["shape"])
+        offset += count * dtype.itemsize
+        offset += -offset % _ALIGNMENT
+
+    def replace(obj):
+        if isinstance(obj, dict):
+            if "__ndarray__" in obj:
+                return arrays[obj["__ndarray__"]]
+            return {key: replace(value) for key, value in obj.items()}
+        elif isinstance(obj, list):
+            return [replace(item) for item in obj]
+        return obj
+
+    return replace(response)
+
+
+def msgpack_ext_default(obj: Any) -> Any:
+    '''
+    Used as `default` of msgpack.packb. Encodes arrays as an ext type, and NumPy scalars
+    as numbers.
+    '''
+    if _is_raw_array(obj):
+        array = numpy.ascontiguousarray(obj)
+        dtype = array.dtype.str.encode("ascii")
+        header = struct.pack("<B", len(dtype)) + dtype + \
+            struct.pack("<B{0}Q".format(array.ndim), array.ndim, *array.shape)
+        return msgpack.ExtType(MSGPACK_NDARRAY_EXT_TYPE, header + array.tobytes())
+    elif isinstance(obj, numpy.ndarray):
+        return obj.tolist()
+    elif isinstance(obj, numpy.generic):
+        return obj.item()
+    return obj
+
+
+def msgpack_ext_hook(code: int, data: bytes) -> Any:
+    '''
+    Used as `ext_hook` of msgpack.unpackb. Decodes arrays that are encoded by
+    `msgpack_ext_default`.
+
+    Example
+    -------
+    >>> msgpack.unpackb(response_body, ext_hook=msgpack_ext_hook)
+    '''
+    if code != MSGPACK_NDARRAY_EXT_TYPE:
+        return msgpack.ExtType(code, data)
+    dtype_length = data[0]
+    dtype = numpy.dtype(bytes(data[1:1 + dtype_length]).decode("ascii"))
+    ndim = data[1 + dtype_length]
+    shape = struct.unpack_from("<{0}Q".format(ndim), data, 2 + dtype_length)
+    offset = 2 + dtype_length + 8 * ndim
+    return numpy.frombuffer(data, dtype=dtype, offset=offset,
+                            count=int(numpy.prod(shape))).reshape(shape)
@@ -0,0 +1,342 @@
+# This file is part of Octopus Sensing <https://octopus-sensing.nastaran-saffar.me/>
+# Copyright © Nastaran Saffaryazdi 2020-2026
+#
+# Octopus Sensing is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation,
+#  either version 3 of the License, or (at your option) any later version.
+#
+# Octopus Sensing is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Octopus Sensing.
+# If not, see <https://www.gnu.org/licenses/>.
+
+'''
+A minimal WebSocket (RFC 6455) implementation, for endpoints and their Python clients.
+It supports text and binary messages, fragmented messages, ping/pong and closing.
+Extensions (e.g. compression) are not supported.
+'''
+
+import os
+import base64
+import hashlib
+import socket
+import struct
+import threading
+from typing import Any, List, Optional, Union
+
+_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# Larger messages are refused, so a client can't make us allocate unlimited memory
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_POLICY_VIOLATION = 1008
+CLOSE_MESSAGE_TOO_BIG = 1009
+
+
+class WebSocketError(Exception):
+    '''
+    Parameters
+    ----------
+    message: str
+        Description of the error
+
+    close_code: int, default: CLOSE_PROTOCOL_ERROR
+        The code the connection is closed with, if it's an error in a received frame
+    '''
+
+    def __init__(self, message: str, close_code: int = CLOSE_PROTOCOL_ERROR):
+        super().__init__(message)
+        self.close_code = close_code
+
+
+def get_accept_key(key: str) -> str:
+    '''
+    Computes the Sec-WebSocket-Accept header of the handshake response
+
+    Parameters
+    ----------
+    key: str
+        The Sec-WebSocket-Key header of the handshake request
+
+    Returns
+    -------
+    str
+        The value of Sec-WebSocket-Accept header
+    '''
+    digest = hashlib.sha1(key.strip().encode("ascii") + _GUID).digest()
+    return base64.b64encode(digest).decode("ascii")
+
+
+def _apply_mask(data: bytes, mask: bytes) -> bytes:
+    if len(data) == 0:
+        return data
+    repeated_mask = (mask * (len(data) // 4 + 1))[:len(data)]
+    return (int.from_bytes(data, "big") ^ int.from_bytes(repeated_mask, "big")) \
+        .to_bytes(len(data), "big")
+
+
+class WebSocket:
+    '''
+    One side of a WebSocket connection, after the handshake.
+    `receive` should be called from one thread only, but `send` can be called from
+    several threads.
+
+    Parameters
+    ----------
+    rfile: io.BufferedIOBase
+        The stream that frames are read from
+
+    wfile: io.BufferedIOBase
+        The stream that frames are written to. It should not buffer the writes.
+
+    is_client: bool, default: False
+        Clients should mask the frames they send
+
+    sock: socket.socket, default: None
+        If it's given, it will be closed when the connection closes
+    '''
+
+    def __init__(self, rfile: Any, wfile: Any, is_client: bool = False,
+                 sock: Optional[socket.socket] = None):
+        self._rfile = rfile
+        self._wfile = wfile
+        self._is_client = is_client
+        self._socket = sock
+        self._send_lock = threading.Lock()
+        self._closed = False
+
+    @property
+    def closed(self) -> bool:
+        '''Whether a close frame is sent or the connection is lost'''
+        return self._closed
+
+    def receive(self) -> Optional[Union[str, bytes]]:
+        '''
+        Waits for the next message. Control frames are handled in the meantime.
+
+        Returns
+        -------
+        Union[str, bytes]
+            The message, `str` for text messages and `bytes` for binary ones. None if
+            the connection is closed.
+        '''
+        opcode = None
+        parts: List[bytes] = []
+        size = 0
+        while True:
+            try:
+                frame = self._read_frame()
+            except OSError:
+                self._closed = True
+                return None
+            except WebSocketError as error:
+                self.close(error.close_code)
+                return None
+            if frame is None:
+                self._closed = True
+                return None
+            fin, frame_opcode, payload = frame
+
+            if frame_opcode == OPCODE_CLOSE:
+                if not self._closed:
+                    self.close(struct.unpack("!H", payload[:2])[0]
+                               if len(payload) >= 2 else CLOSE_NORMAL)
+                return None
+            elif frame_opcode == OPCODE_PING:
+                self._send_frame(OPCODE_PONG, [payload])
+                continue
+            elif frame_opcode == OPCODE_PONG:
+                continue
+            elif frame_opcode == OPCODE_CONTINUATION:
+                if opcode is None:
+                    self.close(CLOSE_PROTOCOL_ERROR)
+                    return None
+            elif frame_opcode in (OPCODE_TEXT, OPCODE_BINARY):
+                if opcode is not None:
+                    self.close(CLOSE_PROTOCOL_ERROR)
+                    return None
+                opcode = frame_opcode
+            else:
+                self.close(CLOSE_PROTOCOL_ERROR)
+                return None
+
+            size += len(payload)
+            if size > MAX_MESSAGE_SIZE:
+                self.close(CLOSE_MESSAGE_TOO_BIG)
+                return None
+            parts.append(payload)
+            if fin:
+                message = b"".join(parts)
+                if opcode == OPCODE_TEXT:
+                    return message.decode("UTF-8")
+                return message
+
+    def send(self, message: Union[str, bytes, List[Any]]) -> None:
+        '''
+        Sends a message
+
+        Parameters
+        ----------
+        message: Union[str, bytes, List[bytes-like]]
+            `str` is sent as a text message. Otherwise, it's a binary message. A list of
+            buffers is sent as one message, without joining them first.
+        '''
+        if isinstance(message, str):
+            self._send_frame(OPCODE_TEXT, [message.encode("UTF-8")])
+        elif isinstance(message, list):
+            self._send_frame(OPCODE_BINARY, message)
+        else:
+            self._send_frame(OPCODE_BINARY, [message])
+
+    def close(self, code: int = CLOSE_NORMAL, reason: str = "") -> None:
+        '''Sends a close frame, and closes the socket (if it's given)'''
+        if self._closed:
+            return
+        try:
+            self._send_frame(OPCODE_CLOSE, [struct.pack("!H", code) + reason.encode("UTF-8")])
+        except OSError:
+            pass
+        self._closed = True
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+
+    def _send_frame(self, opcode: int, buffers: List[Any]) -> None:
+        length = sum(memoryview(buffer).nbytes for buffer in buffers)
+        header = bytearray([0x80 | opcode])
+        mask_bit = 0x80 if self._is_client else 0
+        if length < 126:
+            header.append(mask_bit | length)
+        elif length < 2**16:
+            header.append(mask_bit | 126)
+            header += struct.pack("!H", length)
+        else:
+            header.append(mask_bit | 127)
+            header += struct.pack("!Q", length)
+
+        if self._is_client:
+            # Clients' messages are small, so joining them is fine
+            mask = os.urandom(4)
+            header += mask
+            buffers = [_apply_mask(b"".join(bytes(buffer) for buffer in buffers), mask)]
+
+        with self._send_lock:
+            self._wfile.write(header)
+            for buffer in buffers:
+                self._wfile.write(buffer)
+            if hasattr(self._wfile, "flush"):
+                self._wfile.flush()
+
+    def _read_exactly(self, count: int) -> Optional[bytes]:
+        data = self._rfile.read(count)
+        if data is None or len(data) < count:
+            return None
+        return data
+
+    def _read_frame(self):
+        header = self._read_exactly(2)
+        if header is None:
+            return None
+        fin = bool(header[0] & 0x80)
+        opcode = header[0] & 0x0F
+        masked = bool(header[1] & 0x80)
+        length = header[1] & 0x7F
+        if length == 126:
+            extended = self._read_exactly(2)
+            if extended is None:
+                return None
+            length, = struct.unpack("!H", extended)
+        elif length == 127:
+            extended = self._read_exactly(8)
+            if extended is None:
+                return None
+            length, = struct.unpack("!Q", extended)
+        if length > MAX_MESSAGE_SIZE:
+            raise WebSocketError("Frame is too big", CLOSE_MESSAGE_TOO_BIG)
+        # Clients must mask their frames, and servers must not (RFC 6455, section 5.1)
+        if masked == self._is_client:
+            raise WebSocketError("Frame is {0}masked".format("" if masked else "not "))
+
+        mask = None
+        if masked:
+            mask = self._read_exactly(4)
+            if mask is None:
+                return None
+        payload = self._read_exactly(length) if length > 0 else b""
+        if payload is None:
+            return None
+        if mask is not None:
+            payload = _apply_mask(payload, mask)
+        return fin, opcode, payload
+
+
+def connect(host: str, port: int, path: str = "/", timeout: Optional[float] = None) \
+        -> WebSocket:
+    '''
+    Opens a WebSocket connection to an endpoint
+
+    Parameters
+    ----------
+    host: str
+        Host name or IP of the endpoint
+
+    port: int
+        Port of the endpoint
+
+    path: str, default: "/"
+        Path and query string of the request
+
+    timeout: float, default: None
+        Timeout of the socket operations, in seconds
+
+    Returns
+    -------
+    WebSocket
+        The connection
+
+    Example
+    -------
+    >>> websocket = connect("127.0.0.1", 9332, "/?encoding=json")
+    >>> websocket.send(json.dumps({"type": "START", "experiment_id": "123"}))
+    >>> reply = json.loads(websocket.receive())
+    '''
+    sock = socket.create_connection((host, port), timeout=timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    key = base64.b64encode(os.urandom(16)).decode("ascii")
+    request = ("GET {0} HTTP/1.1\r\n"
+               "Host: {1}:{2}\r\n"
+               "Upgrade: websocket\r\n"
+               "Connection: Upgrade\r\n"
+               "Sec-WebSocket-Key: {3}\r\n"
+               "Sec-WebSocket-Version: 13\r\n\r\n").format(path, host, port, key)
+    sock.sendall(request.encode("ascii"))
+
+    rfile = sock.makefile("rb")
+    status_line = rfile.readline().decode("latin-1")
+    headers = {}
+    while True:
+        line = rfile.readline().decode("latin-1").strip()
+        if line == "":
+            break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    if " 101 " not in status_line or \
+            headers.get("sec-websocket-accept") != get_accept_key(key):
+        sock.close()
+        raise WebSocketError("Handshake failed: {0}".format(status_line.strip()))
+
+    return WebSocket(rfile, sock.makefile("wb", buffering=0), is_client=True, sock=sock)
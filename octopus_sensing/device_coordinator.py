@@ -14,35 +14,112 @@
 
 import sys
 import time
+import contextlib
 import traceback
+import itertools
+import threading
 import multiprocessing
 import queue
 import pickle
-from typing import List, Any, Tuple, Dict, Optional
+from typing import List, Any, Tuple, Dict, Hashable, Optional
 
 from octopus_sensing.devices.device import Device
 from octopus_sensing.devices.realtime_data_device import RealtimeDataDevice
+from octopus_sensing.devices.shared_realtime_data import SharedRealtimeDataReader
 from octopus_sensing.common.message import Message
 from octopus_sensing.common.message_creators import terminate_message
 
 QueueType = multiprocessing.queues.Queue
+# Parameters of a realtime data request of a device: duration, cursor and options
+RealtimeDataKey = Tuple[int, Optional[int], Optional[Tuple[Tuple[str, Any], ...]]]
 
 
 class RealtimeDataCache:
-    def __init__(self) -> None:
-        self._time = time.time_ns()
-        self._cached_data: Dict[str, List[Any]] = {}
+    '''
+    Keeps the latest realtime data of each device for a short time (TTL), separately for
+    each request parameters (e.g. duration and cursor). So clients that poll the same data
+    at the same time cost one request to the device.
 
-    def get_cache(self):
-        '''Returns None if cache is not available or expired'''
-        # 100 ms
-        if time.time_ns() - self._time > 100000000:
-            return None
-        return self._cached_data
+    The TTL of a device is one sample period, according to the `sampling_rate` (or
+    `frame_rate`) in the metadata of its data, limited to [`min_ttl`, `max_ttl`].
+    It can be set explicitly with `set_ttl`.
+
+    Parameters
+    ----------
+    min_ttl: float, default: 0.01
+        Minimum TTL in seconds
+
+    max_ttl: float, default: 0.1
+        Maximum TTL in seconds. It is also the TTL of devices without a sampling rate.
+    '''
+
+    def __init__(self, min_ttl: float = 0.01, max_ttl: float = 0.1) -> None:
+        self._min_ttl = min_ttl
+        self._max_ttl = max_ttl
+        # (device name, key) -> (time of caching, data)
+        self._entries: Dict[Tuple[str, Hashable], Tuple[float, Any]] = {}
+        self._ttls: Dict[str, float] = {}
+        self._fixed_ttls: Dict[str, float] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, device_name: str, key: Hashable) -> Optional[Tuple[float, Any]]:
+        '''
+        Returns the cached data and the time it's cached, or None if it is not cached or
+        expired
+        '''
+        with self._lock:
+            stats = self._stats.setdefault(device_name, {"hits": 0, "misses": 0})
+            entry = self._entries.get((device_name, key))
+            if entry is None or time.time() - entry[0] > self.get_ttl(device_name):
+                stats["misses"] += 1
+                return None
+            stats["hits"] += 1
+            return entry
+
+    def cache(self, device_name: str, key: Hashable, data: Any) -> None:
+        '''Caches the data of the device'''
+        now = time.time()
+        with self._lock:
+            if device_name not in self._fixed_ttls:
+                rate = None
+                if isinstance(data, dict) and isinstance(data.get("metadata"), dict):
+                    rate = data["metadata"].get("sampling_rate") or \
+                        data["metadata"].get("frame_rate")
+                ttl = self._max_ttl if not rate else 1 / rate
+                self._ttls[device_name] = min(max(ttl, self._min_ttl), self._max_ttl)
+
+            # Removing the expired entries, so old cursors don't pile up
+            for entry_key in [entry_key for entry_key, (cache_time, _) in self._entries.items()
+                              if now - cache_time > self.get_ttl(entry_key[0])]:
+                del self._entries[entry_key]
+            self._entries[(device_name, key)] = (now, data)
+
+    def set_ttl(self, device_name: str, ttl: float) -> None:
+        '''Sets TTL of the device in seconds, instead of the one from its sampling rate'''
+        with self._lock:
+            self._fixed_ttls[device_name] = ttl
+
+    def get_ttl(self, device_name: str) -> float:
+        '''Returns TTL of the device in seconds'''
+        return self._fixed_ttls.get(device_name,
+                                    self._ttls.get(device_name, self._max_ttl))
+
+    def get_stats(self) -> Dict[str, Dict[str, int]]:
+        '''Returns number of cache `hits` and `misses` of each device'''
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+
+class _InFlightRequest:
+    '''
+    A realtime data request of a device that is being sent. Identical requests that come
+    meanwhile wait for its result instead of sending another request.
+    '''
 
-    def cache(self, data: Dict[str, List[Any]]):
-        self._cached_data = data
-        self._time = time.time_ns()
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.data: Any = None
 
 
 class DeviceCoordinator:
@@ -56,10 +133,28 @@ class DeviceCoordinator:
     def __init__(self) -> None:
         self.__devices: Dict[str, Device] = {}
         self.__queues: List[QueueType] = []
+        # Number of dispatched messages, and its value when each device was added
+        self.__dispatched_messages: int = 0
+        self.__first_messages: Dict[str, int] = {}
+        # Messages can be dispatched from several threads (e.g. the endpoints)
+        self.__dispatch_lock = threading.Lock()
         self.__device_counter: int = 0
-        self.__realtime_data_queues: List[Tuple[QueueType, QueueType, Device]] = [
-        ]
+        self.__realtime_data_queues: \
+            List[Tuple[QueueType, QueueType, Device, SharedRealtimeDataReader]] = []
         self.__realtime_data_cache = RealtimeDataCache()
+        # Realtime data requests are numbered, so late replies of the previous
+        # requests can be recognized and discarded.
+        self.__realtime_request_ids = itertools.count(1)
+        # Protects the cache, in-flight requests and stats
+        self.__realtime_data_lock = threading.Lock()
+        # One fetch at a time for each device, otherwise they discard each other's replies
+        self.__realtime_fetch_locks: Dict[str, threading.Lock] = {}
+        self.__in_flight_requests: Dict[Tuple[str, RealtimeDataKey], _InFlightRequest] = {}
+        # The last received realtime data of each device (and duration and options) without
+        # a cursor, and when it's received
+        self.__last_realtime_data: \
+            Dict[Tuple[str, int, Hashable], Tuple[float, Any]] = {}
+        self.__realtime_data_stats: Dict[str, Dict[str, int]] = {}
 
     def __get_device_id(self) -> str:
         '''
@@ -115,7 +210,9 @@ class DeviceCoordinator:
         self.__devices[device.name] = device
         msg_queue: QueueType = multiprocessing.Queue()
         device.set_queue(msg_queue)
-        self.__queues.append(msg_queue)
+        with self.__dispatch_lock:
+            self.__queues.append(msg_queue)
+            self.__first_messages[device.name] = self.__dispatched_messages
 
         self.__set_realtime_data_queues(device)
 
@@ -158,8 +255,44 @@ class DeviceCoordinator:
                                                       stimuli_id))
         '''
 
-        for message_queue in self.__queues:
-            message_queue.put(message)
+        with self.__dispatch_lock:
+            for message_queue in self.__queues:
+                message_queue.put(message)
+            self.__dispatched_messages += 1
+
+    def wait_until_saved(self, timeout: Optional[float] = None) -> bool:
+        '''
+        Waits until all devices handled the dispatched messages. Devices save their data
+        in background, so this can be used after dispatching a SAVE (or STOP) message to
+        make sure the data is written to the files.
+        Devices that don't report their handled messages, or are not alive, are skipped.
+
+        Parameters
+        ----------
+        timeout: float, default: None
+            Maximum waiting time in seconds. None means waiting without a limit.
+
+        Returns
+        -----------
+        boolean
+            True if all the devices saved their data, False if timeout happened
+
+        Example
+        --------
+        >>> device_coordinator.dispatch(save_message(experiment_id))
+        >>> device_coordinator.wait_until_saved(timeout=5)
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        for device_name, device in self.__devices.items():
+            expected = self.__dispatched_messages - self.__first_messages[device_name]
+            while True:
+                count = device.get_handled_message_count()
+                if count is None or count >= expected or not device.is_alive():
+                    break
+                if deadline is not None and time.time() >= deadline:
+                    return False
+                time.sleep(0.01)
+        return True
 
     def health_check(self):
         '''
@@ -187,8 +320,13 @@ class DeviceCoordinator:
         self.dispatch(terminate_message())
         for item in self.__devices.values():
             item.join()
+        for _, _, _, reader in self.__realtime_data_queues:
+            reader.close()
 
-    def get_realtime_data(self, duration: int, device_list: Optional[List[str]]) -> Dict[str, List[Any]]:
+    def get_realtime_data(self, duration: int, device_list: Optional[List[str]],
+                          since: Optional[Dict[str, int]] = None,
+                          timeout: float = 0.1,
+                          options: Optional[Dict[str, Any]] = None) -> Dict[str, List[Any]]:
         '''
         Returns latest collected data from all devices.
         Device's data can be anything, depending on the device itself.
@@ -201,50 +339,219 @@ class DeviceCoordinator:
         device_list: List[str]
             a list of device names. Only devices in this list will be monitored or processed in realtime
 
+        since: Dict[str, int], default: None
+            Cursor of each device, i.e. the `cursor` that the device returned in the previous
+            call. For these devices, only the newer records are returned.
+
+        timeout: float, default: 0.1
+            Maximum time in seconds to wait for all the devices to reply
+
+        options: Dict[str, Any], default: None
+            Options of the request, that devices can use to prepare their data
+            (e.g. `width` of camera frames). Devices ignore the options they don't support.
+            Values should be hashable.
+
         Returns
         ---------
         data : dict[str, list[any]]
-            The keys are device names and values are collected data from the device
+            The keys are device names and values are collected data from the device.
+            If a device doesn't reply in time, its previous data is returned instead
+            (except when a cursor is given for it). `stale` and `age` (in seconds) in
+            the device's metadata show whether the data is the previous one, and how old it is.
 
         Note
         ----
-        This method is being used for getting data in real-time for monitoring or realtime processing
+        This method is being used for getting data in real-time for monitoring or realtime processing.
+        Data of each device is cached for a short time (see `RealtimeDataCache`), and identical
+        requests that are made at the same time (e.g. by several clients) are sent to the
+        device only once.
 
         '''
-        cached = self.__realtime_data_cache.get_cache()
-        if cached:
-            return cached
+        result: Dict[str, Any] = {}
+        # Requests that this call sends, and requests of other calls that it waits for
+        own_requests: List[Tuple[QueueType, QueueType, str, SharedRealtimeDataReader,
+                                 RealtimeDataKey, _InFlightRequest]] = []
+        other_requests: List[Tuple[str, RealtimeDataKey, _InFlightRequest]] = []
+        options_key = None if not options else tuple(sorted(options.items()))
+        with self.__realtime_data_lock:
+            for in_q, out_q, device, reader in self.__realtime_data_queues:
+                if device_list is not None and device.name not in device_list:
+                    continue
+                device_since = None if since is None else since.get(device.name)
+                key: RealtimeDataKey = (duration, device_since, options_key)
+                cached = self.__realtime_data_cache.get(device.name, key)
+                if cached is not None:
+                    cache_time, records = cached
+                    result[device.name] = \
+                        self.__with_staleness(records, False, time.time() - cache_time)
+                    continue
+                in_flight = self.__in_flight_requests.get((device.name, key))
+                if in_flight is not None:
+                    self.__realtime_data_stats[device.name]["coalesced"] += 1
+                    other_requests.append((device.name, key, in_flight))
+                    continue
+                in_flight = _InFlightRequest()
+                self.__in_flight_requests[(device.name, key)] = in_flight
+                own_requests.append((in_q, out_q, device.name, reader, key, in_flight))
+
+        if len(own_requests) > 0:
+            with contextlib.ExitStack() as stack:
+                # Always locked in the same order, so concurrent calls don't deadlock
+                for device_name in sorted(request[2] for request in own_requests):
+                    stack.enter_context(self.__realtime_fetch_locks[device_name])
+                fetched = self.__fetch_realtime_data(own_requests, timeout)
+            with self.__realtime_data_lock:
+                for _, _, device_name, _, key, in_flight in own_requests:
+                    in_flight.data = fetched.get(device_name)
+                    in_flight.done.set()
+                    del self.__in_flight_requests[(device_name, key)]
+            result.update(fetched)
+
+        for device_name, key, in_flight in other_requests:
+            if in_flight.done.wait(timeout=timeout + 1):
+                if in_flight.data is not None:
+                    result[device_name] = in_flight.data
+                continue
+            # The other call is still waiting to fetch, e.g. for other devices
+            with self.__realtime_data_lock:
+                self.__realtime_data_stats[device_name]["timeouts"] += 1
+            last = self.__get_last_realtime_data(device_name, key)
+            if last is not None:
+                result[device_name] = last
+
+        return result
 
-        out_queues: List[Tuple[QueueType, str]] = []
+    def __fetch_realtime_data(self,
+                              requests: List[Tuple[QueueType, QueueType, str,
+                                                   SharedRealtimeDataReader, RealtimeDataKey,
+                                                   _InFlightRequest]],
+                              timeout: float) -> Dict[str, Any]:
+        '''Sends the requests to the devices and collects their replies'''
+        request_id = next(self.__realtime_request_ids)
         # Putting request for all devices, then collecting them all, for performance reasons.
-        for in_q, out_q, device in self.__realtime_data_queues:
-            if device_list is None or device.name in device_list:
-                try:
-                    # The sub-process won't use the data we put in the queue. It's just a signal.
-                    in_q.put(str(duration), timeout=0.1)
-                    out_queues.append((out_q, device.name))
-                except queue.Full:
-                    print("Could not put realtime data request for {0} device.".format(
-                        device.name), file=sys.stderr)
-                    traceback.print_exc()
-
-        result: Dict[str, List[Any]] = {}
-        for out_q, device_name in out_queues:
+        for in_q, _, _, _, key, _ in requests:
+            duration, device_since, options_key = key
+            in_q.put((request_id, duration, device_since,
+                      None if options_key is None else dict(options_key)))
+
+        # One deadline for all devices. They prepare their replies in parallel.
+        deadline = time.time() + timeout
+        result: Dict[str, Any] = {}
+        for _, out_q, device_name, reader, key, _ in requests:
+            stats = self.__realtime_data_stats[device_name]
+            stats["requests"] += 1
+            records = self.__receive_realtime_data(out_q, reader, device_name,
+                                                   request_id, deadline)
+            duration, device_since, options_key = key
+            if records is not None:
+                # The data of a cursor is not a complete window, so it can't replace a
+                # request without cursor.
+                if device_since is None:
+                    self.__last_realtime_data[(device_name, duration, options_key)] = \
+                        (time.time(), records)
+                self.__realtime_data_cache.cache(device_name, key, records)
+                result[device_name] = self.__with_staleness(records, False, 0)
+                continue
+
+            stats["timeouts"] += 1
+            last = self.__get_last_realtime_data(device_name, key)
+            if last is not None:
+                result[device_name] = last
+        return result
+
+    def __get_last_realtime_data(self, device_name: str,
+                                 key: RealtimeDataKey) -> Optional[Dict[str, Any]]:
+        '''The previous data of a request that is not answered in time, marked as stale'''
+        duration, device_since, options_key = key
+        # With a cursor, the previous data would be a duplicate
+        if device_since is not None:
+            return None
+        last = self.__last_realtime_data.get((device_name, duration, options_key))
+        if last is None:
+            return None
+        received_time, records = last
+        return self.__with_staleness(records, True, time.time() - received_time)
+
+    def get_realtime_data_stats(self) -> Dict[str, Dict[str, int]]:
+        '''
+        Returns counters of realtime data requests of each device
+
+        Returns
+        ---------
+        stats : dict[str, dict[str, int]]
+            The keys are device names. Each value has `requests` (number of requests),
+            `timeouts` (number of requests that the device didn't reply in time),
+            `stale_replies` (number of late replies that are discarded), `coalesced`
+            (number of requests that waited for an identical one), `cache_hits` and
+            `cache_misses`.
+        '''
+        with self.__realtime_data_lock:
+            stats = {name: dict(device_stats)
+                     for name, device_stats in self.__realtime_data_stats.items()}
+        for name, cache_stats in self.__realtime_data_cache.get_stats().items():
+            stats[name]["cache_hits"] = cache_stats["hits"]
+            stats[name]["cache_misses"] = cache_stats["misses"]
+        return stats
+
+    def set_realtime_cache_ttl(self, device_name: str, ttl: float) -> None:
+        '''
+        Sets for how long realtime data of a device can be cached. By default, it's one
+        sample period of the device (between 10 and 100 milliseconds).
+
+        Parameters
+        ----------
+        device_name: str
+            Name of the device
+
+        ttl: float
+            Time in seconds
+        '''
+        self.__realtime_data_cache.set_ttl(device_name, ttl)
+
+    def __receive_realtime_data(self, out_q: QueueType, reader: SharedRealtimeDataReader,
+                                device_name: str, request_id: int, deadline: float) -> Any:
+        '''Returns the device's reply to the request, or None if there is no valid reply in time'''
+        while True:
             try:
-                records = pickle.loads(out_q.get(timeout=0.1))
-                # We ensured device has a name in the add_device, ignoring it here.
-                result[device_name] = records  # type: ignore
-            except (queue.Empty, pickle.PickleError):
+                reply_id, message = \
+                    pickle.loads(out_q.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                print("Could not read realtime data from {0} device in time".format(
+                    device_name), file=sys.stderr)
+                return None
+            except pickle.PickleError:
                 print("Could not read realtime data from {0} device".format(
                     device_name), file=sys.stderr)
                 traceback.print_exc()
+                return None
 
-        self.__realtime_data_cache.cache(result)
-        return result
+            if reply_id != request_id:
+                # A late reply to a previous request
+                self.__realtime_data_stats[device_name]["stale_replies"] += 1
+                continue
+
+            records = reader.read(message)
+            if records is None:
+                print("Realtime data of {0} device was overwritten while reading it".format(
+                    device_name), file=sys.stderr)
+            return records
+
+    @staticmethod
+    def __with_staleness(records: Any, stale: bool, age: float) -> Any:
+        if not isinstance(records, dict) or not isinstance(records.get("metadata"), dict):
+            return records
+        records = dict(records)
+        records["metadata"] = dict(records["metadata"], stale=stale, age=age)
+        return records
 
     def __set_realtime_data_queues(self, device: Device) -> None:
         if isinstance(device, RealtimeDataDevice):
             in_q: QueueType = multiprocessing.Queue()
             out_q: QueueType = multiprocessing.Queue()
             device.set_realtime_data_queues(in_q, out_q)
-            self.__realtime_data_queues.append((in_q, out_q, device))
+            self.__realtime_data_queues.append(
+                (in_q, out_q, device, SharedRealtimeDataReader()))
+            self.__realtime_fetch_locks[device.name] = threading.Lock()
+            self.__realtime_data_stats[device.name] = \
+                {"requests": 0, "timeouts": 0, "stale_replies": 0, "coalesced": 0,
+                 "cache_hits": 0, "cache_misses": 0}
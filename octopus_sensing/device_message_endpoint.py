@@ -17,6 +17,44 @@ from octopus_sensing.device_coordinator import DeviceCoordinator
 from octopus_sensing.common.message import Message
 
 
+def make_message(request_body: dict) -> Message:
+    '''
+    Creates a Message from a request's body. It's a dictionary with `type` and optional
+    `experiment_id`, `stimulus_id` and `payload` fields.
+
+    Raises
+    ------
+    EndpointClientError
+        If the body is not valid
+    '''
+    if not isinstance(request_body, dict):
+        raise EndpointClientError(
+            "The request body must contain a dictionary. Got [{}]".format(type(request_body)))
+
+    if 'type' not in request_body:
+        raise EndpointClientError(
+            "'type' field is mandatory in request body")
+
+    message_type = request_body['type']
+    experiment_id = request_body.get('experiment_id', None)
+    stimulus_id = request_body.get('stimulus_id', None)
+
+    if not isinstance(message_type, str):
+        raise EndpointClientError(
+            "'type' must be of type 'str', got '{0}'".format(type(message_type)))
+    if experiment_id is not None and not isinstance(experiment_id, str):
+        raise EndpointClientError(
+            "'experiment_id' must be of type 'str', got '{0}'".format(type(experiment_id)))
+    if stimulus_id is not None and not isinstance(stimulus_id, str):
+        raise EndpointClientError(
+            "'stimulus_id' must be of type 'str', got '{0}'".format(type(stimulus_id)))
+
+    return Message(message_type,
+                   request_body.get('payload', None),
+                   experiment_id,
+                   stimulus_id)
+
+
 class DeviceMessageHTTPEndpoint(EndpointBase):
     '''
     Stars and endpoint that listens for incoming Message requests. It passes the message to
@@ -74,33 +112,6 @@ class DeviceMessageHTTPEndpoint(EndpointBase):
         self._device_coordinator = device_coordinator
 
     def _post_handler(self, request_body: dict):
-        if not isinstance(request_body, dict):
-            raise EndpointClientError(
-                "The request body must contain a dictionary. Got [{}]".format(type(request_body)))
-
-        if 'type' not in request_body:
-            raise EndpointClientError(
-                "'type' field is mandatory in request body")
-
-        message_type = request_body['type']
-        experiment_id = request_body.get('experiment_id', None)
-        stimulus_id = request_body.get('stimulus_id', None)
-
-        if not isinstance(message_type, str):
-            raise EndpointClientError(
-                "'type' must be of type 'str', got '{0}'".format(type(message_type)))
-        if experiment_id is not None and not isinstance(experiment_id, str):
-            raise EndpointClientError(
-                "'experiment_id' must be of type 'str', got '{0}'".format(type(experiment_id)))
-        if message_type is not None and not isinstance(message_type, str):
-            raise EndpointClientError(
-                "'stimulus_id' must be of type 'str', got '{0}'".format(type(stimulus_id)))
-
-        message = Message(message_type,
-                          request_body.get('payload', None),
-                          experiment_id,
-                          stimulus_id)
-
-        self._device_coordinator.dispatch(message)
+        self._device_coordinator.dispatch(make_message(request_body))
 
         return "message dispatched"
@@ -47,6 +47,13 @@ try:
 except ImportError:
     print('Not Installed')
 
+print('MultiCameraStreaming..............', end='')
+try:
+    from octopus_sensing.devices.multi_camera_streaming import MultiCameraStreaming
+    print('Installed')
+except ImportError:
+    print('Not Installed')
+
 print('AudioStreaming....................', end='')
 try:
     from octopus_sensing.devices.audio_streaming import AudioStreaming
@@ -13,16 +13,109 @@
 # If not, see <https://www.gnu.org/licenses/>.
 
 import os
-import array
-from typing import List, Any, Dict
+import time
+import multiprocessing
+import wave
+import threading
+from typing import List, Any, Dict, Optional
 import datetime
 import csv
+import numpy as np
 import miniaudio
 
 from octopus_sensing.devices.realtime_data_device import RealtimeDataDevice
+from octopus_sensing.devices.ring_buffer import RingBuffer
 from octopus_sensing.common.message_creators import MessageType
 from octopus_sensing.devices.common import SavingModeEnum
 
+# Samples are captured as 16-bit integers (miniaudio's default format)
+SAMPLE_WIDTH = 2
+
+
+class WavFileWriter:
+    '''
+    Writes audio to a WAV file as it is captured, so the recording doesn't have to be
+    kept in memory. The sizes in the WAV header are updated when the file is closed.
+
+    Attributes
+    ----------
+    file_names: List[str]
+        The written files, in order
+
+    Parameters
+    ----------
+    file_name: str
+        The WAV file
+
+    channels: int
+        Number of channels
+
+    sample_rate: int
+        Number of samples per second
+
+    max_file_size: int, default: None
+        The maximum size of each file in bytes. When a file reaches it, the recording
+        continues in the next file: {file name}-part2.wav, {file name}-part3.wav and so on.
+        Files are not split if it is None. Note that WAV files can't be bigger than 4GB.
+    '''
+
+    def __init__(self, file_name: str, channels: int, sample_rate: int,
+                 max_file_size: Optional[int] = None):
+        self.file_names: List[str] = []
+        self._file_name = file_name
+        self._channels = channels
+        self._sample_rate = sample_rate
+        self._frame_size = channels * SAMPLE_WIDTH
+        self._max_frames: Optional[int] = None
+        if max_file_size is not None:
+            # 44 bytes is the size of the WAV header
+            self._max_frames = max((max_file_size - 44) // self._frame_size, 1)
+        self._file: Optional[wave.Wave_write] = None
+        self._file_frames = 0
+        self._open_next_file()
+
+    def write(self, data: bytes) -> None:
+        '''
+        Writes captured audio to the file
+
+        Parameters
+        ----------
+        data: bytes
+            Interleaved 16-bit samples of all channels
+        '''
+        assert self._file is not None
+        view = memoryview(data).cast("B")
+        while len(view) >= self._frame_size:
+            frames = len(view) // self._frame_size
+            if self._max_frames is not None:
+                if self._file_frames >= self._max_frames:
+                    self._file.close()
+                    self._open_next_file()
+                frames = min(frames, self._max_frames - self._file_frames)
+            self._file.writeframesraw(view[:frames * self._frame_size])
+            self._file_frames += frames
+            view = view[frames * self._frame_size:]
+
+    def close(self) -> None:
+        '''Closes the file and updates its header'''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _open_next_file(self) -> None:
+        if not self.file_names:
+            file_name = self._file_name
+        else:
+            file_name = "{0}-part{1}.wav".format(self._file_name[:-4],
+                                                 len(self.file_names) + 1)
+        self._file = wave.open(file_name, "wb")
+        self._file.setnchannels(self._channels)
+        self._file.setsampwidth(SAMPLE_WIDTH)
+        self._file.setframerate(self._sample_rate)
+        self._file_frames = 0
+        self.file_names.append(file_name)
+
+
 class AudioStreaming(RealtimeDataDevice):
     '''
     Stream and Record audio
@@ -44,6 +137,23 @@ class AudioStreaming(RealtimeDataDevice):
                  The path for recording files.
                  Audio files will be recorded in folder {output_path}/{name}
 
+    saving_mode: int, default: SavingModeEnum.SEPARATED_SAVING_MODE
+        The way of saving data: saving continiously in a file or save data related to
+        each stimulus in a separate file.
+        SavingModeEnum is CONTINIOUS_SAVING_MODE = 0 or SEPARATED_SAVING_MODE = 1
+
+    max_file_size: int, default: None
+        The maximum size of each WAV file in bytes. Longer recordings are split into
+        several files (see `WavFileWriter`). Files are not split if it is None.
+
+    realtime_buffer_duration: int, default: 10
+        Seconds of the latest audio that are kept in memory for realtime data
+
+    Notes
+    -----
+    Audio is written to the file while it is being captured, so the memory usage doesn't
+    grow with the length of the recording.
+
 
     Example
     -------
@@ -73,7 +183,9 @@ class AudioStreaming(RealtimeDataDevice):
 
     '''
     def __init__(self, device_id:int, 
-                 saving_mode: int=SavingModeEnum.SEPARATED_SAVING_MODE, **kwargs):
+                 saving_mode: int=SavingModeEnum.SEPARATED_SAVING_MODE,
+                 max_file_size: Optional[int] = None,
+                 realtime_buffer_duration: int = 10, **kwargs):
         super().__init__(**kwargs)
         self.output_path = os.path.join(self.output_path, self.name)
         os.makedirs(self.output_path, exist_ok=True)
@@ -81,19 +193,41 @@ class AudioStreaming(RealtimeDataDevice):
         self._device_id = device_id
         
         self._saving_mode = saving_mode
-        self._stream_data: List[bytes] = []
+        self._max_file_size = max_file_size
+        self._realtime_buffer_duration = realtime_buffer_duration
+        # Latest samples for realtime data. It's created when the capture device is opened.
+        self._stream_data: Optional[RingBuffer] = None
+        # The file that captured audio is written to, if any
+        self._file: Optional[WavFileWriter] = None
+        self._file_lock = threading.Lock()
         self._record = False
         self._terminate = False
         self._state = ""
-        self._log: List[str] = []
+        self._log: List[Any] = []
         self._continuous_capture = False
         self._sampling_rate = 44100
+        self._handled_messages = multiprocessing.Value('Q', 0)
 
     def __stream_loop(self):
-        _ = yield
+        # It is primed with `next` before the capture starts. So the first chunk of
+        # audio is received by the first `yield`.
         while True:
             data = yield
-            self._stream_data.append(data)
+            capture_time = time.time()
+            with self._file_lock:
+                if self._file is not None:
+                    self._file.write(data)
+            stream_data = self._stream_data
+            if stream_data is not None:
+                samples = np.frombuffer(data, dtype=np.int16)
+                samples = samples[:len(samples) - len(samples) % stream_data.channels]
+                samples = samples.reshape(-1, stream_data.channels)
+                # Nothing is saved from this buffer, so old samples can be overwritten.
+                # Long chunks are added in parts, so the buffer doesn't grow.
+                for start in range(0, len(samples), stream_data.capacity):
+                    stream_data.extend(samples[start:start + stream_data.capacity],
+                                       capture_time)
+                    stream_data.mark_saved(stream_data.sample_count)
 
     def _run(self):
         devices = miniaudio.Devices()
@@ -103,12 +237,16 @@ class AudioStreaming(RealtimeDataDevice):
             miniaudio.CaptureDevice(buffersize_msec=1000,
                                     sample_rate=self._sampling_rate,
                                     device_id=selected_device["id"])
+        self._stream_data = \
+            RingBuffer(capture.nchannels,
+                       capture.sample_rate * self._realtime_buffer_duration,
+                       dtype=np.int16)
 
         recorder = self.__stream_loop()
         next(recorder)
 
-        while True:
-            message = self.message_queue.get()
+        # Files are closed while handling the messages, so they are acknowledged directly
+        for message in self._receive_messages():
             if message is None:
                 continue
             if message.type == MessageType.START:
@@ -116,11 +254,22 @@ class AudioStreaming(RealtimeDataDevice):
                     print("Audio streaming has already started")
                 else:
                     if self._saving_mode == SavingModeEnum.SEPARATED_SAVING_MODE:
-                        self._stream_data = []
+                        file_name = \
+                            "{0}/{1}-{2}-{3}.wav".format(self.output_path,
+                                                        self.name,
+                                                        message.experiment_id,
+                                                        str(message.stimulus_id).zfill(2))
+                        self._open_file(file_name, capture)
                         capture.start(recorder)
                         self._record = True
                     else:
                         if self._continuous_capture is False:
+                            self._experiment_id = message.experiment_id
+                            file_name = \
+                                "{0}/{1}-{2}.wav".format(self.output_path,
+                                                         self.name,
+                                                         self._experiment_id)
+                            self._open_file(file_name, capture)
                             capture.start(recorder)
                             self._continuous_capture = True
                             self._record = True
@@ -136,12 +285,7 @@ class AudioStreaming(RealtimeDataDevice):
                     if self._saving_mode == SavingModeEnum.SEPARATED_SAVING_MODE:
                         capture.stop()
                         self._record = False
-                        file_name = \
-                            "{0}/{1}-{2}-{3}.wav".format(self.output_path,
-                                                        self.name,
-                                                        message.experiment_id,
-                                                        str(message.stimulus_id).zfill(2))
-                        self._save_to_file(file_name, capture)
+                        self._close_file()
                     else:
                         self._log.append([datetime.datetime.now(),
                                          str(message.stimulus_id).zfill(2),
@@ -150,31 +294,31 @@ class AudioStreaming(RealtimeDataDevice):
                     self._state = "STOP"
             elif message.type == MessageType.TERMINATE:
                 self._terminate = True
-                if self._saving_mode == SavingModeEnum.CONTINIOUS_SAVING_MODE:
+                if self._saving_mode == SavingModeEnum.CONTINIOUS_SAVING_MODE and \
+                        self._continuous_capture:
                     self._log.append([datetime.datetime.now(),
                                      "-",
                                      'MESSAGE TERMINATE'])
                     capture.stop()
                     self._record = False
-                    file_name = \
-                        "{0}/{1}-{2}.wav".format(self.output_path,
-                                                 self.name,
-                                                 self._experiment_id)
-                    self._save_to_file(file_name, capture)
+                    self._close_file()
                     self._save_log_file(f"{self.output_path}/{self.name}-{self._experiment_id}-log.csv")                    
                 break
 
-    def _save_to_file(self, file_name:str, capture:miniaudio.CaptureDevice):
-        buffer = b"".join(self._stream_data)
-        samples = array.array('h')
-        samples.frombytes(buffer)
-        sound = miniaudio.DecodedSoundFile('capture',
-                                           capture.nchannels,
-                                           capture.sample_rate,
-                                           capture.format,
-                                           samples)
-        miniaudio.wav_write_file(file_name, sound)
-        print("Saving to file {0} is done".format(file_name))
+        self._acknowledge_message()
+
+    def _open_file(self, file_name: str, capture: miniaudio.CaptureDevice) -> None:
+        with self._file_lock:
+            self._file = WavFileWriter(file_name, capture.nchannels, capture.sample_rate,
+                                       max_file_size=self._max_file_size)
+
+    def _close_file(self) -> None:
+        with self._file_lock:
+            file = self._file
+            self._file = None
+        if file is not None:
+            file.close()
+            print("Saving to file {0} is done".format(", ".join(file.file_names)))
 
     def _save_log_file(self, file_name:str):
         with open(file_name, 'a') as csv_file:
@@ -196,7 +340,8 @@ class AudioStreaming(RealtimeDataDevice):
         '''
         return self._saving_mode
     
-    def _get_realtime_data(self, duration: int) -> Dict[str, Any]:
+    def _get_realtime_data(self, duration: int,
+                           since: Optional[int] = None) -> Dict[str, Any]:
         '''
         Returns n seconds (duration) of latest collected data for monitoring/visualizing or 
         realtime processing purposes.
@@ -206,18 +351,38 @@ class AudioStreaming(RealtimeDataDevice):
         duration: int
             A time duration in seconds for getting the latest recorded data in realtime
 
+        since: int, default: None
+            If it is given, only the samples with a sequence number greater than or equal
+            to it are returned. It is usually the `cursor` of the previous call.
+
         Returns
         -------
         data: Dict[str, Any]
-            The keys are `data` and `metadata`.  
-            `data` is a list of records, or empty list if there's nothing.
-            `metadata` is a dictionary of device metadata including `sampling_rate` and `type`
+            The keys are `data`, `timestamps`, `sequence`, `cursor` and `metadata`.
+            `data` is a 2D array of 16-bit samples (samples * channels), of at most
+            `realtime_buffer_duration` seconds.
+            `timestamps` is an array of samples' capture time. Samples captured together
+            have the same time.
+            `sequence` is the sequence number of the first sample, and `cursor` is the
+            sequence number of the next sample.
+            `metadata` is a dictionary of device metadata including `sampling_rate`,
+            `channels` and `type`
         '''
+        stream_data = self._stream_data
+        if stream_data is None:
+            return {"data": [],
+                    "metadata": {"sampling_rate": self._sampling_rate,
+                                 "type": self.__class__.__name__}}
 
-        data = self._stream_data[-1 * duration * self._sampling_rate:]
+        data, timestamps, _, sequence = \
+            stream_data.get_since(since or 0, duration * self._sampling_rate)
         metadata = {"sampling_rate": self._sampling_rate,
+                    "channels": stream_data.channels,
                     "type": self.__class__.__name__}
 
         realtime_data = {"data": data,
+                         "timestamps": timestamps,
+                         "sequence": sequence,
+                         "cursor": sequence + len(data),
                          "metadata": metadata}
-        return realtime_data
\ No newline at end of file
+        return realtime_data
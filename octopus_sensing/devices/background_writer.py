@@ -0,0 +1,114 @@
+# This file is part of Octopus Sensing <https://octopus-sensing.nastaran-saffar.me/>
+# Copyright © Nastaran Saffaryazdi 2020-2026
+#
+# Octopus Sensing is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation,
+#  either version 3 of the License, or (at your option) any later version.
+#
+# Octopus Sensing is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Octopus Sensing.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import sys
+import queue
+import threading
+import traceback
+from typing import Any, Callable
+
+from octopus_sensing.devices.ring_buffer import RingBuffer
+
+
+class BackgroundWriter(threading.Thread):
+    '''
+    A thread that runs file writing jobs of a device one by one, in the order they
+    were submitted. So the thread that handles messages doesn't wait for disk I/O.
+
+    Attributes
+    ----------
+
+    Parameters
+    ----------
+    name: str
+        Name of the thread
+
+    Example
+    -------
+    >>> writer = BackgroundWriter("my_device writer")
+    >>> writer.start()
+    >>> writer.submit(save_to_file, "output/my_device.csv", data)
+    >>> # Waits for all submitted jobs to finish
+    >>> writer.stop()
+    '''
+
+    def __init__(self, name: str):
+        super().__init__(name=name, daemon=True)
+        self._jobs: queue.Queue = queue.Queue()
+
+    def submit(self, function: Callable[..., Any], *args: Any) -> None:
+        '''
+        Queues a job. `function` will be called with `args` in the writer thread.
+
+        Parameters
+        ----------
+        function: Callable
+            The job
+
+        args: Any
+            Arguments of the function
+        '''
+        self._jobs.put((function, args))
+
+    def submit_unsaved(self, buffer: RingBuffer, function: Callable[..., Any],
+                       *args: Any) -> None:
+        '''
+        Takes the unsaved samples of `buffer`, and queues a job to save them.
+        `function` will be called with `args` followed by the data, timestamps and
+        triggers of the samples. The samples are marked as saved after the job, even if
+        it fails. Otherwise, the buffer would keep growing to hold them.
+
+        Parameters
+        ----------
+        buffer: RingBuffer
+            The buffer of the samples
+
+        function: Callable
+            The job that saves the samples
+
+        args: Any
+            Arguments of the function, before the samples
+        '''
+        data, timestamps, triggers, end = buffer.take_unsaved()
+        self.submit(self._save_unsaved, buffer, end, function,
+                    args + (data, timestamps, triggers))
+
+    def stop(self) -> None:
+        '''Waits for the submitted jobs to finish, and stops the thread.'''
+        self._jobs.put(None)
+        self.join()
+
+    def run(self) -> None:
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            function, args = job
+            try:
+                function(*args)
+            except Exception:
+                print("[{0}] Error in background writing".format(self.name), file=sys.stderr)
+                traceback.print_exc()
+
+    def _save_unsaved(self, buffer: RingBuffer, end: int, function: Callable[..., Any],
+                      args: Any) -> None:
+        try:
+            function(*args)
+        except Exception:
+            # args ends with data, timestamps and triggers
+            print("[{0}] Error in background writing. {1} samples are lost"
+                  .format(self.name, len(args[-3])), file=sys.stderr)
+            traceback.print_exc()
+        finally:
+            buffer.mark_saved(end)
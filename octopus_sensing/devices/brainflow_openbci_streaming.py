@@ -16,7 +16,8 @@ import platform
 from typing import List, Optional
 from brainflow.board_shim import BrainFlowInputParams
 from octopus_sensing.devices.brainflow_streaming import BrainFlowStreaming
-from octopus_sensing.devices.common import SavingModeEnum
+from octopus_sensing.devices.ring_buffer import iter_rows
+from octopus_sensing.devices.common import SavingModeEnum, TriggerModeEnum
 import os
 import csv
 
@@ -47,6 +48,14 @@ class BrainFlowOpenBCIStreaming(BrainFlowStreaming):
             0. CONTINIOUS_SAVING_MODE
             1. SEPARATED_SAVING_MODE
 
+    trigger_mode: int, default: TriggerModeEnum.STRING_TRIGGER_MODE
+        The way of recording triggers. In MARKER_TRIGGER_MODE, triggers are recorded
+        as numeric codes in the board's marker channel (see BrainFlowStreaming).
+        TriggerModeEnum is:
+
+            0. STRING_TRIGGER_MODE
+            1. MARKER_TRIGGER_MODE
+
     board_type: str, default: cyton-daisy
         The type of OpenBCI boards that connect by USB dongle.
         It can be:
@@ -105,7 +114,8 @@ class BrainFlowOpenBCIStreaming(BrainFlowStreaming):
                  name: Optional[str] = None,
                  output_path: str = "output",
                  serial_port=None,
-                 saving_mode: int=SavingModeEnum.CONTINIOUS_SAVING_MODE):
+                 saving_mode: int=SavingModeEnum.CONTINIOUS_SAVING_MODE,
+                 trigger_mode: int=TriggerModeEnum.STRING_TRIGGER_MODE):
         self.channels = channels_order
         if board_type == "cyton-daisy":
             device_id = 2
@@ -148,7 +158,8 @@ class BrainFlowOpenBCIStreaming(BrainFlowStreaming):
                          brain_flow_input_params=params,
                          name=name,
                          output_path=output_path,
-                         saving_mode=saving_mode)
+                         saving_mode=saving_mode,
+                         trigger_mode=trigger_mode)
 
     def get_output_path(self):
         '''
@@ -187,7 +198,7 @@ class BrainFlowOpenBCIStreaming(BrainFlowStreaming):
         '''
         return self._saving_mode
 
-    def _save_to_file(self, file_name):
+    def _write_to_file(self, file_name, data, timestamps, triggers):
         print("Saving {0} to file {1}".format(self._name, file_name))
         if not os.path.exists(file_name):
             csv_file = open(file_name, 'a')
@@ -203,7 +214,6 @@ class BrainFlowOpenBCIStreaming(BrainFlowStreaming):
             csv_file.close()
         with open(file_name, 'a') as csv_file:
             writer = csv.writer(csv_file)
-            for row in self._stream_data:
-                writer.writerow(row)
-                csv_file.flush()
+            writer.writerows(iter_rows(data, timestamps, triggers, self._format_timestamp))
+            csv_file.flush()
         print("Saving {0} to file {1} is done".format(self._name, file_name))
\ No newline at end of file
@@ -16,14 +16,31 @@ from datetime import datetime
 import time
 import os
 import threading
+import multiprocessing
 import csv
 import numpy as np
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 from brainflow.board_shim import BoardShim, BrainFlowInputParams
 
 from octopus_sensing.common.message_creators import MessageType
 from octopus_sensing.devices.realtime_data_device import RealtimeDataDevice
-from octopus_sensing.devices.common import SavingModeEnum
+from octopus_sensing.devices.common import SavingModeEnum, TriggerModeEnum
+from octopus_sensing.devices.background_writer import BackgroundWriter
+from octopus_sensing.devices.ring_buffer import RingBuffer, REALTIME_BUFFER_DURATION, iter_rows
+
+
+# In seconds. The board is checked for new data this often.
+POLL_INTERVAL = 0.1
+
+
+def _nearest_sample(timestamps: np.ndarray, time_: float) -> int:
+    '''Returns the row of the sample that its time is the nearest to `time_`'''
+    row = int(np.searchsorted(timestamps, time_))
+    if row == len(timestamps):
+        return row - 1
+    if row > 0 and time_ - timestamps[row - 1] <= timestamps[row] - time_:
+        return row - 1
+    return row
 
 
 class BrainFlowStreaming(RealtimeDataDevice):
@@ -58,6 +75,13 @@ class BrainFlowStreaming(RealtimeDataDevice):
         or saves data which are related to various stimulus in separate files.
         default is SavingModeEnum.CONTINIOUS_SAVING_MODE
         SavingModeEnum is [CONTINIOUS_SAVING_MODE, SEPARATED_SAVING_MODE]
+
+    trigger_mode
+        The way of recording triggers. default is TriggerModeEnum.STRING_TRIGGER_MODE
+        In TriggerModeEnum.MARKER_TRIGGER_MODE, each trigger gets a numeric code (starting
+        from 1) which is inserted into the board's marker channel by BrainFlow. The codes
+        are saved in {file name}-markers.csv next to each recorded file, with
+        `code, trigger` columns.
     ** kwargs:
        Extra optional arguments according to the board type
 
@@ -66,6 +90,13 @@ class BrainFlowStreaming(RealtimeDataDevice):
     :class:`octopus_sensing.device_coordinator`
     :class:`octopus_sensing.devices.device`
 
+    Notes
+    -----
+    Each record's time is taken from the board's timestamp channel, and triggers are
+    recorded with the record that its time is the nearest to the time the message is
+    received. In MARKER_TRIGGER_MODE, BrainFlow records the marker with the next sample
+    it receives from the board.
+
     Examples
     ---------
     Here is an example of using brainflow for reading cyton_daisy board data
@@ -87,20 +118,33 @@ class BrainFlowStreaming(RealtimeDataDevice):
                  brain_flow_input_params: BrainFlowInputParams,
                  saving_mode: int=SavingModeEnum.CONTINIOUS_SAVING_MODE,
                  name: Optional[str] = None,
-                 output_path: str = "output"):
+                 output_path: str = "output",
+                 trigger_mode: int=TriggerModeEnum.STRING_TRIGGER_MODE):
         super().__init__(name=name, output_path=output_path)
 
         self._saving_mode = saving_mode
-        self._stream_data: List[float] = []
+        self._trigger_mode = trigger_mode
+        # Trigger -> marker code, in MARKER_TRIGGER_MODE
+        self._marker_codes: Dict[str, int] = {}
+        # Marker code -> trigger. It is read by the realtime data thread, so the message
+        # thread replaces it with a new dictionary instead of changing it.
+        self._marker_triggers: Dict[int, str] = {}
         self.sampling_rate = sampling_rate
+        self._stream_data = \
+            RingBuffer(BoardShim.get_num_rows(device_id),
+                       sampling_rate * REALTIME_BUFFER_DURATION)
 
         self._board = None
         self._device_id = device_id
         self._brain_flow_input_params = brain_flow_input_params
+        self._timestamp_channel = BoardShim.get_timestamp_channel(device_id)
         self._terminate = False
-        self._trigger = None
+        # The trigger and the time it is received
+        self._trigger: Optional[Tuple[str, float]] = None
         self._experiment_id = None
         self.__loop_thread: Optional[threading.Thread] = None
+        self._writer: Optional[BackgroundWriter] = None
+        self._handled_messages = multiprocessing.Value('Q', 0)
 
         self.output_path = os.path.join(self.output_path, self.name)
         os.makedirs(self.output_path, exist_ok=True)
@@ -114,9 +158,10 @@ class BrainFlowStreaming(RealtimeDataDevice):
         self.__loop_thread = threading.Thread(target=self._stream_loop)
         self.__loop_thread.start()
 
-        while True:
-            message = self.message_queue.get()
+        self._writer = BackgroundWriter("{0} writer".format(self.name))
+        self._writer.start()
 
+        for message in self._receive_messages(self._writer):
             if not self.__loop_thread.is_alive():
                 print("Brainflow streaming: The streaming thread is dead. Terminating.")
                 break
@@ -145,7 +190,6 @@ class BrainFlowStreaming(RealtimeDataDevice):
                                                         self._experiment_id,
                                                         message.stimulus_id)
                         self._save_to_file(file_name)
-                        self._stream_data = []
                     else:
                         self._experiment_id = message.experiment_id
                         self.__set_trigger(message)
@@ -158,7 +202,6 @@ class BrainFlowStreaming(RealtimeDataDevice):
                                                  self.name,
                                                  self._experiment_id)
                     self._save_to_file(file_name)
-                    self._stream_data = []
             elif message.type == MessageType.TERMINATE:
                 self._terminate = True
                 if self._saving_mode == SavingModeEnum.CONTINIOUS_SAVING_MODE:
@@ -169,6 +212,8 @@ class BrainFlowStreaming(RealtimeDataDevice):
                     self._save_to_file(file_name)
                 break
 
+        self._writer.submit(self._acknowledge_message)
+        self._writer.stop()
         self._board.stop_stream()
         self._board.release_session()
         self.__loop_thread.join()
@@ -179,22 +224,24 @@ class BrainFlowStreaming(RealtimeDataDevice):
             if self._terminate is True:
                 break
 
+            # A 2D array of channels * samples
             data = self._board.get_board_data()
+            if data.shape[1] == 0:
+                time.sleep(POLL_INTERVAL)
+                continue
 
-            if np.array(data).shape[1] != 0:
-                self._stream_data.extend(list(np.transpose(data)))
-                last_record = self._stream_data.pop()
-                last_record = list(last_record)
-                now = str(datetime.now().time())
-                last_record.append(now)
-                last_record.append(time.time())
-                if self._trigger is not None:
-                    last_record.append(self._trigger)
-                    self._trigger = None
-                self._stream_data.append(last_record)
-            else:
-                time.sleep(0.1)
-            #    print("brainflow: didn't read any data")
+            timestamps = data[self._timestamp_channel]
+            triggers = None
+            trigger = self._trigger
+            # If the trigger is received after these samples (and the next sample can be
+            # nearer to it), it's kept for the next block.
+            if trigger is not None and \
+                    trigger[1] <= timestamps[-1] + 0.5 / self.sampling_rate:
+                self._trigger = None
+                triggers = {_nearest_sample(timestamps, trigger[1]): trigger[0]}
+            self._stream_data.extend(data.T, timestamps, triggers)
+            # Samples are collected in BrainFlow's buffer meanwhile, and are read in one block
+            time.sleep(POLL_INTERVAL)
 
     def __set_trigger(self, message):
         '''
@@ -205,18 +252,42 @@ class BrainFlowStreaming(RealtimeDataDevice):
         message: Message
             a message object
         '''
-        self._trigger = \
-            "{0}-{1}-{2}".format(message.type,
-                                 message.experiment_id,
-                                 str(message.stimulus_id).zfill(2))
+        trigger = "{0}-{1}-{2}".format(message.type,
+                                       message.experiment_id,
+                                       str(message.stimulus_id).zfill(2))
+        if self._trigger_mode == TriggerModeEnum.MARKER_TRIGGER_MODE:
+            # Zero means no marker in BrainFlow
+            code = self._marker_codes.get(trigger)
+            if code is None:
+                code = len(self._marker_codes) + 1
+                self._marker_codes[trigger] = code
+                self._marker_triggers = {**self._marker_triggers, code: trigger}
+            self._board.insert_marker(code)
+        else:
+            self._trigger = (trigger, time.time())
 
     def _save_to_file(self, file_name):
+        # Hands over the unsaved data to the writer thread, and returns immediately
+        assert self._writer is not None
+        self._writer.submit_unsaved(self._stream_data, self._write_to_file, file_name)
+        if self._trigger_mode == TriggerModeEnum.MARKER_TRIGGER_MODE:
+            self._writer.submit(self._write_marker_codes,
+                                "{0}-markers.csv".format(file_name[:-4]),
+                                dict(self._marker_codes))
+
+    def _write_marker_codes(self, file_name: str, marker_codes: Dict[str, int]) -> None:
+        '''Writes the lookup table of the marker codes'''
+        with open(file_name, 'w') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(["code", "trigger"])
+            writer.writerows((code, trigger) for trigger, code in marker_codes.items())
+
+    def _write_to_file(self, file_name, data, timestamps, triggers):
         print("Saving {0} to file {1}".format(self._name, file_name))
         with open(file_name, 'a') as csv_file:
             writer = csv.writer(csv_file)
-            for row in self._stream_data:
-                writer.writerow(row)
-                csv_file.flush()
+            writer.writerows(iter_rows(data, timestamps, triggers, self._format_timestamp))
+            csv_file.flush()
         print("Saving {0} to file {1} is done".format(self._name, file_name))
 
     def get_channels(self):
@@ -232,7 +303,8 @@ class BrainFlowStreaming(RealtimeDataDevice):
         '''
         raise NotImplementedError()
 
-    def _get_realtime_data(self, duration: int) -> Dict[str, Any]:
+    def _get_realtime_data(self, duration: int,
+                           since: Optional[int] = None) -> Dict[str, Any]:
         '''
         Returns n seconds (duration) of latest collected data for monitoring/visualizing or
         realtime processing purposes.
@@ -242,21 +314,43 @@ class BrainFlowStreaming(RealtimeDataDevice):
         duration: int
             A time duration in seconds for getting the latest recorded data in realtime
 
+        since: int, default: None
+            If it is given, only the records with a sequence number greater than or equal to
+            it are returned. It is usually the `cursor` of the previous call.
+
         Returns
         -------
         data: Dict[str, Any]
-            The keys are `data` and `metadata`.
-            `data` is a list of records, or empty list if there's nothing.
+            The keys are `data`, `timestamps`, `triggers` and `metadata`.
+            `data` is a 2D array of records (records * channels).
+            `timestamps` is an array of records' time.
+            `triggers` is a dictionary of record's index to its trigger.
+            `sequence` is the sequence number of the first record, and `cursor` is the
+            sequence number of the next record.
             `metadata` is a dictionary of device metadata including `sampling_rate` and `channels` and `type`
 
         '''
         # Last seconds of data
-
-        data = self._stream_data[-1 * duration * self.sampling_rate:]
+        data, timestamps, triggers, sequence = \
+            self._stream_data.get_since(since or 0, duration * self.sampling_rate)
         metadata = {"sampling_rate": self.sampling_rate,
                     "channels": self.get_channels(),
                     "type": self.__class__.__name__}
+        if self._trigger_mode == TriggerModeEnum.MARKER_TRIGGER_MODE:
+            metadata["marker_channel"] = BoardShim.get_marker_channel(self._device_id)
+            metadata["markers"] = dict(self._marker_triggers)
 
         realtime_data = {"data": data,
-                  "metadata": metadata}
+                         "timestamps": timestamps,
+                         "triggers": triggers,
+                         "sequence": sequence,
+                         "cursor": sequence + len(data),
+                         "metadata": metadata}
         return realtime_data
+
+    @staticmethod
+    def _format_timestamp(timestamp: float) -> List[Any]:
+        '''Records without a time don't have the time columns in the file'''
+        if np.isnan(timestamp):
+            return []
+        return [str(datetime.fromtimestamp(timestamp).time()), timestamp]
@@ -12,15 +12,443 @@
 # You should have received a copy of the GNU General Public License along with Octopus Sensing.
 # If not, see <https://www.gnu.org/licenses/>.
 
-from typing import Tuple, Any, Dict, Optional, Union
+from typing import Tuple, Any, Dict, Iterator, List, Optional, Union
 import os
+import sys
+import csv
+import queue
 import threading
+import traceback
+import collections
+import multiprocessing
 import cv2
 import time
 
 from octopus_sensing.devices.realtime_data_device import RealtimeDataDevice
+from octopus_sensing.devices.background_writer import BackgroundWriter
+from octopus_sensing.devices.common import FrameDropPolicyEnum, VideoSavingModeEnum
 from octopus_sensing.common.message_creators import MessageType
 
+# Used until there are enough captured frames to measure the frame rate
+DEFAULT_FRAME_RATE = 30.0
+# The frame rate is an exponentially weighted moving average over about this many frames
+FRAME_RATE_WINDOW = 30
+# Frames per second that are kept for realtime data, and for how many seconds
+REALTIME_FRAME_RATE = 5
+REALTIME_DURATION = 5
+# Default JPEG quality of realtime frames
+REALTIME_JPEG_QUALITY = 80
+_IMAGE_EXTENSIONS = {"jpeg": ".jpg", "png": ".png"}
+
+
+class FrameRateEstimator:
+    '''
+    Measures the frame rate from the capture time of frames. It's an exponentially
+    weighted moving average of the time between frames, over about FRAME_RATE_WINDOW frames,
+    and is updated in O(1) for each frame.
+    '''
+
+    def __init__(self):
+        self._smoothing = 2 / (FRAME_RATE_WINDOW + 1)
+        self._last_capture_time: Optional[float] = None
+        # Moving average of the time between frames
+        self._frame_interval: Optional[float] = None
+
+    def update(self, capture_time: float) -> None:
+        '''Adds the capture time of a new frame'''
+        last_capture_time = self._last_capture_time
+        if last_capture_time is not None and capture_time > last_capture_time:
+            interval = capture_time - last_capture_time
+            if self._frame_interval is None:
+                self._frame_interval = interval
+            else:
+                self._frame_interval += self._smoothing * (interval - self._frame_interval)
+        self._last_capture_time = capture_time
+
+    @property
+    def frame_rate(self) -> float:
+        '''The measured frame rate, or DEFAULT_FRAME_RATE if there aren't enough frames'''
+        frame_interval = self._frame_interval
+        if frame_interval is None:
+            return DEFAULT_FRAME_RATE
+        return 1 / frame_interval
+
+
+class RealtimeFrames:
+    '''
+    The latest frames of a camera for realtime data, REALTIME_FRAME_RATE frames per second
+    for REALTIME_DURATION seconds. Frames are added by the capture thread, and read by the
+    realtime data thread.
+
+    Frames can be read as they are, or resized and encoded as images (see
+    `RealtimeDataEndpoint` for the options). Encoded frames are cached by their frame
+    index, so polling the same frames doesn't encode them again.
+    '''
+
+    def __init__(self):
+        # (frame index, capture time, frame)
+        self._frames: collections.deque = \
+            collections.deque(maxlen=REALTIME_FRAME_RATE * REALTIME_DURATION)
+        self._lock = threading.Lock()
+        self._last_time = 0.0
+        # (frame index, width, format, quality) -> encoded frame. It is only used
+        # in the realtime data thread.
+        self._encoded_frames: Dict[Tuple[int, Optional[int], str, int], bytes] = {}
+
+    def append(self, frame_index: int, capture_time: float, frame: Any) -> None:
+        '''Keeps the frame, if enough time is passed since the previous kept frame'''
+        if capture_time - self._last_time < 1 / REALTIME_FRAME_RATE:
+            return
+        with self._lock:
+            self._frames.append((frame_index, capture_time, frame))
+        self._last_time = capture_time
+
+    def get(self, duration: int, options: Dict[str, Any]) \
+            -> Tuple[List[int], List[Any], Optional[str]]:
+        '''
+        Returns frames of the last `duration` seconds, from the oldest to the latest.
+        `fps` option is the number of frames per second (default is 1). If any of
+        `width`, `format` or `quality` options are given, frames are encoded as images.
+
+        Returns
+        -------
+        frame_indexes, frames, image_format: Tuple[List[int], List[Any], Optional[str]]
+            Index of each frame, the frames (or encoded images as `bytes`), and the
+            format of images (None if frames are not encoded)
+        '''
+        with self._lock:
+            frames = list(self._frames)
+
+        fps = min(options.get("fps", 1), REALTIME_FRAME_RATE)
+        selected_frames: List[Tuple[int, Any]] = []
+        next_time = None
+        for frame_index, capture_time, frame in reversed(frames):
+            if len(selected_frames) >= max(duration * fps, 1):
+                break
+            # Half a realtime frame of tolerance
+            if next_time is None or capture_time <= next_time + 0.5 / REALTIME_FRAME_RATE:
+                selected_frames.append((frame_index, frame))
+                next_time = capture_time - 1 / fps
+        selected_frames.reverse()
+        frame_indexes = [frame_index for frame_index, _ in selected_frames]
+
+        if not {"width", "format", "quality"}.intersection(options):
+            return frame_indexes, [frame for _, frame in selected_frames], None
+
+        image_format = options.get("format", "jpeg")
+        # Only the frames that are still in the buffer are kept in the cache
+        if len(frames) > 0:
+            oldest_index = frames[0][0]
+            for key in [key for key in self._encoded_frames if key[0] < oldest_index]:
+                del self._encoded_frames[key]
+        return (frame_indexes,
+                [self._encode_frame(frame_index, frame, options.get("width"), image_format,
+                                    options.get("quality", REALTIME_JPEG_QUALITY))
+                 for frame_index, frame in selected_frames],
+                image_format)
+
+    def _encode_frame(self, frame_index: int, frame: Any, width: Optional[int],
+                      image_format: str, quality: int) -> bytes:
+        '''Resizes the frame to the width (if it's smaller) and encodes it as an image'''
+        key = (frame_index, width, image_format, quality)
+        encoded = self._encoded_frames.get(key)
+        if encoded is not None:
+            return encoded
+
+        height, original_width = frame.shape[:2]
+        if width is not None and width < original_width:
+            frame = cv2.resize(frame, (width, max(round(height * width / original_width), 1)),
+                               interpolation=cv2.INTER_AREA)
+        parameters = [cv2.IMWRITE_JPEG_QUALITY, quality] if image_format == "jpeg" else []
+        succeeded, buffer = cv2.imencode(_IMAGE_EXTENSIONS[image_format], frame, parameters)
+        if not succeeded:
+            raise RuntimeError("Could not encode the frame as {0}".format(image_format))
+        encoded = buffer.tobytes()
+        self._encoded_frames[key] = encoded
+        return encoded
+
+
+def _last_rows(row: List[Any], columns: int, stop_trigger: Optional[str]) -> List[List[Any]]:
+    '''
+    Adds the stop trigger to the timestamps row of the last frame. `columns` is the number
+    of columns before the trigger. If the row already has the start trigger (only one frame
+    is recorded), the stop trigger gets another row of the same frame.
+    '''
+    if stop_trigger is None:
+        return [row]
+    if len(row) == columns:
+        return [row + [stop_trigger]]
+    return [row, row[:columns] + [stop_trigger]]
+
+
+class _QueuedFrameWriter:
+    '''
+    Base class of the recorders. Captured frames are passed to encoder threads through a
+    bounded queue, so a slow encoder (or disk) makes frames drop (according to the drop
+    policy) instead of filling the memory.
+
+    Parameters
+    ----------
+    name: str
+        Name of the device, for logs and the threads' names
+
+    file_name: str
+        The file (or directory) that frames are written to
+
+    queue_size: int
+        Maximum number of frames that wait for the encoders
+
+    drop_policy: int
+        One of FrameDropPolicyEnum
+
+    start_trigger: str
+        The trigger of the first frame, or None
+
+    encoder_count: int, default: 1
+        Number of encoder threads
+    '''
+
+    def __init__(self, name: str, file_name: str, queue_size: int, drop_policy: int,
+                 start_trigger: Optional[str], encoder_count: int = 1):
+        self.file_name = file_name
+        self.captured_frames = 0
+        self.dropped_frames = 0
+        self.written_frames = 0
+        self._name = name
+        self._drop_policy = drop_policy
+        self._start_trigger = start_trigger
+        self._stop_trigger: Optional[str] = None
+        # Each item is (index of the frame in the recording, frame, capture time)
+        self._frames: queue.Queue = queue.Queue(maxsize=queue_size)
+        # Stops adding frames after the end of the recording is queued
+        self._lock = threading.Lock()
+        self._closed = False
+        self._encoder_threads = [threading.Thread(target=self._run_encoder,
+                                                  name="{0} encoder thread {1}".format(name, i),
+                                                  daemon=True)
+                                 for i in range(encoder_count)]
+        for encoder_thread in self._encoder_threads:
+            encoder_thread.start()
+
+    def submit(self, frame: Any, capture_time: float) -> None:
+        '''Queues a captured frame to be written'''
+        with self._lock:
+            if self._closed:
+                return
+            item = (self.captured_frames, frame, capture_time)
+            self.captured_frames += 1
+            if self._drop_policy == FrameDropPolicyEnum.BLOCK_POLICY:
+                self._frames.put(item)
+                return
+            while True:
+                try:
+                    self._frames.put_nowait(item)
+                    return
+                except queue.Full:
+                    self.dropped_frames += 1
+                    if self._drop_policy == FrameDropPolicyEnum.DROP_NEWEST_POLICY:
+                        return
+                try:
+                    self._frames.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def finish(self, stop_trigger: Optional[str] = None) -> None:
+        '''
+        Ends the recording. The queued frames are still written.
+
+        Parameters
+        ----------
+        stop_trigger: str, default: None
+            The trigger of the last frame
+        '''
+        with self._lock:
+            self._closed = True
+            self._stop_trigger = stop_trigger
+        self._frames.put(None)
+
+    def join(self) -> None:
+        '''Waits until all frames are written and the files are closed'''
+        for encoder_thread in self._encoder_threads:
+            encoder_thread.join()
+        self._finish_writing()
+        print("[{0}] Saving to file {1} is done. Captured {2} frames, dropped {3}.".format(
+            self._name, self.file_name, self.captured_frames, self.dropped_frames))
+
+    def _next_frames(self) -> Iterator[Tuple[int, Any, float]]:
+        '''Yields the queued frames, until the end of the recording'''
+        while True:
+            item = self._frames.get()
+            if item is None:
+                # For the other encoder threads
+                self._frames.put(None)
+                return
+            yield item
+
+    def _run_encoder(self) -> None:
+        try:
+            self._encode_loop()
+        except Exception:
+            print(f"[{self._name}] Error while recording video:", file=sys.stderr)
+            traceback.print_exc()
+            # Discarding the rest, so the capture thread is not blocked (in BLOCK_POLICY)
+            for _ in self._next_frames():
+                pass
+
+    def _encode_loop(self) -> None:
+        '''Writes the frames of `_next_frames`. It runs in each encoder thread.'''
+        raise NotImplementedError()
+
+    def _finish_writing(self) -> None:
+        '''Called after all encoder threads are finished'''
+        pass
+
+
+class FrameRecorder(_QueuedFrameWriter):
+    '''
+    Writes the frames of one recording to a video file, in its own encoder thread.
+    Frames are passed to the encoder through a bounded queue, so a slow encoder (or disk)
+    makes frames drop (according to the drop policy) instead of filling the memory.
+
+    The capture time of each written frame is saved in {file name}-timestamps.csv, with
+    `frame, timestamp, trigger` columns. `frame` is the index of the frame in the video
+    file, and the start and stop triggers are recorded with the first and the last frames.
+    If only one frame is written, the stop trigger is recorded in another row of it.
+
+    Parameters
+    ----------
+    name: str
+        Name of the device, for logs and the thread's name
+
+    file_name: str
+        The video file
+
+    video_size: Tuple[int, int]
+        Width and height of frames
+
+    frame_rate: float
+        The frame rate of the video file
+
+    queue_size: int
+        Maximum number of frames that wait for the encoder
+
+    drop_policy: int
+        One of FrameDropPolicyEnum
+
+    start_trigger: str, default: None
+        The trigger of the first frame
+    '''
+
+    def __init__(self, name: str, file_name: str, video_size: Tuple[int, int],
+                 frame_rate: float, queue_size: int, drop_policy: int,
+                 start_trigger: Optional[str] = None):
+        self.timestamps_file_name = "{0}-timestamps.csv".format(file_name[:-4])
+        # Capture time of the written frames, by their index in the video
+        self.written_capture_times: List[float] = []
+        self._video_size = video_size
+        self._frame_rate = frame_rate
+        super().__init__(name, file_name, queue_size, drop_policy, start_trigger)
+
+    def _encode_loop(self) -> None:
+        print(f"[{self._name}] Recording frame per second", self._frame_rate)
+        # It does have a VideWriter_fourcc method, but mypy can't tell.
+        codec = cv2.VideoWriter_fourcc(*'XVID') # type: ignore[attr-defined]
+        writer = cv2.VideoWriter(self.file_name, codec, self._frame_rate, self._video_size)
+        try:
+            with open(self.timestamps_file_name, 'w') as timestamps_file:
+                timestamps_writer = csv.writer(timestamps_file)
+                timestamps_writer.writerow(["frame", "timestamp", "trigger"])
+                # A row is written when the next frame comes, so the stop trigger can
+                # be added to the last one.
+                row: Optional[List[Any]] = None
+                for _, frame, capture_time in self._next_frames():
+                    writer.write(frame)
+                    if row is not None:
+                        timestamps_writer.writerow(row)
+                    row = [self.written_frames, capture_time]
+                    self.written_capture_times.append(capture_time)
+                    if self.written_frames == 0 and self._start_trigger is not None:
+                        row.append(self._start_trigger)
+                    self.written_frames += 1
+
+                if row is not None:
+                    timestamps_writer.writerows(_last_rows(row, 2, self._stop_trigger))
+        finally:
+            writer.release()
+
+
+class ImageSequenceRecorder(_QueuedFrameWriter):
+    '''
+    Writes the frames of one recording as JPEG images, with several encoder threads
+    (OpenCV releases the GIL while encoding). Frames are passed to the encoders through a
+    bounded queue, the same as FrameRecorder.
+
+    Images are named by the index of the frame in the recording, e.g. `000042.jpg`.
+    Dropped frames leave a gap in the indexes. The capture time of each written frame is
+    saved in {directory}-timestamps.csv, with `frame, timestamp, trigger` columns, and the
+    start and stop triggers are recorded with the first and the last frames (in two rows
+    if only one frame is written).
+
+    Parameters
+    ----------
+    name: str
+        Name of the device, for logs and the threads' names
+
+    directory: str
+        The directory of images. It is created if it doesn't exist.
+
+    queue_size: int
+        Maximum number of frames that wait for the encoders
+
+    drop_policy: int
+        One of FrameDropPolicyEnum
+
+    encoder_count: int
+        Number of encoder threads
+
+    jpeg_quality: int
+        JPEG quality of images, from 0 to 100
+
+    start_trigger: str, default: None
+        The trigger of the first frame
+    '''
+
+    def __init__(self, name: str, directory: str, queue_size: int, drop_policy: int,
+                 encoder_count: int, jpeg_quality: int, start_trigger: Optional[str] = None):
+        self.timestamps_file_name = "{0}-timestamps.csv".format(directory)
+        os.makedirs(directory, exist_ok=True)
+        self._parameters = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+        # (frame index, capture time) of the written images
+        self._written: List[Tuple[int, float]] = []
+        self._written_lock = threading.Lock()
+        super().__init__(name, directory, queue_size, drop_policy, start_trigger,
+                         encoder_count=encoder_count)
+
+    def _encode_loop(self) -> None:
+        for frame_index, frame, capture_time in self._next_frames():
+            image_file_name = os.path.join(self.file_name, "{0:06d}.jpg".format(frame_index))
+            if not cv2.imwrite(image_file_name, frame, self._parameters):
+                print(f"[{self._name}] Could not write {image_file_name}", file=sys.stderr)
+                continue
+            with self._written_lock:
+                self._written.append((frame_index, capture_time))
+                self.written_frames += 1
+
+    def _finish_writing(self) -> None:
+        written = sorted(self._written)
+        with open(self.timestamps_file_name, 'w') as timestamps_file:
+            timestamps_writer = csv.writer(timestamps_file)
+            timestamps_writer.writerow(["frame", "timestamp", "trigger"])
+            for i, (frame_index, capture_time) in enumerate(written):
+                row: List[Any] = [frame_index, capture_time]
+                if i == 0 and self._start_trigger is not None:
+                    row.append(self._start_trigger)
+                if i == len(written) - 1:
+                    timestamps_writer.writerows(_last_rows(row, 2, self._stop_trigger))
+                else:
+                    timestamps_writer.writerow(row)
+
+
 class CameraStreaming(RealtimeDataDevice):
     '''
     Stream and Record video data.
@@ -28,6 +456,13 @@ class CameraStreaming(RealtimeDataDevice):
     Device coordinator is responsible for triggerng the camera to start or stop recording.
     The content of recorded file is the recorded video between start and stop triggers
 
+    Frames are captured continuously in a capture thread. During a recording, they are
+    passed through a bounded queue to an encoder thread that writes them to the video file
+    as they arrive, so memory usage doesn't grow with the length of the recording. If the
+    encoder can't keep up, frames are dropped according to `drop_policy`, and the number
+    of dropped frames is logged at the end of the recording. Realtime data is read from a
+    small buffer of the latest frames.
+
     Attributes
     ----------
 
@@ -54,6 +489,30 @@ class CameraStreaming(RealtimeDataDevice):
     image_height: int, default: 720
         The height of recorded frame/frames.
 
+    frame_queue_size: int, default: 64
+        Maximum number of captured frames that wait to be written to the file
+
+    drop_policy: int, default: FrameDropPolicyEnum.DROP_NEWEST_POLICY
+        What to do with a new frame when the queue of frames is full.
+        FrameDropPolicyEnum is:
+
+            0. DROP_NEWEST_POLICY
+            1. DROP_OLDEST_POLICY
+            2. BLOCK_POLICY
+
+    video_saving_mode: int, default: VideoSavingModeEnum.VIDEO_FILE_SAVING_MODE
+        How recordings are saved.
+        VideoSavingModeEnum is:
+
+            0. VIDEO_FILE_SAVING_MODE
+            1. IMAGE_SEQUENCE_SAVING_MODE
+
+    image_encoder_threads: int, default: 4
+        Number of threads that encode images in IMAGE_SEQUENCE_SAVING_MODE
+
+    jpeg_quality: int, default: 95
+        JPEG quality of images in IMAGE_SEQUENCE_SAVING_MODE, from 0 to 100
+
 
     Notes
     -----
@@ -63,6 +522,17 @@ class CameraStreaming(RealtimeDataDevice):
       Because camera may not be able to support these resolution and it will change it
       based on its settings
 
+    - The frame rate of recorded videos is measured from the capture time of frames.
+
+    - The capture time of each recorded frame is saved next to the video file, in
+      {file name}-timestamps.csv. Its `frame` column is the index of the frame in the
+      video, and START and STOP triggers are recorded in its `trigger` column.
+
+    - In IMAGE_SEQUENCE_SAVING_MODE, each recording is a directory of JPEG images instead
+      of a video file, e.g. {output_path}/{name}/{name}-{experiment_id}-{stimulus_id}/.
+      Images are named by the index of the frame in the recording (`000042.jpg`), and
+      {directory}-timestamps.csv has the capture time of each image.
+
 
     Example
     -----------
@@ -85,6 +555,11 @@ class CameraStreaming(RealtimeDataDevice):
                  camera_path: Optional[str] = None,
                  image_width: int = 1280,
                  image_height: int = 720,
+                 frame_queue_size: int = 64,
+                 drop_policy: int = FrameDropPolicyEnum.DROP_NEWEST_POLICY,
+                 video_saving_mode: int = VideoSavingModeEnum.VIDEO_FILE_SAVING_MODE,
+                 image_encoder_threads: int = 4,
+                 jpeg_quality: int = 95,
                  **kwargs):
         assert (camera_no is not None) ^ (camera_path is not None), \
             "Only one of camera_no or camera_path should have value"
@@ -98,13 +573,21 @@ class CameraStreaming(RealtimeDataDevice):
 
         self._image_width = image_width
         self._image_height = image_height
+        self._frame_queue_size = frame_queue_size
+        self._drop_policy = drop_policy
+        self._video_saving_mode = video_saving_mode
+        self._image_encoder_threads = image_encoder_threads
+        self._jpeg_quality = jpeg_quality
         self._video_size: Tuple[int, int] = (self._image_width, self._image_height)
         self._video_capture: Any = None
-        self._fps: int = 30
-        self._capture_times: list = []
-        self._frames: list = []
-        self._counter = 0
+        self._frame_rate = FrameRateEstimator()
+        self._realtime_frames = RealtimeFrames()
+        # The recording that captured frames are passed to, if any
+        self._recorder: Optional[_QueuedFrameWriter] = None
+        self._last_recorder: Optional[_QueuedFrameWriter] = None
+        self._terminate = False
         self._state = ""
+        self._handled_messages = multiprocessing.Value('Q', 0)
 
     def _run(self):
         self._video_capture = cv2.VideoCapture(self._camera_number)
@@ -127,13 +610,15 @@ class CameraStreaming(RealtimeDataDevice):
             self._video_capture.release()
             raise RuntimeError(f"[{self.name}] Couldn't read the video size from the camera.")
 
-        recording_thread = None
-        recording_event = None
-
         print(f"[{self.name}] Initialized video device: video size: {self._video_size}")
 
-        while True:
-            message = self.message_queue.get()
+        capture_thread = threading.Thread(target=self._stream_loop,
+                                          name=self.name + " capture thread", daemon=True)
+        capture_thread.start()
+        writer = BackgroundWriter("{0} writer".format(self.name))
+        writer.start()
+
+        for message in self._receive_messages(writer):
             if message is None:
                 continue
             if message.type == MessageType.START:
@@ -141,94 +626,91 @@ class CameraStreaming(RealtimeDataDevice):
                 if self._state == "START":
                     print("Video streaming has already started")
                 else:
-                    self._frames = []
-                    self._capture_times = []
-                    if recording_thread is not None:
-                        raise RuntimeError(
-                            ("[{0} device] Received two start messages. "
-                            "A STOP message should be send before trying "
-                            "to start a new video recording.".format(self.name)))
-
                     file_name = "{0}/{1}-{2}-{3}.avi".format(self.output_path,
                                                             self.name,
                                                             message.experiment_id,
                                                             str(message.stimulus_id).zfill(2))
-                    print(f"[{self.name}] Starting the recording thread")
-                    recording_event = threading.Event()
-                    recording_event.set()
-                    recording_thread = threading.Thread(
-                        target=self._stream_loop, args=(file_name, recording_event), daemon=True)
-                    recording_thread.start()
+                    print(f"[{self.name}] Starting the recording")
+                    self._recorder = self._create_recorder(file_name,
+                                                           self._get_trigger(message))
+                    self._last_recorder = self._recorder
                     self._state = "START"
 
             elif message.type == MessageType.STOP:
                 if self._state == "STOP":
                     print(f"[{self.name}] Video streaming has already stopped")
                 else:
-                    if recording_event is not None:
-                        recording_event.clear()
-                    recording_thread = None
-                    recording_event = None
+                    self._stop_recording(writer, self._get_trigger(message))
                     self._state = "STOP"
 
             elif message.type == MessageType.TERMINATE:
-                if recording_event is not None:
-                    recording_event.clear()
-                recording_thread = None
-                recording_event = None
+                self._stop_recording(writer)
                 break
 
+        writer.submit(self._acknowledge_message)
+        writer.stop()
+        self._terminate = True
+        capture_thread.join()
         print(f"[{self.name}] video terminated")
         self._video_capture.release()
 
-    def _stream_loop(self, file_name: str, event: threading.Event):
+    def _create_recorder(self, file_name: str, start_trigger: str) -> _QueuedFrameWriter:
+        if self._video_saving_mode == VideoSavingModeEnum.IMAGE_SEQUENCE_SAVING_MODE:
+            return ImageSequenceRecorder(self.name, file_name[:-4],
+                                         self._frame_queue_size,
+                                         self._drop_policy,
+                                         self._image_encoder_threads,
+                                         self._jpeg_quality,
+                                         start_trigger=start_trigger)
+        return FrameRecorder(self.name, file_name, self._video_size,
+                             self._get_frame_rate(),
+                             self._frame_queue_size,
+                             self._drop_policy,
+                             start_trigger=start_trigger)
+
+    def _stop_recording(self, writer: BackgroundWriter,
+                        stop_trigger: Optional[str] = None) -> None:
+        recorder = self._recorder
+        if recorder is None:
+            return
+        self._recorder = None
+        recorder.finish(stop_trigger)
+        # The file is closed in the writer thread. `_receive_messages` acknowledges the
+        # message in the same thread, so it happens after this.
+        writer.submit(recorder.join)
+
+    @staticmethod
+    def _get_trigger(message) -> str:
+        return "{0}-{1}-{2}".format(message.type,
+                                    message.experiment_id,
+                                    str(message.stimulus_id).zfill(2))
+
+    def _stream_loop(self) -> None:
+        '''Captures frames, until the device terminates'''
         print(f"[{self.name}] Start stream camera")
-        # It does have a VideWriter_fourcc method, but mypy can't tell.
-        codec = cv2.VideoWriter_fourcc(*'XVID') # type: ignore[attr-defined]
-        try:
-            while self._video_capture.isOpened:
-                if event.is_set():
-                    ret, frame = self._video_capture.read()
-                    if ret:
-                        self._counter += 1
-                        self._capture_times.append(time.time())
-                        self._frames.append(frame)
-                else:
-                    fps = self._get_frame_rate()
-                    print(f"[{self.name}] Recording frame per second", fps)
-                    writer = cv2.VideoWriter(file_name,
-                            codec,
-                            fps,
-                            self._video_size)
-                    for frame in self._frames:
-                        writer.write(frame)
-                    writer.release()
-                    print("Saving to file {0} is done".format(file_name))
-                    break
-
-        except Exception as error:
-            print(f"[{self.name}] Error while recording video:")
-            print(error)
-
-    def _stream_loop_image(self, file_name: str, event: threading.Event):
+        frame_index = -1
         try:
-            while self._video_capture.isOpened:
-                if event.is_set():
-                    ret, frame = self._video_capture.read()
-                    if ret:
-                        a = time.time()
-                        os.makedirs(file_name[:-4], exist_ok=True)
-                        image_file_name = file_name[:-4] + "/" + str(a) + ".jpg"
-                        print(image_file_name)
-                        cv2.imwrite(image_file_name, frame)
-                else:
-                    break
-
-        except Exception as error:
-            print(f"[{self.name}] Error while recording video.")
-            print(error)
-
-    def _get_realtime_data(self, duration: int) -> Dict[str, Any]:
+            while not self._terminate and self._video_capture.isOpened():
+                ret, frame = self._video_capture.read()
+                capture_time = time.time()
+                if not ret:
+                    # Not spinning on a camera that is not ready (or a finished video file)
+                    time.sleep(0.01)
+                    continue
+                frame_index += 1
+                self._frame_rate.update(capture_time)
+                self._realtime_frames.append(frame_index, capture_time, frame)
+
+                recorder = self._recorder
+                if recorder is not None:
+                    recorder.submit(frame, capture_time)
+
+        except Exception:
+            print(f"[{self.name}] Error while capturing video:", file=sys.stderr)
+            traceback.print_exc()
+
+    def _get_realtime_data(self, duration: int,
+                           since: Optional[int] = None) -> Dict[str, Any]:
         '''
         Returns n seconds (duration) of latest collected data for monitoring/visualizing or
         realtime processing purposes.
@@ -236,41 +718,45 @@ class CameraStreaming(RealtimeDataDevice):
         Parameters
         ----------
         duration: int
-            A time duration in seconds for getting the latest recorded data in realtime
+            A time duration in seconds for getting the latest recorded data in realtime.
+            At most REALTIME_DURATION seconds of frames are kept.
+
+        since: int, default: None
+            Not supported by this device. The records don't have sequence numbers, so
+            it is ignored.
 
         Returns
         -------
         data: Dict[str, Any]
             The keys are `data` and `metadata`.
-            `data` is a list of records, or empty list if there's nothing.
-            `metadata` is a dictionary of device metadata including `frame_rate` and `type`
+            `data` is a list of frames, one per second, from the oldest to the latest
+            captured frame, or empty list if there's nothing.
+            `metadata` is a dictionary of device metadata including `frame_rate`,
+            `dropped_frames` (in the current or last recording), `frame_indexes` (index
+            of each frame since the device started) and `type`
         '''
-        fps = self._get_frame_rate()
+        return self._get_realtime_data_with_options(duration, since, {})
 
-        data = self._frames[-1 * duration * fps:]
-        metadata = {"frame_rate": fps,
+    def _get_realtime_data_with_options(self, duration: int, since: Optional[int],
+                                        options: Dict[str, Any]) -> Dict[str, Any]:
+        '''
+        The same as `_get_realtime_data`, but `fps` option sets the number of frames per
+        second. If any of `width`, `format` or `quality` options are given, frames are
+        resized and encoded as images (`bytes`), and the `format` is added to the metadata.
+        Encoded frames are cached, so polling the same frames doesn't encode them again.
+        See `RealtimeDataEndpoint` for details of the options.
+        '''
+        frame_indexes, frames, image_format = self._realtime_frames.get(duration, options)
+        recorder = self._last_recorder
+        metadata = {"frame_rate": self._get_frame_rate(),
+                    "dropped_frames": recorder.dropped_frames if recorder is not None else 0,
+                    "frame_indexes": frame_indexes,
                     "type": self.__class__.__name__}
-
-        if len(data) == 0:
-            realtime_data = {"data": [],
-                             "metadata": metadata}
-        else:
-            one_frame_per_seconds = []
-            for i in range(duration):
-                if (i * fps) + 1 > len(data):
-                    break
-                one_frame_per_seconds.append(data[i * fps])
-
-            realtime_data = {"data": one_frame_per_seconds,
-                             "metadata": metadata}
-        return realtime_data
-
-    def _get_frame_rate(self):
-        time_diff = 1
-        i = 1
-        while time_diff < 5 and len(self._capture_times) > i:
-            time_diff = self._capture_times[-1] - self._capture_times[-(i+1)]
-            i += 1
-        fps = int(i/time_diff)
-
-        return fps
+        if image_format is not None:
+            metadata["format"] = image_format
+        return {"data": frames,
+                "metadata": metadata}
+
+    def _get_frame_rate(self) -> float:
+        '''The frame rate, measured from the capture time of the latest frames'''
+        return self._frame_rate.frame_rate
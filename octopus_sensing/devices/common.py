@@ -28,3 +28,40 @@ class SavingModeEnum():
     '''
     CONTINIOUS_SAVING_MODE = 0
     SEPARATED_SAVING_MODE = 1
+
+
+class TriggerModeEnum():
+    '''
+    The way devices record triggers. In STRING_TRIGGER_MODE, the trigger (e.g. START-exp1-01)
+    is written in a separate column next to the sample it belongs to. In MARKER_TRIGGER_MODE,
+    each trigger is mapped to a numeric code and the device writes the code into its own
+    marker channel. The codes and their triggers are saved in a lookup table next to the
+    recorded file.
+    Only the devices that have a marker channel support MARKER_TRIGGER_MODE.
+    '''
+    STRING_TRIGGER_MODE = 0
+    MARKER_TRIGGER_MODE = 1
+
+
+class FrameDropPolicyEnum():
+    '''
+    What a camera does with a new frame when its encoder can't keep up and the queue of
+    frames waiting to be written is full. In DROP_NEWEST_POLICY, the new frame is dropped.
+    In DROP_OLDEST_POLICY, the oldest frame in the queue is dropped to make room for the
+    new one. In BLOCK_POLICY, capturing waits until there is room, so frames are dropped
+    by the camera driver instead and the realtime data is delayed too.
+    '''
+    DROP_NEWEST_POLICY = 0
+    DROP_OLDEST_POLICY = 1
+    BLOCK_POLICY = 2
+
+
+class VideoSavingModeEnum():
+    '''
+    How a camera saves its recordings. In VIDEO_FILE_SAVING_MODE, the frames of each
+    recording are encoded in a video file. In IMAGE_SEQUENCE_SAVING_MODE, each frame is
+    saved as a JPEG image in a directory of the recording, which avoids the video codec's
+    inter-frame compression but takes more space.
+    '''
+    VIDEO_FILE_SAVING_MODE = 0
+    IMAGE_SEQUENCE_SAVING_MODE = 1
@@ -12,10 +12,12 @@
 # You should have received a copy of the GNU General Public License along with Octopus Sensing.
 # If not, see <https://www.gnu.org/licenses/>.
 
-from typing import Optional
+from typing import Any, Iterator, Optional
 import multiprocessing
 from multiprocessing.queues import Queue
 
+from octopus_sensing.devices.background_writer import BackgroundWriter
+
 
 class Device(multiprocessing.Process):
     '''
@@ -41,6 +43,9 @@ class Device(multiprocessing.Process):
         self.subject_id: Optional[str] = None
         self.stimulus_id: Optional[str] = None
         self.output_path: str = output_path
+        # Number of messages that are completely handled, including saving their data.
+        # Only devices that report it set this to a `multiprocessing.Value`.
+        self._handled_messages: Optional[Any] = None
 
     def run(self) -> None:
         '''
@@ -75,3 +80,41 @@ class Device(multiprocessing.Process):
             The name of device
         '''
         return self.name
+
+    def get_handled_message_count(self) -> Optional[int]:
+        '''
+        Gets number of messages that the device completely handled. A SAVE (or STOP)
+        message is counted after its data is written to the file.
+
+        Returns
+        --------
+        Optional[int]
+            Number of handled messages, or None if the device doesn't report it
+        '''
+        if self._handled_messages is None:
+            return None
+        return self._handled_messages.value
+
+    def _receive_messages(self, writer: Optional[BackgroundWriter] = None) -> Iterator[Any]:
+        '''
+        Yields messages of the message queue one by one. When the next message is
+        requested, the previous one is acknowledged. If a writer is given, the
+        acknowledgement goes through it, so it happens after the files are written.
+
+        Parameters
+        -----------
+        writer: BackgroundWriter, default: None
+            The thread that writes the device's data
+        '''
+        assert self.message_queue is not None
+        while True:
+            yield self.message_queue.get()
+            if writer is None:
+                self._acknowledge_message()
+            else:
+                writer.submit(self._acknowledge_message)
+
+    def _acknowledge_message(self) -> None:
+        if self._handled_messages is not None:
+            with self._handled_messages.get_lock():
+                self._handled_messages.value += 1
@@ -12,15 +12,28 @@
 # You should have received a copy of the GNU General Public License along with Octopus Sensing.
 # If not, see <https://www.gnu.org/licenses/>.
 
+import time
 import threading
+import multiprocessing
 import csv
 import os
-from typing import List, Optional, Any, Dict
-from pylsl import StreamInlet, resolve_byprop
+from typing import Optional, Any, Dict, Tuple
+
+import numpy as np
+from pylsl import StreamInlet, resolve_byprop, local_clock, cf_string
 
 from octopus_sensing.common.message_creators import MessageType
 from octopus_sensing.devices.realtime_data_device import RealtimeDataDevice
 from octopus_sensing.devices.common import SavingModeEnum
+from octopus_sensing.devices.background_writer import BackgroundWriter
+from octopus_sensing.devices.ring_buffer import RingBuffer, REALTIME_BUFFER_DURATION, iter_rows
+
+
+# In seconds. The stream is checked for new samples this often.
+PULL_INTERVAL = 0.01
+# In seconds. The time correction offset (of the stream's clock to the local clock) is
+# updated this often.
+TIME_CORRECTION_INTERVAL = 5.0
 
 
 class LslStreaming(RealtimeDataDevice):
@@ -61,6 +74,14 @@ class LslStreaming(RealtimeDataDevice):
     ...                             output_path="output")
     >>> device_coordinator.add_device(lsl_device)
 
+    Notes
+    -----
+    Samples are pulled from the stream in chunks. Their timestamps are converted to the
+    local LSL clock (`pylsl.local_clock`) using the stream's time correction, and each
+    trigger is recorded with the first sample after the time it is received. The first
+    estimate of the time correction takes a few hundred milliseconds; samples before that
+    are not corrected.
+
     See Also
     -----------
     :class:`octopus_sensing.device_coordinator`
@@ -81,8 +102,12 @@ class LslStreaming(RealtimeDataDevice):
         self._name = name
         self._stream_property_type = stream_property_type
         self._stream_property_value = stream_property_value
-        self._stream_data: List[float] = []
+        # It will be created when the stream is resolved, since number of channels
+        # is provided by the stream.
+        self._stream_data: Optional[RingBuffer] = None
         self._loop_thread: Optional[threading.Thread] = None
+        self._writer: Optional[BackgroundWriter] = None
+        self._handled_messages = multiprocessing.Value('Q', 0)
         self._terminate = False
         self._state = ""
         self._experiment_id = None
@@ -90,7 +115,8 @@ class LslStreaming(RealtimeDataDevice):
         self._inlet = None
         self.sampling_rate = sampling_rate
         self.channels = channels
-        self._trigger = None
+        # The trigger and the time it is received (local LSL clock)
+        self._trigger: Optional[Tuple[str, float]] = None
         self._saving_mode = saving_mode
 
         self.output_path = os.path.join(output_path, self._name)
@@ -103,8 +129,10 @@ class LslStreaming(RealtimeDataDevice):
         self._loop_thread = threading.Thread(target=self._stream_loop)
         self._loop_thread.start()
 
-        while True:
-            message = self.message_queue.get()
+        self._writer = BackgroundWriter("{0} writer".format(self.name))
+        self._writer.start()
+
+        for message in self._receive_messages(self._writer):
             if message is None:
                 continue
 
@@ -130,8 +158,7 @@ class LslStreaming(RealtimeDataDevice):
                                                         self._experiment_id,
                                                         message.stimulus_id)
                         self._save_to_file(file_name)
-                        self._stream_data = []
-                        print(f"LSL Device '{self.name}' saved data to {file_name} after STOP.")
+                        print(f"LSL Device '{self.name}' is saving data to {file_name} after STOP.")
                     else:
                         self._experiment_id = message.experiment_id
                         self.__set_trigger(message)
@@ -144,8 +171,7 @@ class LslStreaming(RealtimeDataDevice):
                                                  self.name,
                                                  self._experiment_id)
                     self._save_to_file(file_name)
-                    print(f"LSL Device '{self.name}' saved data to {file_name} after SAVE.")
-                    self._stream_data = []
+                    print(f"LSL Device '{self.name}' is saving data to {file_name} after SAVE.")
             elif message.type == MessageType.TERMINATE:
                 self._terminate = True
                 if self._saving_mode == SavingModeEnum.CONTINIOUS_SAVING_MODE:
@@ -154,9 +180,11 @@ class LslStreaming(RealtimeDataDevice):
                                                  self.name,
                                                  self._experiment_id)
                     self._save_to_file(file_name)
-                    print(f"LSL Device '{self.name}' saved data to {file_name} after TERMINATE.")
+                    print(f"LSL Device '{self.name}' is saving data to {file_name} after TERMINATE.")
                 break
 
+        self._writer.submit(self._acknowledge_message)
+        self._writer.stop()
         self._loop_thread.join()
 
     def _stream_loop(self):
@@ -164,18 +192,59 @@ class LslStreaming(RealtimeDataDevice):
         self._stream = resolve_byprop(self._stream_property_type, self._stream_property_value, timeout=5)
         if self._stream is None or len(self._stream) == 0:
             raise RuntimeError(f"Couldn't resolve an LSL stream with {self._stream_property_type}={self._stream_property_value}")
+        if self._stream[0].channel_format() == cf_string:
+            raise RuntimeError(f"LSL stream '{self.name}' has string values. Only numeric streams are supported.")
         self._inlet = StreamInlet(self._stream[0])
+        channel_count = self._stream[0].channel_count()
+        self._stream_data = RingBuffer(channel_count,
+                                       self.sampling_rate * REALTIME_BUFFER_DURATION)
+
+        # liblsl writes the chunks directly into this buffer. It has room for one second
+        # of samples, in the stream's type.
+        max_samples = max(self.sampling_rate, 1)
+        chunk = np.empty((max_samples, channel_count), dtype=np.dtype(self._inlet.value_type))
 
+        time_correction: Optional[float] = None
+        time_correction_updated = 0.0
         while True:
             if self._terminate is True:
                 break
-            sample, timestamp = self._inlet.pull_sample(timeout=0.2)
-            if sample is not None:
-                sample.append(timestamp)
-                if self._trigger is not None:
-                    sample.append(self._trigger)
+
+            if time_correction is None or \
+                    time.monotonic() - time_correction_updated >= TIME_CORRECTION_INTERVAL:
+                try:
+                    # The first estimate takes a few hundred milliseconds, and happens in
+                    # background. The next ones return immediately.
+                    time_correction = self._inlet.time_correction(timeout=0.0)
+                    time_correction_updated = time.monotonic()
+                except Exception:
+                    # Not estimated yet, or the stream is lost. The previous one is used.
+                    pass
+
+            _, timestamps = self._inlet.pull_chunk(timeout=0.0, max_samples=max_samples,
+                                                   dest_obj=chunk)
+            count = len(timestamps)
+            if count == 0:
+                time.sleep(PULL_INTERVAL)
+                continue
+
+            local_timestamps = np.asarray(timestamps, dtype=np.float64) + (time_correction or 0.0)
+
+            triggers = None
+            trigger = self._trigger
+            if trigger is not None:
+                message, trigger_time = trigger
+                # The first sample that is recorded after the trigger
+                row = int(np.searchsorted(local_timestamps, trigger_time))
+                if row < count:
                     self._trigger = None
-                self._stream_data.append(sample)
+                    triggers = {row: message}
+            self._stream_data.extend(chunk[:count], local_timestamps, triggers)
+
+            if count == max_samples:
+                # There might be more samples waiting
+                continue
+            time.sleep(PULL_INTERVAL)
 
     def __set_trigger(self, message):
         '''
@@ -188,20 +257,33 @@ class LslStreaming(RealtimeDataDevice):
         '''
         # Add the trigger to the data
         self._trigger = \
-            "{0}-{1}-{2}".format(message.type,
-                                 message.experiment_id,
-                                 str(message.stimulus_id).zfill(2))
+            ("{0}-{1}-{2}".format(message.type,
+                                  message.experiment_id,
+                                  str(message.stimulus_id).zfill(2)),
+             local_clock())
 
     def _save_to_file(self, file_name):
+        # Hands over the unsaved data to the writer thread, and returns immediately
+        assert self._writer is not None
+        if self._stream_data is None:
+            # The stream is not resolved yet, so there's no data.
+            self._writer.submit(self._write_to_file, file_name, None, None, {})
+        else:
+            self._writer.submit_unsaved(self._stream_data, self._write_to_file, file_name)
+
+    def _write_to_file(self, file_name, data, timestamps, triggers):
         print("Saving {0} to file {1}".format(self._name, file_name))
+        if data is None:
+            open(file_name, 'a').close()
+            return
         with open(file_name, 'a') as csv_file:
             writer = csv.writer(csv_file)
-            for row in self._stream_data:
-                writer.writerow(row)
+            writer.writerows(iter_rows(data, timestamps, triggers))
             csv_file.flush()
         print("Saving {0} to file {1} is done".format(self._name, file_name))
 
-    def _get_realtime_data(self, duration: int) -> Dict[str, Any]:
+    def _get_realtime_data(self, duration: int,
+                           since: Optional[int] = None) -> Dict[str, Any]:
             '''
             Returns n seconds (duration) of latest collected data for monitoring/visualizing or
             realtime processing purposes.
@@ -211,21 +293,41 @@ class LslStreaming(RealtimeDataDevice):
             duration: int
                 A time duration in seconds for getting the latest recorded data in realtime
 
+            since: int, default: None
+                If it is given, only the records with a sequence number greater than or equal to
+                it are returned. It is usually the `cursor` of the previous call.
+
             Returns
             -------
             data: Dict[str, Any]
-                The keys are `data` and `metadata`.
-                `data` is a list of records, or empty list if there's nothing.
+                The keys are `data`, `timestamps`, `triggers` and `metadata`.
+                `data` is a 2D array of records (records * channels).
+                `timestamps` is an array of records' time.
+                `triggers` is a dictionary of record's index to its trigger.
+                `sequence` is the sequence number of the first record, and `cursor` is the
+                sequence number of the next record.
                 `metadata` is a dictionary of device metadata including `sampling_rate` and `channels` and `type`
 
             '''
-            # Last seconds of data
-
-            data = self._stream_data[-1 * duration * self.sampling_rate:]
             metadata = {"sampling_rate": self.sampling_rate,
                         "channels": self.channels,
                         "type": self.__class__.__name__}
+            if self._stream_data is None:
+                return {"data": [],
+                        "timestamps": [],
+                        "triggers": {},
+                        "sequence": 0,
+                        "cursor": 0,
+                        "metadata": metadata}
+
+            # Last seconds of data
+            data, timestamps, triggers, sequence = \
+                self._stream_data.get_since(since or 0, duration * self.sampling_rate)
 
             realtime_data = {"data": data,
-                    "metadata": metadata}
+                             "timestamps": timestamps,
+                             "triggers": triggers,
+                             "sequence": sequence,
+                             "cursor": sequence + len(data),
+                             "metadata": metadata}
             return realtime_data
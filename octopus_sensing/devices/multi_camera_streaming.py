@@ -0,0 +1,395 @@
+# This file is part of Octopus Sensing <https://octopus-sensing.nastaran-saffar.me/>
+# Copyright © Nastaran Saffaryazdi 2020-2026
+#
+# Octopus Sensing is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation,
+#  either version 3 of the License, or (at your option) any later version.
+#
+# Octopus Sensing is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Octopus Sensing.
+# If not, see <https://www.gnu.org/licenses/>.
+
+from typing import Tuple, Any, Dict, List, Optional, Union
+import os
+import sys
+import csv
+import threading
+import traceback
+import multiprocessing
+import time
+import cv2
+
+from octopus_sensing.devices.realtime_data_device import RealtimeDataDevice
+from octopus_sensing.devices.background_writer import BackgroundWriter
+from octopus_sensing.devices.common import FrameDropPolicyEnum
+from octopus_sensing.devices.camera_streaming import \
+    DEFAULT_FRAME_RATE, FrameRateEstimator, FrameRecorder, RealtimeFrames, _last_rows
+from octopus_sensing.common.message_creators import MessageType
+
+
+class _Recording:
+    '''
+    One recording of all cameras. Each camera has its own FrameRecorder (and encoder
+    thread), and the capture time of every set of frames is kept for the shared index.
+    '''
+
+    def __init__(self, recorders: List[FrameRecorder], index_file_name: str,
+                 camera_names: List[str], start_trigger: str):
+        self.recorders = recorders
+        self._index_file_name = index_file_name
+        self._camera_names = camera_names
+        self._start_trigger = start_trigger
+        self._stop_trigger: Optional[str] = None
+        self._capture_times: List[float] = []
+        # Stops adding frames after the end of the recording is queued
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def submit(self, frames: List[Any], capture_time: float) -> None:
+        '''Queues a set of frames, one for each camera'''
+        with self._lock:
+            if self._closed:
+                return
+            self._capture_times.append(capture_time)
+            for recorder, frame in zip(self.recorders, frames):
+                recorder.submit(frame, capture_time)
+
+    def finish(self, stop_trigger: Optional[str] = None) -> None:
+        '''Ends the recording of all cameras'''
+        with self._lock:
+            self._closed = True
+            self._stop_trigger = stop_trigger
+        for recorder in self.recorders:
+            recorder.finish(stop_trigger)
+
+    def join(self) -> None:
+        '''Waits for all videos to be written, and writes the shared index'''
+        for recorder in self.recorders:
+            recorder.join()
+
+        # Frames of all cameras have the same capture time, so they are found by it
+        video_indexes = [{capture_time: index
+                          for index, capture_time in enumerate(recorder.written_capture_times)}
+                         for recorder in self.recorders]
+        with open(self._index_file_name, 'w') as index_file:
+            writer = csv.writer(index_file)
+            writer.writerow(["frame", "timestamp"] + self._camera_names + ["trigger"])
+            last = len(self._capture_times) - 1
+            columns = 2 + len(self._camera_names)
+            for frame, capture_time in enumerate(self._capture_times):
+                row: List[Any] = [frame, capture_time]
+                row.extend(indexes.get(capture_time, "") for indexes in video_indexes)
+                if frame == 0:
+                    row.append(self._start_trigger)
+                if frame == last:
+                    writer.writerows(_last_rows(row, columns, self._stop_trigger))
+                else:
+                    writer.writerow(row)
+
+
+class MultiCameraStreaming(RealtimeDataDevice):
+    '''
+    Stream and Record video of several cameras, synchronously, in one process.
+    In each capture, all cameras grab a frame first, and then the frames are retrieved
+    (decoded) one by one, so frames of different cameras are taken as close in time as
+    possible. Each camera's video is encoded in its own encoder thread (see
+    CameraStreaming), so a slow camera doesn't hold back the others.
+
+    One video file is recorded for each camera and stimulus, named
+    {name}-{camera name}-{experiment_id}-{stimulus_id}.avi, with its own timestamps file
+    (see CameraStreaming). All frames that are captured together have the same timestamp.
+    A shared index, {name}-{experiment_id}-{stimulus_id}-timestamps.csv, has a row for each
+    capture, with its timestamp and the index of its frame in each camera's video (empty
+    if the camera dropped that frame). START and STOP triggers are recorded in its
+    `trigger` column.
+
+    Attributes
+    ----------
+
+    Parameters
+    ----------
+    name: str, default: None:
+        The name of device
+
+    output_path: str, default: output
+        The path for recording files.
+        Video files will be recorded in folder {output_path}/{name}
+
+    camera_nos: List[int], default: None
+        Camera numbers
+
+    camera_paths: List[str], default: None
+        The physical paths of camera devices (see CameraStreaming). They can be video
+        files too, e.g. for testing. Video files are played at their frame rate.
+
+    camera_names: List[str], default: None
+        Names of cameras, that are used in file names and realtime data.
+        Default is camera0, camera1, ...
+
+    image_width: int, default: 1280
+        The width of recorded frames
+
+    image_height: int, default: 720
+        The height of recorded frames
+
+    frame_queue_size: int, default: 64
+        Maximum number of captured frames of each camera that wait to be written to the file
+
+    drop_policy: int, default: FrameDropPolicyEnum.DROP_NEWEST_POLICY
+        What to do with a new frame when the queue of frames is full (see CameraStreaming)
+
+    Notes
+    -----
+    - Only one of camera_nos or camera_paths should have value.
+
+    - Cameras are captured at the rate of the slowest one.
+
+    Example
+    -----------
+    >>> cameras = MultiCameraStreaming(camera_nos=[0, 2],
+    ...                                camera_names=["face", "body"],
+    ...                                name="cameras",
+    ...                                output_path="./output")
+    >>> device_coordinator.add_device(cameras)
+
+    See Also
+    -----------
+    :class:`octopus_sensing.devices.camera_streaming`
+    :class:`octopus_sensing.device_coordinator`
+    :class:`octopus_sensing.devices.RealtimeDataDevice`
+    '''
+
+    def __init__(self, camera_nos: Optional[List[int]] = None,
+                 camera_paths: Optional[List[str]] = None,
+                 camera_names: Optional[List[str]] = None,
+                 image_width: int = 1280,
+                 image_height: int = 720,
+                 frame_queue_size: int = 64,
+                 drop_policy: int = FrameDropPolicyEnum.DROP_NEWEST_POLICY,
+                 **kwargs):
+        assert (camera_nos is not None) ^ (camera_paths is not None), \
+            "Only one of camera_nos or camera_paths should have value"
+        super().__init__(**kwargs)
+        self.output_path = os.path.join(self.output_path, self.name)
+        os.makedirs(self.output_path, exist_ok=True)
+        self._camera_numbers: List[Union[int, str]] = []
+        if camera_nos is not None:
+            self._camera_numbers = list(camera_nos)
+        elif camera_paths is not None:
+            self._camera_numbers = [os.path.realpath(path) for path in camera_paths]
+        if camera_names is None:
+            camera_names = ["camera{0}".format(i) for i in range(len(self._camera_numbers))]
+        if len(camera_names) != len(self._camera_numbers):
+            raise RuntimeError("The number of camera_names should be the same as cameras")
+        self._camera_names = camera_names
+
+        self._image_width = image_width
+        self._image_height = image_height
+        self._frame_queue_size = frame_queue_size
+        self._drop_policy = drop_policy
+        self._video_captures: List[Any] = []
+        self._video_sizes: List[Tuple[int, int]] = []
+        # Time between captures, if some of the sources are video files
+        self._playback_interval: Optional[float] = None
+        self._frame_rate = FrameRateEstimator()
+        self._realtime_frames = [RealtimeFrames() for _ in self._camera_numbers]
+        # The recording that captured frames are passed to, if any
+        self._recording: Optional[_Recording] = None
+        self._last_recording: Optional[_Recording] = None
+        self._terminate = False
+        self._state = ""
+        self._handled_messages = multiprocessing.Value('Q', 0)
+
+    def _run(self):
+        for camera_name, camera_number in zip(self._camera_names, self._camera_numbers):
+            video_capture = cv2.VideoCapture(camera_number)
+            self._video_captures.append(video_capture)
+            try:
+                video_capture.set(cv2.CAP_PROP_FRAME_WIDTH, self._image_width)
+                video_capture.set(cv2.CAP_PROP_FRAME_HEIGHT, self._image_height)
+            except Exception as error:
+                # Ignoring all errors
+                print(f"[{self.name}] Could not set the resolution of {camera_name}. Continuing.")
+                print(error)
+
+            # There's no guarantee that we can set the camera resolution. So, we
+            # re-read the settings again from the camera.
+            video_size = (int(video_capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                          int(video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+            if video_size[0] <= 0 or video_size[1] <= 0:
+                for capture in self._video_captures:
+                    capture.release()
+                raise RuntimeError(
+                    f"[{self.name}] Couldn't read the video size from {camera_name}.")
+            self._video_sizes.append(video_size)
+
+            if isinstance(camera_number, str) and os.path.isfile(camera_number):
+                # Video files are read as fast as they are decoded, unlike cameras
+                file_frame_rate = video_capture.get(cv2.CAP_PROP_FPS) or DEFAULT_FRAME_RATE
+                self._playback_interval = max(self._playback_interval or 0,
+                                              1 / file_frame_rate)
+
+        print(f"[{self.name}] Initialized video devices: video sizes: {self._video_sizes}")
+
+        capture_thread = threading.Thread(target=self._stream_loop,
+                                          name=self.name + " capture thread", daemon=True)
+        capture_thread.start()
+        writer = BackgroundWriter("{0} writer".format(self.name))
+        writer.start()
+
+        for message in self._receive_messages(writer):
+            if message is None:
+                continue
+            if message.type == MessageType.START:
+                if self._state == "START":
+                    print(f"[{self.name}] Video streaming has already started")
+                else:
+                    self._recording = self._start_recording(message)
+                    self._last_recording = self._recording
+                    self._state = "START"
+
+            elif message.type == MessageType.STOP:
+                if self._state == "STOP":
+                    print(f"[{self.name}] Video streaming has already stopped")
+                else:
+                    self._stop_recording(writer, self._get_trigger(message))
+                    self._state = "STOP"
+
+            elif message.type == MessageType.TERMINATE:
+                self._stop_recording(writer)
+                break
+
+        writer.submit(self._acknowledge_message)
+        writer.stop()
+        self._terminate = True
+        capture_thread.join()
+        print(f"[{self.name}] video terminated")
+        for video_capture in self._video_captures:
+            video_capture.release()
+
+    def _start_recording(self, message) -> _Recording:
+        file_suffix = "{0}-{1}".format(message.experiment_id,
+                                       str(message.stimulus_id).zfill(2))
+        trigger = self._get_trigger(message)
+        recorders = []
+        for camera_name, video_size in zip(self._camera_names, self._video_sizes):
+            file_name = "{0}/{1}-{2}-{3}.avi".format(self.output_path, self.name,
+                                                     camera_name, file_suffix)
+            recorders.append(FrameRecorder("{0} {1}".format(self.name, camera_name),
+                                           file_name, video_size, self._frame_rate.frame_rate,
+                                           self._frame_queue_size, self._drop_policy,
+                                           start_trigger=trigger))
+        index_file_name = "{0}/{1}-{2}-timestamps.csv".format(self.output_path, self.name,
+                                                               file_suffix)
+        return _Recording(recorders, index_file_name, self._camera_names, trigger)
+
+    def _stop_recording(self, writer: BackgroundWriter,
+                        stop_trigger: Optional[str] = None) -> None:
+        recording = self._recording
+        if recording is None:
+            return
+        self._recording = None
+        recording.finish(stop_trigger)
+        # The files are closed in the writer thread, and `_receive_messages` acknowledges
+        # the message in the same thread after it.
+        writer.submit(recording.join)
+
+    @staticmethod
+    def _get_trigger(message) -> str:
+        return "{0}-{1}-{2}".format(message.type,
+                                    message.experiment_id,
+                                    str(message.stimulus_id).zfill(2))
+
+    def _stream_loop(self) -> None:
+        '''Captures frames of all cameras, until the device terminates'''
+        frame_index = -1
+        next_capture_time = time.time()
+        try:
+            while not self._terminate:
+                if self._playback_interval is not None:
+                    time.sleep(max(next_capture_time - time.time(), 0))
+                    next_capture_time += self._playback_interval
+                # Grabbing is fast. Decoding the frames is done after all cameras grabbed.
+                grabbed = [video_capture.grab() for video_capture in self._video_captures]
+                capture_time = time.time()
+                frames = []
+                if all(grabbed):
+                    for video_capture in self._video_captures:
+                        ret, frame = video_capture.retrieve()
+                        if not ret:
+                            break
+                        frames.append(frame)
+                if len(frames) < len(self._video_captures):
+                    # Not spinning on cameras that are not ready (or finished video files)
+                    time.sleep(0.01)
+                    continue
+
+                frame_index += 1
+                self._frame_rate.update(capture_time)
+                for realtime_frames, frame in zip(self._realtime_frames, frames):
+                    realtime_frames.append(frame_index, capture_time, frame)
+
+                recording = self._recording
+                if recording is not None:
+                    recording.submit(frames, capture_time)
+
+        except Exception:
+            print(f"[{self.name}] Error while capturing video:", file=sys.stderr)
+            traceback.print_exc()
+
+    def _get_realtime_data(self, duration: int,
+                           since: Optional[int] = None) -> Dict[str, Any]:
+        '''
+        Returns n seconds (duration) of latest collected data for monitoring/visualizing or
+        realtime processing purposes.
+
+        Parameters
+        ----------
+        duration: int
+            A time duration in seconds for getting the latest recorded data in realtime.
+
+        since: int, default: None
+            Not supported by this device, and is ignored.
+
+        Returns
+        -------
+        data: Dict[str, Any]
+            The keys are `data` and `metadata`.
+            `data` is a dictionary of camera names to their frames, one per second, from
+            the oldest to the latest captured frame.
+            `metadata` is a dictionary of device metadata including `frame_rate`,
+            `dropped_frames` (of each camera in the current or last recording),
+            `frame_indexes` (index of each frame since the device started, the same for
+            all cameras), `camera_names` and `type`
+        '''
+        return self._get_realtime_data_with_options(duration, since, {})
+
+    def _get_realtime_data_with_options(self, duration: int, since: Optional[int],
+                                        options: Dict[str, Any]) -> Dict[str, Any]:
+        '''
+        The same as `_get_realtime_data`, with the options of CameraStreaming
+        (e.g. frames encoded as small JPEG images).
+        '''
+        data = {}
+        frame_indexes: List[int] = []
+        image_format = None
+        for camera_name, realtime_frames in zip(self._camera_names, self._realtime_frames):
+            frame_indexes, data[camera_name], image_format = \
+                realtime_frames.get(duration, options)
+
+        recording = self._last_recording
+        metadata = {"frame_rate": self._frame_rate.frame_rate,
+                    "dropped_frames": {camera_name: recorder.dropped_frames
+                                       for camera_name, recorder
+                                       in zip(self._camera_names, recording.recorders)}
+                                      if recording is not None else {},
+                    "frame_indexes": frame_indexes,
+                    "camera_names": self._camera_names,
+                    "type": self.__class__.__name__}
+        if image_format is not None:
+            metadata["format"] = image_format
+        return {"data": data,
+                "metadata": metadata}
@@ -14,12 +14,15 @@
 
 import os
 import threading
+import multiprocessing
 import csv
 import datetime
 import pyOpenBCI
 import numpy as np
+from typing import Optional
 
 from octopus_sensing.common.message_creators import MessageType
+from octopus_sensing.devices.background_writer import BackgroundWriter
 from octopus_sensing.devices.realtime_data_device import RealtimeDataDevice
 from octopus_sensing.devices.common import SavingModeEnum
 
@@ -113,6 +116,8 @@ class OpenBCIStreaming(RealtimeDataDevice):
         self._trigger = None
         self._experiment_id = None
         self._sampling_rate = 128
+        self._writer: Optional[BackgroundWriter] = None
+        self._handled_messages = multiprocessing.Value('Q', 0)
 
         self.output_path = self._make_output_path()
 
@@ -143,9 +148,10 @@ class OpenBCIStreaming(RealtimeDataDevice):
 
     def _run(self):
         threading.Thread(target=self._stream_loop).start()
+        self._writer = BackgroundWriter("{0} writer".format(self.name))
+        self._writer.start()
 
-        while True:
-            message = self.message_queue.get()
+        for message in self._receive_messages(self._writer):
             if message is None:
                 continue
             if message.type == MessageType.START:
@@ -172,6 +178,8 @@ class OpenBCIStreaming(RealtimeDataDevice):
                     self._save_to_file(file_name)
                 break
 
+        self._writer.submit(self._acknowledge_message)
+        self._writer.stop()
         self._board.stop_stream()
 
     def __set_trigger(self, message):
@@ -200,6 +208,11 @@ class OpenBCIStreaming(RealtimeDataDevice):
         self._stream_data.append(data_list)
 
     def _save_to_file(self, file_name):
+        # Hands over a copy of the records to the writer thread, and returns immediately
+        assert self._writer is not None
+        self._writer.submit(self._write_to_file, file_name, list(self._stream_data))
+
+    def _write_to_file(self, file_name, rows):
         print("Saving {0} to file {1}".format(self._name, file_name))
         if not os.path.exists(file_name):
             csv_file = open(file_name, 'a')
@@ -213,12 +226,12 @@ class OpenBCIStreaming(RealtimeDataDevice):
             csv_file.close()
         with open(file_name, 'a') as csv_file:
             writer = csv.writer(csv_file)
-            for row in self._stream_data:
+            for row in rows:
                 writer.writerow(row)
                 csv_file.flush()
         print("Saving {0} to file {1} is done".format(self._name, file_name))
 
-    def _get_realtime_data(self, duration: int):
+    def _get_realtime_data(self, duration: int, since: Optional[int] = None):
         '''
         Returns n seconds (duration) of latest collected data for monitoring/visualizing or 
         realtime processing purposes.
@@ -228,6 +241,10 @@ class OpenBCIStreaming(RealtimeDataDevice):
         duration: int
             A time duration in seconds for getting the latest recorded data in realtime
 
+        since: int, default: None
+            Not supported by this device. The records don't have sequence numbers, so
+            it is ignored.
+
         Returns
         -------
         data: List[Any]
@@ -13,13 +13,15 @@
 # If not, see <https://www.gnu.org/licenses/>.
 
 import sys
+import queue
 import pickle
 import multiprocessing.queues
 import threading
 import traceback
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
 from octopus_sensing.devices.device import Device
+from octopus_sensing.devices.shared_realtime_data import SharedRealtimeDataWriter
 
 QueueType = multiprocessing.queues.Queue
 
@@ -28,12 +30,17 @@ class RealtimeDataDevice(Device):
     '''
     Provides functionalities for realtime processing or monitoring a device's data. 
     For example, visualizing data in real time.
+
+    NumPy arrays of the realtime data are passed to the parent process through shared
+    memory (see `SharedRealtimeDataWriter`), and the rest of it is pickled. If shared
+    memory is not available, the whole data is pickled.
     '''
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._realtime_data_in_q = None
         self._realtime_data_out_q = None
+        self._shared_realtime_data: Optional[SharedRealtimeDataWriter] = None
 
     def set_realtime_data_queues(self, realtime_data_in_q: QueueType, realtime_data_out_q: QueueType) -> None:
         '''Sets the queues for communicating with the parent process.
@@ -47,35 +54,61 @@ class RealtimeDataDevice(Device):
         assert self._realtime_data_in_q is not None
         assert self._realtime_data_out_q is not None
 
+        self._shared_realtime_data = SharedRealtimeDataWriter()
         threading.Thread(target=self._realtime_data_loop,
                          name=self.__class__.__name__ + " realtime data thread", daemon=True) \
             .start()
 
-        self._run()
+        try:
+            self._run()
+        finally:
+            self._shared_realtime_data.close()
 
     def _realtime_data_loop(self) -> None:
         while True:
-            # There is a duration for getting data n queue
-            data = self._realtime_data_in_q.get()
-            duration = int(data)
+            # Each request is its ID, a duration, a cursor (or None) and options (or None)
+            request_id, duration, since, options = self._realtime_data_in_q.get()
+            # The coordinator only waits for its latest request. Skipping the older ones.
+            while True:
+                try:
+                    request_id, duration, since, options = \
+                        self._realtime_data_in_q.get_nowait()
+                except queue.Empty:
+                    break
 
             try:
-                # Only 10ms timeout, because we don't want to take cpu time from the
-                # main thread (data collector)
-                self._realtime_data_out_q.put(
-                    pickle.dumps(
-                        self._get_realtime_data(duration),
-                        protocol=pickle.HIGHEST_PROTOCOL),
-                    timeout=0.01)
+                if options:
+                    realtime_data = \
+                        self._get_realtime_data_with_options(int(duration), since, options)
+                else:
+                    realtime_data = self._get_realtime_data(int(duration), since)
+                if self._shared_realtime_data is not None:
+                    try:
+                        realtime_data = self._shared_realtime_data.publish(realtime_data)
+                    except OSError:
+                        print("Could not use shared memory for realtime data. "
+                              "Falling back to pickling it.", file=sys.stderr)
+                        traceback.print_exc()
+                        self._shared_realtime_data = None
+
+                reply = pickle.dumps((request_id, realtime_data),
+                                     protocol=pickle.HIGHEST_PROTOCOL)
 
             except pickle.PickleError:
                 print("Error pickling realtime data", file=sys.stderr)
                 traceback.print_exc()
                 # We don't want to keep the parent process waiting
-                self._realtime_data_out_q(pickle.dumps(
-                    [], protocol=pickle.HIGHEST_PROTOCOL))
+                reply = pickle.dumps((request_id, []), protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                print("Error getting realtime data", file=sys.stderr)
+                traceback.print_exc()
+                reply = pickle.dumps((request_id, []), protocol=pickle.HIGHEST_PROTOCOL)
+
+            # The queue is unbounded, so it won't block (or drop the reply). Sending it
+            # happens in the queue's feeder thread.
+            self._realtime_data_out_q.put(reply)
 
-    def _get_realtime_data(self, duration: int) -> Dict[str, Any]:
+    def _get_realtime_data(self, duration: int, since: Optional[int] = None) -> Dict[str, Any]:
         '''
         Subclasses must implmenet this method. It should return
         a list of latest collected records.
@@ -89,11 +122,44 @@ class RealtimeDataDevice(Device):
         duration: int
             A time duration in seconds for getting the latest recorded data in realtime
 
+        since: int, default: None
+            A sequence number. If it is given, only the records that their sequence number
+            is greater than or equal to it should be returned (but not more than `duration`).
+            Devices that don't number their records ignore it.
+
         Returns
         -------
         data: Dict[str, Any]
             it includes `data`: List of records, or empty list if there's nothing.
                         `metadata`: Dict of device metadata
+            Devices that number their records also include
+                        `sequence`: Sequence number of the first record
+                        `cursor`: Sequence number of the next record. It should be passed
+                                  as `since` to get only the newer records.
 
         '''
         raise NotImplementedError()
+
+    def _get_realtime_data_with_options(self, duration: int, since: Optional[int],
+                                        options: Dict[str, Any]) -> Dict[str, Any]:
+        '''
+        The same as `_get_realtime_data`, with options of the request (e.g. the size of
+        camera frames). Devices that support options override it, others ignore them.
+
+        Parameters
+        ----------
+        duration: int
+            A time duration in seconds for getting the latest recorded data in realtime
+
+        since: int
+            A sequence number, or None (see `_get_realtime_data`)
+
+        options: Dict[str, Any]
+            Options of the request. See `RealtimeDataEndpoint` for the available ones.
+
+        Returns
+        -------
+        data: Dict[str, Any]
+            The same as `_get_realtime_data`
+        '''
+        return self._get_realtime_data(duration, since)
@@ -0,0 +1,365 @@
+# This file is part of Octopus Sensing <https://octopus-sensing.nastaran-saffar.me/>
+# Copyright © Nastaran Saffaryazdi 2020-2026
+#
+# Octopus Sensing is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation,
+#  either version 3 of the License, or (at your option) any later version.
+#
+# Octopus Sensing is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Octopus Sensing.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import math
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+# In seconds. Devices keep at least this much of their latest data in memory
+# for realtime processing, even after it is saved to the file.
+REALTIME_BUFFER_DURATION = 60
+
+
+class _Storage:
+    '''
+    The arrays behind a RingBuffer. They are replaced as a whole when the buffer grows,
+    so readers always see a consistent capacity and arrays.
+    '''
+    def __init__(self, capacity: int, channels: int, dtype: Any):
+        self.capacity = capacity
+        # Every sample is written twice, at `i` and `i + capacity`. So any window of
+        # at most `capacity` samples is a contiguous slice of these arrays.
+        self.data = np.empty((2 * capacity, channels), dtype=dtype)
+        self.timestamps = np.full(2 * capacity, np.nan, dtype=np.float64)
+
+
+class RingBuffer:
+    '''
+    A preallocated, fixed-capacity store of samples for streaming devices.
+    Samples are kept in a 2D NumPy array (one row per sample), with a parallel column
+    of timestamps and an index of triggers (sample number -> trigger).
+
+    One thread (the device's streaming loop) appends samples, while other threads can
+    read the latest samples or write the unsaved samples to a file at the same time.
+
+    Attributes
+    ----------
+
+    Parameters
+    ----------
+    channels: int
+        Number of values in each sample
+
+    capacity: int
+        Number of samples the buffer keeps in memory
+
+    dtype: default: numpy.float64
+        Data type of samples
+
+    Notes
+    -----
+    Samples that are not saved yet are never overwritten. If there is no space left for
+    new samples because nothing has been saved (e.g. in CONTINIOUS_SAVING_MODE without
+    any SAVE message), the buffer doubles its capacity.
+
+    Example
+    -------
+    >>> buffer = RingBuffer(2, 1000)
+    >>> buffer.append([1.0, 2.0], time.time(), trigger="START-exp-01")
+    >>> data, timestamps, triggers = buffer.get_latest(125)
+    '''
+
+    def __init__(self, channels: int, capacity: int, dtype: Any = np.float64):
+        assert channels > 0 and capacity > 0
+        self._channels = channels
+        self._dtype = dtype
+        self._initial_capacity = capacity
+        # Arrays are allocated lazily in the process that uses the buffer, so creating a
+        # device doesn't allocate (or copy to the device's process) any memory.
+        self._storage: Optional[_Storage] = None
+        self._total = 0
+        # Samples before `_taken` are handed over for saving, and samples before
+        # `_saved` are written to the file.
+        self._taken = 0
+        self._saved = 0
+        self._triggers: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def channels(self) -> int:
+        '''Number of values in each sample'''
+        return self._channels
+
+    @property
+    def capacity(self) -> int:
+        '''Number of samples the buffer can keep in memory'''
+        if self._storage is None:
+            return self._initial_capacity
+        return self._storage.capacity
+
+    @property
+    def sample_count(self) -> int:
+        '''Total number of samples appended to the buffer since its creation'''
+        return self._total
+
+    def __len__(self) -> int:
+        return min(self._total, self.capacity)
+
+    def append(self, sample: Any, timestamp: float = math.nan,
+               trigger: Optional[str] = None) -> None:
+        '''
+        Appends one sample to the buffer
+
+        Parameters
+        ----------
+        sample: Sequence of numbers
+            Sample values. Its length should be equal to `channels`
+
+        timestamp: float, default: nan
+            The time of the sample
+
+        trigger: str, default: None
+            The trigger that is recorded with this sample
+        '''
+        with self._lock:
+            storage = self._reserve(1)
+            position = self._total % storage.capacity
+            storage.data[position] = sample
+            storage.data[position + storage.capacity] = sample
+            storage.timestamps[position] = timestamp
+            storage.timestamps[position + storage.capacity] = timestamp
+            if trigger is not None:
+                self._triggers[self._total] = trigger
+            self._total += 1
+
+    def extend(self, samples: np.ndarray, timestamps: Any = math.nan,
+               triggers: Optional[Dict[int, str]] = None) -> None:
+        '''
+        Appends a block of samples to the buffer
+
+        Parameters
+        ----------
+        samples: numpy.ndarray
+            A 2D array of samples (samples * channels)
+
+        timestamps: numpy.ndarray or float, default: nan
+            Time of each sample, or one time for all of them
+
+        triggers: Dict[int, str], default: None
+            Triggers recorded with the samples. Keys are row numbers in `samples`
+        '''
+        count = len(samples)
+        if count == 0:
+            return
+        with self._lock:
+            storage = self._reserve(count)
+            capacity = storage.capacity
+            position = self._total % capacity
+            first_part = min(count, capacity - position)
+            for offset in (0, capacity):
+                storage.data[position + offset:position + offset + first_part] = \
+                    samples[:first_part]
+                storage.data[offset:offset + count - first_part] = samples[first_part:]
+                if np.ndim(timestamps) == 0:
+                    storage.timestamps[position + offset:position + offset + first_part] = \
+                        timestamps
+                    storage.timestamps[offset:offset + count - first_part] = timestamps
+                else:
+                    storage.timestamps[position + offset:position + offset + first_part] = \
+                        timestamps[:first_part]
+                    storage.timestamps[offset:offset + count - first_part] = \
+                        timestamps[first_part:]
+            if triggers:
+                for row, trigger in triggers.items():
+                    self._triggers[self._total + row] = trigger
+            self._total += count
+
+    def get_latest(self, count: int) -> Tuple[np.ndarray, np.ndarray, Dict[int, str]]:
+        '''
+        Returns the latest samples in the buffer
+
+        Parameters
+        ----------
+        count: int
+            Number of samples. If the buffer has fewer samples, all of them will be returned.
+
+        Returns
+        -------
+        data, timestamps, triggers: Tuple[numpy.ndarray, numpy.ndarray, Dict[int, str]]
+            `data` is a 2D array of samples, `timestamps` is time of each sample, and
+            `triggers` maps row numbers in `data` to their triggers.
+
+        Notes
+        -----
+        `data` and `timestamps` are views on the buffer (no copy). They remain valid until
+        `capacity - count` more samples are appended, so they should be consumed
+        (e.g. serialized) right away, or be copied.
+        '''
+        with self._lock:
+            return self._get_range(max(self._total - max(count, 0), 0), self._total)
+
+    def get_since(self, since: int, count: int) \
+            -> Tuple[np.ndarray, np.ndarray, Dict[int, str], int]:
+        '''
+        Returns the samples that are appended after the `since` sequence number.
+        Each sample's sequence number is the number of samples appended before it.
+
+        Parameters
+        ----------
+        since: int
+            Sequence number of the first sample that is needed, usually the `cursor` of
+            the previous call
+
+        count: int
+            Maximum number of samples. If there are more new samples, only the latest
+            ones are returned.
+
+        Returns
+        -------
+        data, timestamps, triggers, sequence: Tuple[numpy.ndarray, numpy.ndarray, Dict[int, str], int]
+            `data`, `timestamps` and `triggers` are the same as `get_latest`.
+            `sequence` is the sequence number of the first returned sample. If it's greater
+            than `since`, some samples are missed. The next `since` (cursor) is
+            `sequence + len(data)`.
+        '''
+        with self._lock:
+            start = max(since, self._total - max(count, 0), self._total - self.capacity, 0)
+            start = min(start, self._total)
+            return (*self._get_range(start, self._total), start)
+
+    def take_unsaved(self) -> Tuple[np.ndarray, np.ndarray, Dict[int, str], int]:
+        '''
+        Hands over the samples that are not taken for saving yet. The next call only
+        returns the samples that are appended after this one. The taken samples won't be
+        overwritten until they are marked as saved, so they can be written to the file
+        in another thread while new samples are being appended.
+
+        Returns
+        -------
+        data, timestamps, triggers, end: Tuple[numpy.ndarray, numpy.ndarray, Dict[int, str], int]
+            `data`, `timestamps` and `triggers` are the same as `get_latest`.
+            `end` should be passed to `mark_saved` after the samples are saved.
+        '''
+        with self._lock:
+            start = self._taken
+            end = self._taken = self._total
+            return (*self._get_range(start, end), end)
+
+    def mark_saved(self, end: int) -> None:
+        '''
+        Marks all samples before `end` as saved, so they can be overwritten
+
+        Parameters
+        ----------
+        end: int
+            The `end` returned by `take_unsaved`
+        '''
+        with self._lock:
+            self._saved = max(self._saved, end)
+            oldest = min(self._saved, self._total - self.capacity)
+            for index in [index for index in self._triggers if index < oldest]:
+                del self._triggers[index]
+
+    def _get_range(self, start: int, end: int) -> Tuple[np.ndarray, np.ndarray, Dict[int, str]]:
+        '''Should be called while holding the lock'''
+        storage = self._storage
+        start = max(start, end - self.capacity)
+        if storage is None or end <= start:
+            return (np.empty((0, self._channels), dtype=self._dtype),
+                    np.empty(0, dtype=np.float64),
+                    {})
+        position = start % storage.capacity
+        count = end - start
+        triggers = {index - start: trigger
+                    for index, trigger in self._triggers.items()
+                    if start <= index < end}
+        return (storage.data[position:position + count],
+                storage.timestamps[position:position + count],
+                triggers)
+
+    def _reserve(self, count: int) -> _Storage:
+        '''
+        Makes sure there's room for `count` new samples without overwriting unsaved ones.
+        Should be called while holding the lock.
+        '''
+        storage = self._storage
+        if storage is None:
+            storage = self._storage = \
+                _Storage(max(self._initial_capacity, count), self._channels, self._dtype)
+            return storage
+
+        required = self._total - self._saved + count
+        if required <= storage.capacity:
+            return storage
+
+        new_capacity = max(storage.capacity * 2, required)
+        new_storage = _Storage(new_capacity, self._channels, self._dtype)
+        kept = min(self._total, storage.capacity)
+        start = self._total - kept
+        old_position = start % storage.capacity
+        new_position = start % new_capacity
+        old_data = storage.data[old_position:old_position + kept]
+        old_timestamps = storage.timestamps[old_position:old_position + kept]
+        # Copying the kept samples to the new arrays the same way `extend` does.
+        first_part = min(kept, new_capacity - new_position)
+        for offset in (0, new_capacity):
+            new_storage.data[new_position + offset:new_position + offset + first_part] = \
+                old_data[:first_part]
+            new_storage.data[offset:offset + kept - first_part] = old_data[first_part:]
+            new_storage.timestamps[new_position + offset:
+                                   new_position + offset + first_part] = \
+                old_timestamps[:first_part]
+            new_storage.timestamps[offset:offset + kept - first_part] = \
+                old_timestamps[first_part:]
+        self._storage = new_storage
+        return new_storage
+
+
+def iter_rows(data: np.ndarray, timestamps: np.ndarray, triggers: Dict[int, str],
+              format_timestamp: Optional[Callable[[float], List[Any]]] = None) \
+        -> Iterator[List[Any]]:
+    '''
+    Converts samples of a RingBuffer to rows for writing in a csv file.
+    Each row is the sample's values, followed by the formatted timestamp and the trigger
+    (if the sample has one).
+
+    Parameters
+    ----------
+    data: numpy.ndarray
+        A 2D array of samples
+
+    timestamps: numpy.ndarray
+        Time of each sample
+
+    triggers: Dict[int, str]
+        Maps row numbers to their triggers
+
+    format_timestamp: Callable[[float], List[Any]], default: None
+        Converts a timestamp to a list of columns. By default, timestamp is written as is.
+
+    Returns
+    -------
+    Iterator[List[Any]]
+        Rows of the csv file
+    '''
+    for i, (values, timestamp) in enumerate(zip(data.tolist(), timestamps.tolist())):
+        if format_timestamp is None:
+            values.append(timestamp)
+        else:
+            values.extend(format_timestamp(timestamp))
+        trigger = triggers.get(i)
+        if trigger is not None:
+            values.append(trigger)
+        yield values
@@ -0,0 +1,231 @@
+# This file is part of Octopus Sensing <https://octopus-sensing.nastaran-saffar.me/>
+# Copyright © Nastaran Saffaryazdi 2020-2026
+#
+# Octopus Sensing is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation,
+#  either version 3 of the License, or (at your option) any later version.
+#
+# Octopus Sensing is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Octopus Sensing.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import os
+from multiprocessing import shared_memory, resource_tracker
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+# The header of the segment is one int64: the generation counter. It is odd while
+# the device is writing to the segment.
+HEADER_SIZE = 64
+ALIGNMENT = 64
+# Arrays smaller than this are cheaper to pickle
+MIN_SHARED_ARRAY_SIZE = 1024
+
+
+class SharedArray(NamedTuple):
+    '''Location of an array in the shared memory segment'''
+    offset: int
+    shape: Tuple[int, ...]
+    dtype: str
+
+
+class SharedRealtimeData(NamedTuple):
+    '''
+    The message a device sends to the coordinator instead of the realtime data itself.
+    Large arrays in `content` (and in its nested dictionaries) are replaced by SharedArray,
+    and their data is in the `segment_name` shared memory.
+    '''
+    segment_name: str
+    generation: int
+    content: Dict[str, Any]
+
+
+def _is_shareable(value: Any) -> bool:
+    return isinstance(value, np.ndarray) and value.dtype.kind in "biufc"
+
+
+def _aligned(size: int) -> int:
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class SharedRealtimeDataWriter:
+    '''
+    Publishes realtime data of a device through a shared memory segment, so its arrays
+    don't need to be pickled. Used in the device's process, by one thread only.
+
+    Attributes
+    ----------
+
+    Example
+    -------
+    >>> writer = SharedRealtimeDataWriter()
+    >>> message = writer.publish({"data": data_array, "metadata": {...}})
+    >>> out_queue.put(pickle.dumps(message))
+    '''
+
+    def __init__(self) -> None:
+        self._segment: Optional[shared_memory.SharedMemory] = None
+        self._generation = 0
+
+    def publish(self, realtime_data: Dict[str, Any]) -> Any:
+        '''
+        Copies arrays of the realtime data to the shared memory
+
+        Parameters
+        ----------
+        realtime_data: Dict[str, Any]
+            The output of RealtimeDataDevice._get_realtime_data
+
+        Returns
+        -------
+        message: SharedRealtimeData or Dict[str, Any]
+            A small picklable message that should be sent to the coordinator.
+            If there's no large array in the data, it's the data itself.
+        '''
+        arrays: List[Tuple[int, np.ndarray]] = []
+        size = HEADER_SIZE
+
+        def share(array: np.ndarray) -> SharedArray:
+            nonlocal size
+            array = np.ascontiguousarray(array)
+            arrays.append((size, array))
+            reference = SharedArray(size, array.shape, array.dtype.str)
+            size += _aligned(array.nbytes)
+            return reference
+
+        def share_value(value: Any) -> Any:
+            if _is_shareable(value) and value.nbytes >= MIN_SHARED_ARRAY_SIZE:
+                return share(value)
+            if isinstance(value, list) and len(value) > 0 and \
+                    all(_is_shareable(item) for item in value):
+                # e.g. list of frames
+                return [share(item) for item in value]
+            if isinstance(value, dict):
+                # e.g. frames of each camera
+                return {key: share_value(item) for key, item in value.items()}
+            return value
+
+        content: Dict[str, Any] = share_value(realtime_data)
+
+        if len(arrays) == 0:
+            return realtime_data
+
+        segment = self._reserve(size)
+        header = np.ndarray((1,), dtype=np.int64, buffer=segment.buf)
+        self._generation += 1
+        header[0] = 2 * self._generation - 1
+        for offset, array in arrays:
+            np.ndarray(array.shape, dtype=array.dtype,
+                       buffer=segment.buf, offset=offset)[...] = array
+        header[0] = 2 * self._generation
+        del header
+
+        return SharedRealtimeData(segment.name, 2 * self._generation, content)
+
+    def close(self) -> None:
+        '''Releases the shared memory segment'''
+        if self._segment is not None:
+            self._segment.close()
+            self._segment.unlink()
+            self._segment = None
+
+    def _reserve(self, size: int) -> shared_memory.SharedMemory:
+        if self._segment is None or self._segment.size < size:
+            new_size = size
+            if self._segment is not None:
+                new_size = max(size, 2 * self._segment.size)
+            # The coordinator finds the new segment by its name in the next message.
+            self.close()
+            self._segment = shared_memory.SharedMemory(create=True, size=new_size)
+        return self._segment
+
+
+class SharedRealtimeDataReader:
+    '''
+    Reads messages of a SharedRealtimeDataWriter in the coordinator's process.
+
+    Attributes
+    ----------
+
+    Example
+    -------
+    >>> reader = SharedRealtimeDataReader()
+    >>> realtime_data = reader.read(pickle.loads(out_queue.get()))
+    '''
+
+    def __init__(self) -> None:
+        self._segment: Optional[shared_memory.SharedMemory] = None
+        if os.name == "posix":
+            # It should be created before starting the device, so the device's process
+            # shares it. Otherwise, each process tracks the segments separately, and the
+            # coordinator's tracker would unlink them at exit as leaked ones.
+            resource_tracker.ensure_running()
+
+    def read(self, message: Any) -> Optional[Dict[str, Any]]:
+        '''
+        Converts a message of the device to realtime data
+
+        Parameters
+        ----------
+        message: Any
+            The unpickled message
+
+        Returns
+        -------
+        realtime_data: Dict[str, Any]
+            The realtime data, with NumPy arrays in place of SharedArrays.
+            None if the device overwrote the segment while reading it.
+        '''
+        if not isinstance(message, SharedRealtimeData):
+            return message
+
+        try:
+            segment = self._attach(message.segment_name)
+        except FileNotFoundError:
+            # The device already replaced the segment with a larger one
+            return None
+        header = np.ndarray((1,), dtype=np.int64, buffer=segment.buf)
+        try:
+            if header[0] != message.generation:
+                return None
+
+            def load(reference: SharedArray) -> np.ndarray:
+                # Mapping it is zero-copy, but it should be copied once, because the
+                # device overwrites the segment on the next request.
+                return np.ndarray(reference.shape, dtype=np.dtype(reference.dtype),
+                                  buffer=segment.buf, offset=reference.offset).copy()
+
+            def load_value(value: Any) -> Any:
+                if isinstance(value, SharedArray):
+                    return load(value)
+                if isinstance(value, list) and len(value) > 0 and \
+                        all(isinstance(item, SharedArray) for item in value):
+                    return [load(item) for item in value]
+                if isinstance(value, dict):
+                    return {key: load_value(item) for key, item in value.items()}
+                return value
+
+            realtime_data: Dict[str, Any] = load_value(message.content)
+
+            # Seqlock: if the generation changed, the arrays might be half overwritten
+            if header[0] != message.generation:
+                return None
+            return realtime_data
+        finally:
+            del header
+
+    def close(self) -> None:
+        '''Detaches from the shared memory segment'''
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+    def _attach(self, name: str) -> shared_memory.SharedMemory:
+        if self._segment is None or self._segment.name != name:
+            self.close()
+            self._segment = shared_memory.SharedMemory(name=name)
+        return self._segment
@@ -15,22 +15,150 @@
 import os
 import platform
 import threading
+import multiprocessing
 import time
 import datetime
 import csv
 import math
 import struct
 import serial
-from typing import List, Optional, Any, Dict
+from typing import List, Optional, Any, Dict, Tuple
+
+import numpy as np
 
 from octopus_sensing.devices.realtime_data_device import RealtimeDataDevice
 from octopus_sensing.common.message_creators import MessageType
 from octopus_sensing.common.message import Message
 from octopus_sensing.devices.common import SavingModeEnum
+from octopus_sensing.devices.background_writer import BackgroundWriter
+from octopus_sensing.devices.ring_buffer import RingBuffer, REALTIME_BUFFER_DURATION, iter_rows
 
 # In seconds
 SERIAL_PORT_TIMEOUT = 0.6
 
+# 1byte packet type + 3byte timestamp + 2 byte X + 2 byte Y +
+# 2 byte Z + 2 byte PPG + 2 byte GSR
+FRAME_SIZE = 14
+# Packet type of data frames
+DATA_PACKET = 0x00
+
+_FRAME_DTYPE = np.dtype([("type", "u1"),
+                         ("timestamp", "u1", (3,)),
+                         ("x", "<u2"),
+                         ("y", "<u2"),
+                         ("z", "<u2"),
+                         ("ppg", "<u2"),
+                         ("gsr", "<u2")])
+assert _FRAME_DTYPE.itemsize == FRAME_SIZE
+
+# GSR range resistor values (kohm), indexed by the upper two bits of GSR
+_GSR_RESISTORS = np.array([40.2, 287.0, 1000.0, 3300.0])
+
+# Number of leading columns (type, time stamp, Acc_x, Acc_y, Acc_z) that are integers.
+# They are kept as floats in the buffer, but written to the file as integers.
+_INTEGER_COLUMNS = 5
+
+
+def _read_timestamps(buffer: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    '''Reads the 3 bytes (little-endian) timestamps at the positions'''
+    return buffer[positions].astype(np.int64) + \
+        buffer[positions + 1].astype(np.int64) * 256 + \
+        buffer[positions + 2].astype(np.int64) * 65536
+
+
+def _is_next_frame(buffer: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    '''
+    Checks if frames at `positions + FRAME_SIZE` are the next frames of the ones at
+    `positions`. Frames don't have a checksum, so it checks they are data packets and their
+    timestamps are at most one second (32768 ticks) apart.
+    '''
+    next_positions = positions + FRAME_SIZE
+    steps = (_read_timestamps(buffer, next_positions + 1) -
+             _read_timestamps(buffer, positions + 1)) % 2**24
+    return (buffer[positions] == DATA_PACKET) & (buffer[next_positions] == DATA_PACKET) & \
+        (steps > 0) & (steps <= 2**15)
+
+
+def _find_frame_start(buffer: np.ndarray) -> int:
+    '''
+    Finds the first position in the buffer that looks like the start of a data frame.
+    Returns the length of the buffer if there's no such position.
+    '''
+    candidates = np.flatnonzero(buffer == DATA_PACKET)
+    # Positions that their next frame isn't received yet are kept for the next read
+    has_next = candidates + 2 * FRAME_SIZE <= len(buffer)
+    valid = ~has_next
+    valid[has_next] = _is_next_frame(buffer, candidates[has_next])
+    candidates = candidates[valid]
+    return int(candidates[0]) if len(candidates) > 0 else len(buffer)
+
+
+def decode_frames(buffer: bytes) -> Tuple[np.ndarray, int]:
+    '''
+    Decodes all the complete data frames in the buffer at once.
+    If the buffer is out of sync (e.g. some bytes are lost), bytes are dropped until the
+    next frame.
+
+    Parameters
+    ----------
+    buffer: bytes
+        Received bytes
+
+    Returns
+    -------
+    records, consumed: Tuple[numpy.ndarray, int]
+        `records` is a 2D array of records: type, time stamp, Acc_x, Acc_y, Acc_z,
+        GSR_ohm, PPG_mv. `consumed` is the number of bytes that are decoded or dropped;
+        the rest should be kept for the next call.
+    '''
+    raw = np.frombuffer(buffer, dtype=np.uint8)
+    chunks = []
+    position = 0
+    while len(raw) - position >= FRAME_SIZE:
+        count = (len(raw) - position) // FRAME_SIZE
+        starts = np.arange(position, position + count * FRAME_SIZE, FRAME_SIZE)
+        # A frame is accepted if the next one follows it. The last one (that its next
+        # frame isn't received yet) should follow its previous frame.
+        linked = raw[starts] == DATA_PACKET
+        if count > 1:
+            is_next = _is_next_frame(raw, starts[:-1])
+            linked[:-1] &= is_next
+            linked[-1] &= is_next[-1]
+        bad = np.flatnonzero(~linked)
+        good_count = int(bad[0]) if len(bad) > 0 else count
+        if good_count > 0:
+            chunks.append(np.frombuffer(buffer, dtype=_FRAME_DTYPE, count=good_count,
+                                        offset=position))
+            position += good_count * FRAME_SIZE
+        if good_count < count:
+            # Resynchronizing
+            position += 1 + _find_frame_start(raw[position + 1:])
+
+    if len(chunks) == 0:
+        return np.empty((0, 7)), position
+    frames = np.concatenate(chunks) if len(chunks) > 1 else chunks[0]
+
+    records = np.empty((len(frames), 7))
+    records[:, 0] = frames["type"]
+    timestamp_bytes = frames["timestamp"]
+    records[:, 1] = _read_timestamps(timestamp_bytes.reshape(-1),
+                                     np.arange(0, timestamp_bytes.size, 3))
+    records[:, 2] = frames["x"]
+    records[:, 3] = frames["y"]
+    records[:, 4] = frames["z"]
+
+    gsr_raw = frames["gsr"]
+    # The upper two bits are the GSR range
+    resistors = _GSR_RESISTORS[gsr_raw >> 14]
+    # Converting GSR to kohm value
+    gsr_to_volts = (gsr_raw & 0x3fff) * (3.0/4095.0)
+    with np.errstate(divide="ignore"):
+        records[:, 5] = resistors/((gsr_to_volts / 0.5) - 1.0)
+
+    # Converting PPG to milliVolt value
+    records[:, 6] = frames["ppg"] * (3000.0/4095.0)
+    return records, position
+
 class Shimmer3Streaming(RealtimeDataDevice):
     '''
     Streams and Records Shimmer3 data.
@@ -114,11 +242,14 @@ class Shimmer3Streaming(RealtimeDataDevice):
         super().__init__(**kwargs)
 
         self._saving_mode = saving_mode
-        self._stream_data: List[float] = []
         self._sampling_rate = sampling_rate
+        # type, time stamp, Acc_x, Acc_y, Acc_z, GSR_ohm, PPG_mv
+        self._stream_data = RingBuffer(7, sampling_rate * REALTIME_BUFFER_DURATION)
         self._trigger: Optional[str] = None
         self._break_loop = False
         self._loop_thread: Optional[threading.Thread] = None
+        self._writer: Optional[BackgroundWriter] = None
+        self._handled_messages = multiprocessing.Value('Q', 0)
         self.output_path = self._make_output_path()
         self._state = ""
         if serial_port is None:
@@ -227,9 +358,10 @@ class Shimmer3Streaming(RealtimeDataDevice):
         self._loop_thread = threading.Thread(target=self._stream_loop)
         self._loop_thread.start()
 
-        while True:
-            message = self.message_queue.get()
+        self._writer = BackgroundWriter("{0} writer".format(self.name))
+        self._writer.start()
 
+        for message in self._receive_messages(self._writer):
             if not self._loop_thread.is_alive():
                 print(f"[{self.name}] Shimmer3: Streaming loop is dead. Terminating.")
                 break
@@ -257,7 +389,6 @@ class Shimmer3Streaming(RealtimeDataDevice):
                                                          self._experiment_id,
                                                          message.stimulus_id)
                         self._save_to_file(file_name)
-                        self._stream_data = []
                     else:
                         print("Shimmer stop")
                         self._experiment_id = message.experiment_id
@@ -271,7 +402,6 @@ class Shimmer3Streaming(RealtimeDataDevice):
                                                  self.name,
                                                  self._experiment_id)
                     self._save_to_file(file_name)
-                    self._stream_data = []
             elif message.type == MessageType.TERMINATE:
                 if self._saving_mode == SavingModeEnum.CONTINIOUS_SAVING_MODE:
                     file_name = \
@@ -281,6 +411,8 @@ class Shimmer3Streaming(RealtimeDataDevice):
                     self._save_to_file(file_name)
                 break
 
+        self._writer.submit(self._acknowledge_message)
+        self._writer.stop()
         self._break_loop = True
         self._loop_thread.join()
 
@@ -302,78 +434,34 @@ class Shimmer3Streaming(RealtimeDataDevice):
         '''
         Reads incoming data
         '''
-        ddata = bytes("", 'utf-8')
-        numbytes = 0
-        # 1byte packet type + 3byte timestamp + 2 byte X + 2 byte Y +
-        # 2 byte Z + 2 byte PPG + 2 byte GSR
-        framesize = 14
-
+        buffer = b""
         try:
             while True:
-                while numbytes < framesize:
-                    ddata += self._serial.read(framesize)
-                    numbytes = len(ddata)
-                    if self._break_loop:
-                        break
+                # Reading all the received bytes at once. If nothing is received yet,
+                # waiting for at least one frame.
+                buffer += self._serial.read(max(self._serial.in_waiting, FRAME_SIZE))
+                record_time = time.time()
 
                 if self._break_loop:
                     self._stop_shimmer()
                     break
 
-                data = ddata[0:framesize]
-                ddata = ddata[framesize:]
-                numbytes = len(ddata)
-
-                # read basic packet information
-                (packettype) = struct.unpack('B', data[0:1])
-                (timestamp0, timestamp1, timestamp2) = \
-                    struct.unpack('BBB', data[1:4])
-
-                # read packet payload
-                (x, y, z, PPG_raw, GSR_raw) = \
-                    struct.unpack('HHHHH', data[4:framesize])
-                record_time = datetime.datetime.now()
+                records, consumed = decode_frames(buffer)
+                buffer = buffer[consumed:]
+                if len(records) == 0:
+                    continue
 
-                # get current GSR range resistor value
-                data_range = ((GSR_raw >> 14) & 0xff)  # upper two bits
-                if data_range == 0:
-                    rf = 40.2   # kohm
-                elif data_range == 1:
-                    rf = 287.0  # kohm
-                elif data_range == 2:
-                    rf = 1000.0  # kohm
-                elif data_range == 3:
-                    rf = 3300.0  # kohm
+                # Records are received at the sampling rate, with the last one just now
+                timestamps = \
+                    record_time - np.arange(len(records) - 1, -1, -1) / self._sampling_rate
 
-                # convert GSR to kohm value
-                gsr_to_volts = (GSR_raw & 0x3fff) * (3.0/4095.0)
-                GSR_ohm = rf/((gsr_to_volts / 0.5) - 1.0)
-
-                # convert PPG to milliVolt value
-                PPG_mv = PPG_raw * (3000.0/4095.0)
-
-                timestamp = timestamp0 + timestamp1*256 + timestamp2*65536
-
-                # print([packettype[0], timestamp, GSR_ohm, PPG_mv] + self._trigger)
-
-                if self._trigger is not None:
+                trigger = self._trigger
+                triggers = None
+                if trigger is not None:
                     print("Shimmer trigger")
-                    row = [packettype[0],
-                           timestamp,
-                           x, y, z,
-                           GSR_ohm,
-                           PPG_mv,
-                           record_time,
-                           self._trigger]
                     self._trigger = None
-                else:
-                    row = [packettype[0],
-                           timestamp,
-                           x, y, z,
-                           GSR_ohm,
-                           PPG_mv,
-                           record_time]
-                self._stream_data.append(row)
+                    triggers = {0: trigger}
+                self._stream_data.extend(records, timestamps, triggers)
 
         except KeyboardInterrupt:
             self._stop_shimmer()
@@ -389,6 +477,11 @@ class Shimmer3Streaming(RealtimeDataDevice):
         print("All done")
 
     def _save_to_file(self, file_name):
+        # Hands over the unsaved data to the writer thread, and returns immediately
+        assert self._writer is not None
+        self._writer.submit_unsaved(self._stream_data, self._write_to_file, file_name)
+
+    def _write_to_file(self, file_name, data, timestamps, triggers):
         print("Saving {0} to file {1}".format(self._name, file_name))
         if not os.path.exists(file_name):
             csv_file = open(file_name, 'a')
@@ -404,12 +497,19 @@ class Shimmer3Streaming(RealtimeDataDevice):
 
         with open(file_name, 'a') as csv_file:
             writer = csv.writer(csv_file)
-            for row in self._stream_data:
+            for row in iter_rows(data, timestamps, triggers, self._format_timestamp):
+                row[:_INTEGER_COLUMNS] = [int(value) for value in row[:_INTEGER_COLUMNS]]
                 writer.writerow(row)
-                csv_file.flush()
+            csv_file.flush()
         print("Saving {0} to file {1} is done".format(self._name, file_name))
 
-    def _get_realtime_data(self, duration: int) -> Dict[str, Any]:
+    @staticmethod
+    def _format_timestamp(timestamp: float) -> List[Any]:
+        '''Record time is written as a datetime, e.g. 2021-06-03 12:10:45.153271'''
+        return [datetime.datetime.fromtimestamp(timestamp)]
+
+    def _get_realtime_data(self, duration: int,
+                           since: Optional[int] = None) -> Dict[str, Any]:
         '''
         Returns n seconds (duration) of latest collected data for monitoring/visualizing or
         realtime processing purposes.
@@ -419,20 +519,33 @@ class Shimmer3Streaming(RealtimeDataDevice):
         duration: int
             A time duration in seconds for getting the latest recorded data in realtime
 
+        since: int, default: None
+            If it is given, only the records with a sequence number greater than or equal to
+            it are returned. It is usually the `cursor` of the previous call.
+
         Returns
         -------
         data: Dict[str, Any]
-            The keys are `data` and `metadata`.
-            `data` is a list of records, or empty list if there's nothing.
+            The keys are `data`, `timestamps`, `triggers` and `metadata`.
+            `data` is a 2D array of records (records * channels).
+            `timestamps` is an array of records' time.
+            `triggers` is a dictionary of record's index to its trigger.
+            `sequence` is the sequence number of the first record, and `cursor` is the
+            sequence number of the next record.
             `metadata` is a dictionary of device metadata including `sampling_rate` and `type`
         '''
         # Last recorded data
-        data = self._stream_data[-1 * duration * self._sampling_rate:]
+        data, timestamps, triggers, sequence = \
+            self._stream_data.get_since(since or 0, duration * self._sampling_rate)
         metadata = {"sampling_rate": self._sampling_rate,
                     "channels": ["type", "time stamp", "Acc_x", "Acc_y", "Acc_z",
-                                 "GSR_ohm", "PPG_mv", "time", "trigger"],
+                                 "GSR_ohm", "PPG_mv"],
                     "type": self.__class__.__name__}
         realtime_data = {"data": data,
+                         "timestamps": timestamps,
+                         "triggers": triggers,
+                         "sequence": sequence,
+                         "cursor": sequence + len(data),
                          "metadata": metadata}
         return realtime_data
 
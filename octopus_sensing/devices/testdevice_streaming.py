@@ -17,11 +17,14 @@ import os
 import threading
 import csv
 import random
-from typing import List, Optional, Dict, Any
+import multiprocessing
+from typing import Optional, Dict, Any
 
 from octopus_sensing.common.message_creators import MessageType
 from octopus_sensing.devices.realtime_data_device import RealtimeDataDevice
 from octopus_sensing.devices.common import SavingModeEnum
+from octopus_sensing.devices.ring_buffer import RingBuffer, REALTIME_BUFFER_DURATION, iter_rows
+from octopus_sensing.devices.background_writer import BackgroundWriter
 
 class TestDeviceStreaming(RealtimeDataDevice):
     '''
@@ -70,27 +73,29 @@ class TestDeviceStreaming(RealtimeDataDevice):
         super().__init__(name=name, output_path=output_path)
 
         self._saving_mode = saving_mode
-        self._stream_data: List[float] = []
         self.sampling_rate = sampling_rate
+        self._stream_data = RingBuffer(2, sampling_rate * REALTIME_BUFFER_DURATION)
         self._terminate = False
         self._trigger = None
         self._experiment_id = None
         self.__loop_thread: Optional[threading.Thread] = None
+        self._writer: Optional[BackgroundWriter] = None
+        self._handled_messages = multiprocessing.Value('Q', 0)
 
         self.output_path = os.path.join(self.output_path, self.name)
         os.makedirs(self.output_path, exist_ok=True)
         self._state = ""
 
     def __get_sample(self):
-        return [random.randint(0, 100), random.randint(0, 50), time.time()]
+        return [random.randint(0, 100), random.randint(0, 50)]
 
     def _run(self):
         self.__loop_thread = threading.Thread(target=self._stream_loop)
         self.__loop_thread.start()
+        self._writer = BackgroundWriter("{0} writer".format(self.name))
+        self._writer.start()
 
-        while True:
-            message = self.message_queue.get()
-
+        for message in self._receive_messages(self._writer):
             if not self.__loop_thread.is_alive():
                 print("TestDevice streaming: The streaming thread is dead. Terminating.")
                 break
@@ -119,7 +124,6 @@ class TestDeviceStreaming(RealtimeDataDevice):
                                                         self._experiment_id,
                                                         message.stimulus_id)
                         self._save_to_file(file_name)
-                        self._stream_data = []
                     else:
                         self._experiment_id = message.experiment_id
                         self.__set_trigger(message)
@@ -132,7 +136,6 @@ class TestDeviceStreaming(RealtimeDataDevice):
                                                  self.name,
                                                  self._experiment_id)
                     self._save_to_file(file_name)
-                    self._stream_data = []
             elif message.type == MessageType.TERMINATE:
                 self._terminate = True
                 if self._saving_mode == SavingModeEnum.CONTINIOUS_SAVING_MODE:
@@ -143,17 +146,17 @@ class TestDeviceStreaming(RealtimeDataDevice):
                     self._save_to_file(file_name)
                 break
 
+        self._writer.submit(self._acknowledge_message)
+        self._writer.stop()
         self.__loop_thread.join()
 
     def _stream_loop(self):
         while True:
             if self._terminate is True:
                 break
-            data = self.__get_sample()
-            if self._trigger is not None:
-                data.append(self._trigger)
-                self._trigger = None
-            self._stream_data.append(data)
+            trigger = self._trigger
+            self._trigger = None
+            self._stream_data.append(self.__get_sample(), time.time(), trigger)
             time.sleep(1/self.sampling_rate)
 
 
@@ -172,11 +175,15 @@ class TestDeviceStreaming(RealtimeDataDevice):
                                  str(message.stimulus_id).zfill(2))
 
     def _save_to_file(self, file_name):
+        # Hands over the unsaved data to the writer thread, and returns immediately
+        assert self._writer is not None
+        self._writer.submit_unsaved(self._stream_data, self._write_to_file, file_name)
+
+    def _write_to_file(self, file_name, data, timestamps, triggers):
         print("Saving {0} to file {1}".format(self._name, file_name))
         with open(file_name, 'a') as csv_file:
             writer = csv.writer(csv_file)
-            for row in self._stream_data:
-                writer.writerow(row)
+            writer.writerows(iter_rows(data, timestamps, triggers))
             csv_file.flush()
         print("Saving {0} to file {1} is done".format(self._name, file_name))
 
@@ -193,7 +200,8 @@ class TestDeviceStreaming(RealtimeDataDevice):
         '''
         return ["channel_1", "channel_2", "timestamp"]
 
-    def _get_realtime_data(self, duration: int) -> Dict[str, Any]:
+    def _get_realtime_data(self, duration: int,
+                           since: Optional[int] = None) -> Dict[str, Any]:
         '''
         Returns n seconds (duration) of latest collected data for monitoring/visualizing or
         realtime processing purposes.
@@ -203,21 +211,34 @@ class TestDeviceStreaming(RealtimeDataDevice):
         duration: int
             A time duration in seconds for getting the latest recorded data in realtime
 
+        since: int, default: None
+            If it is given, only the records with a sequence number greater than or equal to
+            it are returned. It is usually the `cursor` of the previous call.
+
         Returns
         -------
         data: Dict[str, Any]
-            The keys are `data` and `metadata`.
-            `data` is a list of records, or empty list if there's nothing.
+            The keys are `data`, `timestamps`, `triggers` and `metadata`.
+            `data` is a 2D array of records (records * channels).
+            `timestamps` is an array of records' time.
+            `triggers` is a dictionary of record's index to its trigger.
+            `sequence` is the sequence number of the first record, and `cursor` is the
+            sequence number of the next record.
             `metadata` is a dictionary of device metadata including `sampling_rate` and `channels` and `type`
 
         '''
         # Last seconds of data
-
-        data = self._stream_data[-1 * duration * self.sampling_rate:]
+        data, timestamps, triggers, sequence = \
+            self._stream_data.get_since(since or 0, duration * self.sampling_rate)
         metadata = {"sampling_rate": self.sampling_rate,
-                    "channels": self.get_channels(),
+                    # Timestamps are in a separate array
+                    "channels": self.get_channels()[:-1],
                     "type": self.__class__.__name__}
 
         realtime_data = {"data": data,
-                  "metadata": metadata}
+                         "timestamps": timestamps,
+                         "triggers": triggers,
+                         "sequence": sequence,
+                         "cursor": sequence + len(data),
+                         "metadata": metadata}
         return realtime_data
@@ -15,6 +15,7 @@
 import time
 import os
 import threading
+import multiprocessing
 import csv
 import numpy as np
 from typing import List, Optional, Dict, Any
@@ -22,6 +23,8 @@ from typing import List, Optional, Dict, Any
 from octopus_sensing.common.message_creators import MessageType
 from octopus_sensing.devices.realtime_data_device import RealtimeDataDevice
 from octopus_sensing.devices.common import SavingModeEnum
+from octopus_sensing.devices.background_writer import BackgroundWriter
+from octopus_sensing.devices.ring_buffer import RingBuffer, REALTIME_BUFFER_DURATION, iter_rows
 
 import libtobiiglassesctrl
 
@@ -108,8 +111,9 @@ class TobiiGlassesStreaming(RealtimeDataDevice):
         super().__init__(name=name, output_path=output_path)
 
         self._saving_mode = saving_mode
-        self._stream_data: List[float] = []
         self.sampling_rate = sampling_rate
+        # Missing values are stored as NaN
+        self._stream_data = RingBuffer(36, sampling_rate * REALTIME_BUFFER_DURATION)
 
         self._board = None
         self._device_ip = device_ip
@@ -117,6 +121,8 @@ class TobiiGlassesStreaming(RealtimeDataDevice):
         self._trigger = None
         self._experiment_id = None
         self.__loop_thread: Optional[threading.Thread] = None
+        self._writer: Optional[BackgroundWriter] = None
+        self._handled_messages = multiprocessing.Value('Q', 0)
         self._controller = None
         # Used to inject mocked controller in tests.
         self._controller_class = libtobiiglassesctrl.TobiiGlassesController
@@ -133,9 +139,10 @@ class TobiiGlassesStreaming(RealtimeDataDevice):
         self.__loop_thread = threading.Thread(target=self._stream_loop)
         self.__loop_thread.start()
 
-        while True:
-            message = self.message_queue.get()
+        self._writer = BackgroundWriter("{0} writer".format(self.name))
+        self._writer.start()
 
+        for message in self._receive_messages(self._writer):
             if not self.__loop_thread.is_alive():
                 print("TobiiGlasses streaming: The streaming thread is dead. Terminating.")
                 break
@@ -164,7 +171,6 @@ class TobiiGlassesStreaming(RealtimeDataDevice):
                                                         self._experiment_id,
                                                         message.stimulus_id)
                         self._save_to_file(file_name)
-                        self._stream_data = []
                     else:
                         self._experiment_id = message.experiment_id
                         self.__set_trigger(message)
@@ -177,7 +183,6 @@ class TobiiGlassesStreaming(RealtimeDataDevice):
                                                  self.name,
                                                  self._experiment_id)
                     self._save_to_file(file_name)
-                    self._stream_data = []
             elif message.type == MessageType.TERMINATE:
                 self._terminate = True
                 if self._saving_mode == SavingModeEnum.CONTINIOUS_SAVING_MODE:
@@ -188,6 +193,8 @@ class TobiiGlassesStreaming(RealtimeDataDevice):
                     self._save_to_file(file_name)
                 break
 
+        self._writer.submit(self._acknowledge_message)
+        self._writer.stop()
         self._controller.stop_streaming()
         self._controller.close()
         self.__loop_thread.join()
@@ -198,12 +205,10 @@ class TobiiGlassesStreaming(RealtimeDataDevice):
             if self._terminate is True:
                 break
             data = self.__safe_get(self._controller.get_data())
-            
-            if self._trigger is not None:
-                data.append(self._trigger)
-                self._trigger = None
 
-            self._stream_data.append(np.array(data))
+            trigger = self._trigger
+            self._trigger = None
+            self._stream_data.append(np.array(data, dtype=np.float64), time.time(), trigger)
             time.sleep(1/self.sampling_rate)
 
     def __set_trigger(self, message):
@@ -221,6 +226,11 @@ class TobiiGlassesStreaming(RealtimeDataDevice):
                                  str(message.stimulus_id).zfill(2))
 
     def _save_to_file(self, file_name):
+        # Hands over the unsaved data to the writer thread, and returns immediately
+        assert self._writer is not None
+        self._writer.submit_unsaved(self._stream_data, self._write_to_file, file_name)
+
+    def _write_to_file(self, file_name, data, timestamps, triggers):
         print("Saving {0} to file {1}".format(self._name, file_name))
         header = ["ac_ts", "ac_x", "ac_y", "ac_z",
                   "gy_ts", "gy_x", "gy_y", "gy_z",
@@ -241,13 +251,15 @@ class TobiiGlassesStreaming(RealtimeDataDevice):
                 writer.writerow(header)
                 csv_file.flush()
             print("TobiiGlassesStreaming: file already exists, appending data")
-            for row in self._stream_data:
-                writer.writerow(row)
-                csv_file.flush()
+            for row in iter_rows(data, timestamps, triggers):
+                # Missing values are written as empty cells
+                writer.writerow(["" if value != value else value for value in row])
+            csv_file.flush()
         print("Saving {0} to file {1} is done".format(self._name, file_name))
 
 
-    def _get_realtime_data(self, duration: int) -> Dict[str, Any]:
+    def _get_realtime_data(self, duration: int,
+                           since: Optional[int] = None) -> Dict[str, Any]:
         '''
         Returns n seconds (duration) of latest collected data for monitoring/visualizing or
         realtime processing purposes.
@@ -257,22 +269,34 @@ class TobiiGlassesStreaming(RealtimeDataDevice):
         duration: int
             A time duration in seconds for getting the latest recorded data in realtime
 
+        since: int, default: None
+            If it is given, only the records with a sequence number greater than or equal to
+            it are returned. It is usually the `cursor` of the previous call.
+
         Returns
         -------
         data: Dict[str, Any]
-            The keys are `data` and `metadata`.
-            `data` is a list of records, or empty list if there's nothing.
+            The keys are `data`, `timestamps`, `triggers` and `metadata`.
+            `data` is a 2D array of records (records * channels). Missing values are NaN.
+            `timestamps` is an array of records' time.
+            `triggers` is a dictionary of record's index to its trigger.
+            `sequence` is the sequence number of the first record, and `cursor` is the
+            sequence number of the next record.
             `metadata` is a dictionary of device metadata including `sampling_rate` and `channels` and `type`
 
         '''
         # Last seconds of data
-
-        data = self._stream_data[-1 * duration * self.sampling_rate:]
+        data, timestamps, triggers, sequence = \
+            self._stream_data.get_since(since or 0, duration * self.sampling_rate)
         metadata = {"sampling_rate": self.sampling_rate,
                     "type": self.__class__.__name__}
 
         realtime_data = {"data": data,
-                  "metadata": metadata}
+                         "timestamps": timestamps,
+                         "triggers": triggers,
+                         "sequence": sequence,
+                         "cursor": sequence + len(data),
+                         "metadata": metadata}
         return realtime_data
 
 
@@ -288,48 +312,35 @@ class TobiiGlassesStreaming(RealtimeDataDevice):
         Returns
         -------
         flat_data: list
-            A flat list of values extracted from the nested dictionary.
+            A flat list of 36 values extracted from the nested dictionary.
         '''
+        def sensor(parent: Any, name: str, keys: List[str], sizes: List[int]) -> List[Any]:
+            # Missing sensors are filled with None, so all records have the same columns.
+            item = parent.get(name) if isinstance(parent, dict) else None
+            if not isinstance(item, dict):
+                item = {}
+            values: List[Any] = [item.get("ts", None)]
+            for key, size in zip(keys, sizes):
+                value = item.get(key, None)
+                if size == 1:
+                    values.append(value)
+                elif isinstance(value, list) and len(value) == size:
+                    values.extend(value)
+                else:
+                    values.extend([None] * size)
+            return values
+
         flat_data = []
-        mems = data.get("mems", [None]*8)
-        if isinstance(mems, dict):
-            mems_ac = mems.get("ac", [None]*4)
-            if isinstance(mems_ac, dict):
-                flat_data.extend([mems_ac.get("ts", None), *mems_ac.get("ac", [None]*3)])
-            mems_gy = mems.get("gy", [None]*4)
-            if isinstance(mems_gy, dict):
-                flat_data.extend([mems_gy.get("ts", None), *mems_gy.get("gy", [None]*3)])
-        left_eye = data.get("left_eye", [None]*10)
-        if isinstance(left_eye, dict):
-            left_pc = left_eye.get("pc", [None]*4)
-            if isinstance(left_pc, dict):
-                flat_data.extend([left_pc.get("ts", None), *left_pc.get("pc", [None]*3)])
-
-            left_pd = left_eye.get("pd", [None, None])
-            flat_data.extend([left_pd.get("ts", None), left_pd.get("pd", None)])
-
-            left_gd = left_eye.get("gd", [None]*4)
-            if isinstance(left_gd, dict):
-                flat_data.extend([left_gd.get("ts", None), *left_gd.get("gd", [None]*3)]) 
-        right_eye = data.get("right_eye", [None]*10)
-        if isinstance(right_eye, dict):
-            right_pc = right_eye.get("pc", [None]*4)
-            if isinstance(right_pc, dict):
-                flat_data.extend([right_pc.get("ts", None), *right_pc.get("pc", [None]*3)])
-
-            right_pd = right_eye.get("pd", [None, None])
-            flat_data.extend([right_pd.get("ts", None), right_pd.get("pd", None)])
-
-            right_gd = right_eye.get("gd", [None]*4)
-            if isinstance(right_gd, dict):
-                flat_data.extend([right_gd.get("ts", None), *right_gd.get("gd", [None]*3)])
-        gp = data.get("gp", [None]*4)
-        if isinstance(gp, dict):
-            flat_data.extend([gp.get("ts", None), gp.get("l", None), *gp.get("gp", [None]*2)])
-        gp3 = data.get("gp3", [None]*4)
-        if isinstance(gp3, dict):
-            flat_data.extend([gp3.get("ts", None), *gp3.get("gp3", [None]*3)])
-        flat_data.append(time.time())
+        mems = data.get("mems", None)
+        flat_data.extend(sensor(mems, "ac", ["ac"], [3]))
+        flat_data.extend(sensor(mems, "gy", ["gy"], [3]))
+        for eye in ("left_eye", "right_eye"):
+            eye_data = data.get(eye, None)
+            flat_data.extend(sensor(eye_data, "pc", ["pc"], [3]))
+            flat_data.extend(sensor(eye_data, "pd", ["pd"], [1]))
+            flat_data.extend(sensor(eye_data, "gd", ["gd"], [3]))
+        flat_data.extend(sensor(data, "gp", ["l", "gp"], [1, 2]))
+        flat_data.extend(sensor(data, "gp3", ["gp3"], [3]))
 
         return flat_data
     
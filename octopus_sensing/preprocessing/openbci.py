@@ -24,7 +24,7 @@ except ImportError:
     print()
     raise
 
-from octopus_sensing.preprocessing.utils import load_all_trials, resample, load_all_samples
+from octopus_sensing.preprocessing.utils import iter_trials, resample, load_all_samples
 from octopus_sensing.devices.common import SavingModeEnum
 
 
@@ -99,30 +99,30 @@ def openbci_preprocess(input_path: str, file_name: str, output_path: str,
         data_frame.to_csv(output_file_path, index=False)
 
     elif saving_mode == SavingModeEnum.CONTINIOUS_SAVING_MODE:
+        # Trials are read one by one, so only one of them is kept in memory
         if len(channels) == 8:
-            trials_data, trials_times, triger_list = \
-                load_all_trials(os.path.join(input_path, file_name),  # File path
-                                (0, 8),  # channel columns
-                                12,  # timestamp column
-                                13,  # triger column
-                                '%H:%M:%S.%f')  # timestamp format
+            trials = \
+                iter_trials(os.path.join(input_path, file_name),  # File path
+                            (0, 8),  # channel columns
+                            13,  # triger column
+                            time_stamp_col=12,
+                            time_format='%H:%M:%S.%f')
         elif len(channels) == 16:
-            trials_data, trials_times, triger_list = \
-                load_all_trials(os.path.join(input_path, file_name),  # File path
-                                (0, 16),  # channel columns
-                                20,  # timestamp column
-                                21,  # triger column
-                                '%H:%M:%S.%f')  # timestamp format
-        print("len trials ***************", len(trials_data))
-        i = 0
-        for trial in trials_data:
+            trials = \
+                iter_trials(os.path.join(input_path, file_name),  # File path
+                            (0, 16),  # channel columns
+                            21,  # triger column
+                            time_stamp_col=20,
+                            time_format='%H:%M:%S.%f')
+        for trial_number, trial, times in trials:
             output_file_path = \
                 "{0}/{1}-{2}.csv".format(output_path,
                                          file_name[:-4],  # Removing .csv from file_name
-                                         str(triger_list[i]).zfill(2))
+                                         str(trial_number).zfill(2))
             print("output_file_path", output_file_path)
+            assert times is not None
             resampled_data = \
-                resample(trial, trials_times[i], sampling_rate)
+                resample(trial, times, sampling_rate)
 
             if signal_preprocess is True:
                 preprocessed_data = \
@@ -136,7 +136,6 @@ def openbci_preprocess(input_path: str, file_name: str, output_path: str,
 
             # save the dataframe as a csv file
             data_frame.to_csv(output_file_path, index=False)
-            i += 1
     else:
         raise Exception("Saving mode is incorrect")
 
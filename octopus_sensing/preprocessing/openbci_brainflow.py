@@ -23,7 +23,7 @@ except ImportError:
     raise
 
 from octopus_sensing.preprocessing.openbci import clean_eeg
-from octopus_sensing.preprocessing.utils import load_all_samples_without_time, load_all_trials_without_time
+from octopus_sensing.preprocessing.utils import load_all_samples_without_time, iter_trials
 from octopus_sensing.devices.common import SavingModeEnum
 
 def openbci_brainflow_preprocess(input_path: str, file_name: str, output_path: str,
@@ -92,24 +92,26 @@ def openbci_brainflow_preprocess(input_path: str, file_name: str, output_path: s
         data_frame.to_csv(output_file_path, index=False)
 
     elif saving_mode == SavingModeEnum.CONTINIOUS_SAVING_MODE:
+        # Trials are read one by one, so only one of them is kept in memory
         if len(channels) == 8:
-            trials_data, triger_list = \
-                load_all_trials_without_time(os.path.join(input_path, file_name),  # File path
-                                             (1, 9),  # channel columns
-                                             26)  # triger column
+            trials = \
+                iter_trials(os.path.join(input_path, file_name),  # File path
+                            (1, 9),  # channel columns
+                            26,  # triger column
+                            has_header=False)
 
         elif len(channels) == 16:
-            trials_data, triger_list = \
-                load_all_trials_without_time(os.path.join(input_path, file_name),  # File path
-                                            (1, 17),  # channel columns
-                                            34)  # triger column
+            trials = \
+                iter_trials(os.path.join(input_path, file_name),  # File path
+                            (1, 17),  # channel columns
+                            34,  # triger column
+                            has_header=False)
 
-        i = 0
-        for trial in trials_data:
+        for trial_number, trial, _ in trials:
             output_file_path = \
                 "{0}/{1}-{2}.csv".format(output_path,
                                          file_name[:-4],  # Removing .csv from file_name
-                                         str(triger_list[i]).zfill(2))
+                                         str(trial_number).zfill(2))
             print("output_file_path", output_file_path)
             data = trial[:int(len(trial)/sampling_rate)*sampling_rate]
 
@@ -125,6 +127,5 @@ def openbci_brainflow_preprocess(input_path: str, file_name: str, output_path: s
 
             # save the dataframe as a csv file
             data_frame.to_csv(output_file_path, index=False)
-            i += 1
     else:
         raise Exception("Saving mode is incorrect")
@@ -13,8 +13,12 @@
 # If not, see <https://www.gnu.org/licenses/>.
 
 import os
+import sys
+import time
 import pathlib
-from typing import List, Dict
+import traceback
+import concurrent.futures
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
 from octopus_sensing.device_coordinator import DeviceCoordinator
 from octopus_sensing.devices.openbci_streaming import OpenBCIStreaming
 from octopus_sensing.devices import BrainFlowOpenBCIStreaming
@@ -24,10 +28,20 @@ from octopus_sensing.preprocessing.openbci_brainflow import openbci_brainflow_pr
 from octopus_sensing.preprocessing.shimmer3 import shimmer3_preprocess
 
 
+class PreprocessingJob(NamedTuple):
+    '''One file to preprocess. `function` is called with `args` and `kwargs`.'''
+    name: str
+    function: Callable[..., Any]
+    args: Tuple[Any, ...]
+    kwargs: Dict[str, Any]
+
+
 def preprocess_devices(device_coordinator: DeviceCoordinator, output_path: str,
                        openbci_sampling_rate: int = 128,
                        shimmer3_sampling_rate: int = 128,
-                       signal_preprocess: bool = True):
+                       signal_preprocess: bool = True,
+                       workers: int = 1,
+                       max_pending_jobs: Optional[int] = None):
     '''
     Preprocees recorded files for all devices that are added to device_coordinator and has a 
     preprocessing module. Some devices do not have any preprocessing, so this function will ignore them
@@ -45,8 +59,23 @@ def preprocess_devices(device_coordinator: DeviceCoordinator, output_path: str,
     
     shimmer3_sampling_rate: int
         New sampling rate for shimmer3 resampling
+
+    workers: int, default: 1
+        Number of processes that preprocess files in parallel. If it is 1, files are
+        preprocessed one by one in the calling process.
+
+    max_pending_jobs: int, default: None
+        The maximum number of files that are submitted to the workers but not finished
+        yet. It limits the memory usage when there are many files. The default is twice
+        the number of workers.
+
+    Notes
+    -----
+    An error in preprocessing a file doesn't stop the other files. Errors are printed,
+    and a RuntimeError listing the failed files is raised at the end.
     '''
     print("Start preprocessing ....")
+    jobs: List[PreprocessingJob] = []
     devices = device_coordinator.get_devices()
     for device in devices:
         if isinstance(device, OpenBCIStreaming):
@@ -63,11 +92,13 @@ def preprocess_devices(device_coordinator: DeviceCoordinator, output_path: str,
             if not os.path.exists(device_output_path):
                 os.mkdir(device_output_path)
             for file_name in file_names:
-                openbci_preprocess(input_path, file_name, device_output_path,
-                                   device.get_channels(),
-                                   saving_mode=device.get_saving_mode(),
-                                   sampling_rate=openbci_sampling_rate,
-                                   signal_preprocess=signal_preprocess)
+                jobs.append(PreprocessingJob(
+                    os.path.join(device.get_name(), file_name),
+                    openbci_preprocess,
+                    (input_path, file_name, device_output_path, device.get_channels()),
+                    dict(saving_mode=device.get_saving_mode(),
+                         sampling_rate=openbci_sampling_rate,
+                         signal_preprocess=signal_preprocess)))
         elif isinstance(device, BrainFlowOpenBCIStreaming):
             device_output_path = os.path.join(output_path, device.get_name())
             print("device_output_path", device_output_path)
@@ -82,11 +113,13 @@ def preprocess_devices(device_coordinator: DeviceCoordinator, output_path: str,
             if not os.path.exists(device_output_path):
                 os.mkdir(device_output_path)
             for file_name in file_names:
-                openbci_brainflow_preprocess(input_path, file_name, device_output_path,
-                                             device.get_channels(),
-                                             saving_mode=device.get_saving_mode(),
-                                             sampling_rate=openbci_sampling_rate,
-                                             signal_preprocess=signal_preprocess)
+                jobs.append(PreprocessingJob(
+                    os.path.join(device.get_name(), file_name),
+                    openbci_brainflow_preprocess,
+                    (input_path, file_name, device_output_path, device.get_channels()),
+                    dict(saving_mode=device.get_saving_mode(),
+                         sampling_rate=openbci_sampling_rate,
+                         signal_preprocess=signal_preprocess)))
         elif isinstance(device, Shimmer3Streaming):
             device_output_path = os.path.join(output_path, device.get_name())
             if not os.path.exists(device_output_path):
@@ -100,11 +133,14 @@ def preprocess_devices(device_coordinator: DeviceCoordinator, output_path: str,
             print("preprocess shimmer input_path", input_path)
             print("preprocess shimmer device_output_path", device_output_path)
             for file_name in file_names:
-                shimmer3_preprocess(input_path, file_name, device_output_path,
-                                    saving_mode=device.get_saving_mode(),
-                                    sampling_rate=shimmer3_sampling_rate,
-                                    signal_preprocess=signal_preprocess)
-    print("Preprocessing done")
+                jobs.append(PreprocessingJob(
+                    os.path.join(device.get_name(), file_name),
+                    shimmer3_preprocess,
+                    (input_path, file_name, device_output_path),
+                    dict(saving_mode=device.get_saving_mode(),
+                         sampling_rate=shimmer3_sampling_rate,
+                         signal_preprocess=signal_preprocess)))
+    run_preprocessing_jobs(jobs, workers=workers, max_pending_jobs=max_pending_jobs)
 
 
 def preprocess_devices_by_path(devices_path: Dict[str, str], output_path: str,
@@ -112,7 +148,9 @@ def preprocess_devices_by_path(devices_path: Dict[str, str], output_path: str,
                         "C4", "T4", "T5", "P3", "P4", "T6", "O1", "O2"],
                        openbci_sampling_rate: int = 128,
                        shimmer3_sampling_rate: int = 128,
-                       signal_preprocess: bool = True):
+                       signal_preprocess: bool = True,
+                       workers: int = 1,
+                       max_pending_jobs: Optional[int] = None):
     '''
     Gets a list of path to the recorded data from different devices and preprocess them if they have  
     preprocessing module. Some devices do not have any preprocessing, so this function will ignore them
@@ -134,9 +172,24 @@ def preprocess_devices_by_path(devices_path: Dict[str, str], output_path: str,
     
     shimmer3_sampling_rate: int
         New sampling rate for shimmer3 resampling
+
+    workers: int, default: 1
+        Number of processes that preprocess files in parallel. If it is 1, files are
+        preprocessed one by one in the calling process.
+
+    max_pending_jobs: int, default: None
+        The maximum number of files that are submitted to the workers but not finished
+        yet. It limits the memory usage when there are many files. The default is twice
+        the number of workers.
+
+    Notes
+    -----
+    An error in preprocessing a file doesn't stop the other files. Errors are printed,
+    and a RuntimeError listing the failed files is raised at the end.
     '''
 
     print("Start preprocessing ....")
+    jobs: List[PreprocessingJob] = []
     for device, input_path in devices_path.items():
         print(device, input_path)
         if device == "openbci":
@@ -153,10 +206,12 @@ def preprocess_devices_by_path(devices_path: Dict[str, str], output_path: str,
                 os.mkdir(device_output_path)
             for file_name in file_names:
                 print(file_name, device_output_path)
-                openbci_preprocess(input_path, file_name, device_output_path,
-                                   openbci_channels,
-                                   sampling_rate=openbci_sampling_rate,
-                                   signal_preprocess=signal_preprocess)
+                jobs.append(PreprocessingJob(
+                    os.path.join(device, file_name),
+                    openbci_preprocess,
+                    (input_path, file_name, device_output_path, openbci_channels),
+                    dict(sampling_rate=openbci_sampling_rate,
+                         signal_preprocess=signal_preprocess)))
         elif device == "openbci_brainflow":
             device_output_path = os.path.join(output_path, "openbci_brainflow")
             print("device_output_path", device_output_path)
@@ -171,10 +226,12 @@ def preprocess_devices_by_path(devices_path: Dict[str, str], output_path: str,
                 os.mkdir(device_output_path)
             for file_name in file_names:
                 print(file_name, device_output_path)
-                openbci_brainflow_preprocess(input_path, file_name, device_output_path,
-                                             openbci_channels,
-                                             sampling_rate=openbci_sampling_rate,
-                                             signal_preprocess=signal_preprocess)
+                jobs.append(PreprocessingJob(
+                    os.path.join(device, file_name),
+                    openbci_brainflow_preprocess,
+                    (input_path, file_name, device_output_path, openbci_channels),
+                    dict(sampling_rate=openbci_sampling_rate,
+                         signal_preprocess=signal_preprocess)))
         elif device == "shimmer3":
             device_output_path = output_path
             print("device_output_path", device_output_path)
@@ -190,7 +247,86 @@ def preprocess_devices_by_path(devices_path: Dict[str, str], output_path: str,
             print("preprocess shimmer input_path", input_path)
             print("preprocess shimmer device_output_path", device_output_path)
             for file_name in file_names:
-                shimmer3_preprocess(input_path, file_name, device_output_path,
-                                    sampling_rate=shimmer3_sampling_rate,
-                                    signal_preprocess=signal_preprocess)
-    print("Preprocessing done")
+                jobs.append(PreprocessingJob(
+                    os.path.join(device, file_name),
+                    shimmer3_preprocess,
+                    (input_path, file_name, device_output_path),
+                    dict(sampling_rate=shimmer3_sampling_rate,
+                         signal_preprocess=signal_preprocess)))
+    run_preprocessing_jobs(jobs, workers=workers, max_pending_jobs=max_pending_jobs)
+
+
+def run_preprocessing_jobs(jobs: List[PreprocessingJob], workers: int = 1,
+                           max_pending_jobs: Optional[int] = None) -> None:
+    '''
+    Runs preprocessing jobs, in parallel if there is more than one worker.
+    Progress of jobs and a summary of their time is printed.
+
+    Parameters
+    ----------
+    jobs: List[PreprocessingJob]
+        The jobs. Output files of each job should be different from the others.
+
+    workers: int, default: 1
+        Number of worker processes. If it is 1, jobs run one by one in the calling process.
+
+    max_pending_jobs: int, default: None
+        The maximum number of submitted jobs that are not finished yet. The default is
+        twice the number of workers.
+
+    Raises
+    ------
+    RuntimeError
+        If any of the jobs failed. The other jobs are finished before raising it.
+    '''
+    start_time = time.time()
+    durations: Dict[str, float] = {}
+    errors: Dict[str, str] = {}
+
+    def finished(job: PreprocessingJob, duration: float, error: Optional[str]) -> None:
+        durations[job.name] = duration
+        status = "done"
+        if error is not None:
+            errors[job.name] = error
+            status = "failed"
+            print("Error while preprocessing {0}:".format(job.name), file=sys.stderr)
+            print(error, file=sys.stderr)
+        print("[{0}/{1}] {2} {3} in {4:.2f}s".format(len(durations), len(jobs),
+                                                   job.name, status, duration))
+
+    if workers <= 1:
+        for job in jobs:
+            finished(job, *_run_job(job))
+    else:
+        if max_pending_jobs is None:
+            max_pending_jobs = 2 * workers
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            pending: Dict[concurrent.futures.Future, PreprocessingJob] = {}
+            for job in jobs:
+                while len(pending) >= max_pending_jobs:
+                    done, _ = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        finished(pending.pop(future), *future.result())
+                pending[executor.submit(_run_job, job)] = job
+            for future in concurrent.futures.as_completed(pending):
+                finished(pending[future], *future.result())
+
+    print("Preprocessing done: {0} files in {1:.2f}s ({2:.2f}s of processing time), "
+          "{3} failed".format(len(jobs), time.time() - start_time,
+                              sum(durations.values()), len(errors)))
+    if errors:
+        raise RuntimeError("Preprocessing failed for: {0}".format(
+            ", ".join(job.name for job in jobs if job.name in errors)))
+
+
+def _run_job(job: PreprocessingJob) -> Tuple[float, Optional[str]]:
+    '''Returns the duration of the job and its error (formatted), if it failed'''
+    start_time = time.time()
+    error = None
+    try:
+        job.function(*job.args, **job.kwargs)
+    except Exception:
+        # Exceptions may not be picklable. So the traceback is passed as str.
+        error = traceback.format_exc()
+    return time.time() - start_time, error
@@ -25,7 +25,7 @@ except ImportError:
     print()
     raise
 
-from octopus_sensing.preprocessing.utils import load_all_trials, resample, load_all_samples
+from octopus_sensing.preprocessing.utils import iter_trials, resample, load_all_samples
 from octopus_sensing.devices.common import SavingModeEnum
 
 
@@ -100,16 +100,16 @@ def shimmer3_preprocess(input_path: str, file_name: str, output_path: str,
 
     elif saving_mode == SavingModeEnum.CONTINIOUS_SAVING_MODE:
         print("shimmer input_path", input_path)
-        # First data needs to be splitted based on markers
-        trials_data, trials_times, triger_list = \
-            load_all_trials(os.path.join(input_path, file_name),  # File path
-                            (5, 7),  # channel columns
-                            7,  # timestamp column
-                            8,  # triger column
-                            '%Y-%m-%d %H:%M:%S.%f')  # timestamp format
-
-        i = 0
-        for trial in trials_data:
+        # First data needs to be splitted based on markers. Trials are read one by one,
+        # so only one of them is kept in memory
+        trials = \
+            iter_trials(os.path.join(input_path, file_name),  # File path
+                        (5, 7),  # channel columns
+                        8,  # triger column
+                        time_stamp_col=7,
+                        time_format='%Y-%m-%d %H:%M:%S.%f')
+
+        for trial_number, trial, times in trials:
             gsr_output_path = os.path.join(output_path, "gsr")
             if not os.path.exists(gsr_output_path):
                 pathlib.Path(gsr_output_path).mkdir(parents=True, exist_ok=True)
@@ -117,7 +117,7 @@ def shimmer3_preprocess(input_path: str, file_name: str, output_path: str,
                 "{0}/gsr{1}-{2}.csv".format(gsr_output_path,
                                             # Removing .csv and shimmer from file_name
                                             file_name[7:-4],
-                                            str(triger_list[i]).zfill(2))
+                                            str(trial_number).zfill(2))
             ppg_output_path = os.path.join(output_path, "ppg")
             if not os.path.exists(ppg_output_path):
                 pathlib.Path(ppg_output_path).mkdir(parents=True, exist_ok=True)
@@ -125,10 +125,11 @@ def shimmer3_preprocess(input_path: str, file_name: str, output_path: str,
                 "{0}/ppg{1}-{2}.csv".format(ppg_output_path,
                                             # Removing .csv and shimmer from file_name
                                             file_name[7:-4],
-                                            str(triger_list[i]).zfill(2))
+                                            str(trial_number).zfill(2))
 
+            assert times is not None
             resampled_data = \
-                resample(trial, trials_times[i], sampling_rate)
+                resample(trial, times, sampling_rate)
 
             if signal_preprocess is True:
                 print("shape", resampled_data.shape)
@@ -144,7 +145,6 @@ def shimmer3_preprocess(input_path: str, file_name: str, output_path: str,
 
             np.savetxt(gsr_file_path, cleaned_gsr)
             np.savetxt(ppg_file_path, cleaned_ppg)
-            i += 1
     else:
         raise Exception("Saving mode is incorrect")
 
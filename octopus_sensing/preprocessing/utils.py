@@ -13,9 +13,229 @@
 # If not, see <https://www.gnu.org/licenses/>.
 
 import datetime
-import csv
+import functools
+import itertools
+import math
+import re
+import warnings
 import numpy as np
-from typing import List, Any, Tuple
+from typing import Dict, Iterable, Iterator, List, Any, Optional, Sequence, Tuple, Union
+
+# The time formats that `str_to_times` parses in bulk. Values are the pattern of times
+# in the format, and the prefix that makes them an ISO 8601 date and time.
+FAST_TIME_FORMATS = {
+    '%H:%M:%S.%f': (re.compile(r'\d\d:\d\d:\d\d\.\d{1,6}'), '1900-01-01T'),
+    '%H:%M:%S': (re.compile(r'\d\d:\d\d:\d\d'), '1900-01-01T'),
+    '%Y-%m-%d %H:%M:%S.%f': (re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.\d{1,6}'), ''),
+    '%Y-%m-%d %H:%M:%S': (re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d'), ''),
+}
+
+
+def load_csv(file_path: str, channels_cols: Tuple[int, int],
+             time_stamp_col: Optional[int] = None, triger_col: Optional[int] = None,
+             has_header: bool = True) -> Tuple[np.ndarray, Optional[np.ndarray], Dict[int, str]]:
+    '''
+    Reads a recorded data file. The channels are parsed in bulk into one 2D array,
+    and the time stamps and triggers are read separately.
+
+    Parameters
+    ----------
+    file_path: str
+        The path of recorded data
+
+    channels_cols: Tuple[int, int]
+        The start column and end column number of channels.
+        For example [1, 16] means column 1 to 16 in the csv file includes channels data
+
+    time_stamp_col: int, default: None
+        The column number of time stamp. Time stamps are not read if it is None.
+
+    triger_col: int, default: None
+        The column number of trigger. Triggers are not read if it is None.
+
+    has_header: bool, default: True
+        If True, the first line of the file is skipped
+
+    Returns
+    ---------
+    data, times, triggers: Tuple[numpy.ndarray, numpy.ndarray, Dict[int, str]]
+
+    data: numpy.ndarray
+        A 2D float32 array of channels (samples * channels)
+
+    times: numpy.ndarray
+        An array of time stamps as str, or None if time_stamp_col is None
+
+    triggers: Dict[int, str]
+        Maps row numbers in `data` to their triggers. Rows without a trigger are not
+        included.
+    '''
+    skip_rows = 1 if has_header else 0
+    with warnings.catch_warnings():
+        # An empty file is not an error
+        warnings.filterwarnings("ignore", message="loadtxt: input contained no data")
+        data = np.loadtxt(file_path, delimiter=',', skiprows=skip_rows, comments=None,
+                          usecols=range(channels_cols[0], channels_cols[1]),
+                          dtype=np.float32, ndmin=2)
+        times = None
+        if time_stamp_col is not None:
+            times = np.loadtxt(file_path, delimiter=',', skiprows=skip_rows, comments=None,
+                               usecols=time_stamp_col, dtype=str, ndmin=1)
+
+    triggers: Dict[int, str] = {}
+    if triger_col is not None:
+        with open(file_path, 'r') as file:
+            for _ in range(skip_rows):
+                next(file, None)
+            triggers = _find_triggers(file, triger_col)
+    return data, times, triggers
+
+
+def _find_triggers(lines: Iterable[str], triger_col: int) -> Dict[int, str]:
+    '''
+    Maps row numbers to their triggers. Rows without a trigger may not have the trigger
+    column at all, so it can't be parsed in bulk. Lines are only split, which is much
+    cheaper than parsing them.
+    '''
+    triggers = {}
+    for i, line in enumerate(lines):
+        row = line.rstrip('\r\n').split(',')
+        if len(row) > triger_col and row[triger_col] != '':
+            triggers[i] = row[triger_col]
+    return triggers
+
+
+def split_trials(triggers: Dict[int, str]) -> List[Tuple[int, int, int]]:
+    '''
+    Finds the trials of a recording according to the START and STOP triggers
+
+    Parameters
+    ----------
+    triggers: Dict[int, str]
+        Maps row numbers to their triggers, e.g. the triggers returned by `load_csv`
+
+    Returns
+    ---------
+    List[Tuple[int, int, int]]
+        The trial number, the first row and the end row (exclusive) of each trial.
+        A trial starts from its START trigger and ends before its STOP trigger.
+    '''
+    return _find_trials(triggers, None)[0]
+
+
+def _find_trials(triggers: Dict[int, str], start: Optional[int]) \
+        -> Tuple[List[Tuple[int, int, int]], Optional[int]]:
+    '''
+    The same as `split_trials`, but a trial may be started before the triggers.
+    `start` is the first row of the started trial, or None. Returns the trials and the
+    first row of the trial that is not finished yet (or None).
+    '''
+    trials = []
+    for row in sorted(triggers):
+        triger = triggers[row]
+        action = triger[0:4]
+        trial_number = int(triger[-2:])
+        if action == "STAR":
+            if start is None:
+                start = row
+        elif action == "STOP":
+            # A STOP without a START makes an empty trial
+            trials.append((trial_number,
+                           row if start is None else start,
+                           row))
+            start = None
+    return trials, start
+
+
+def iter_trials(file_path: str, channels_cols: Tuple[int, int], triger_col: int,
+                time_stamp_col: Optional[int] = None, time_format: Optional[str] = None,
+                has_header: bool = True, chunk_size: int = 100000) \
+        -> Iterator[Tuple[int, np.ndarray, Optional[np.ndarray]]]:
+    '''
+    Reads the trials of a recorded data file one by one, according to the START and STOP
+    triggers. The file is read once, in chunks of lines, and each trial is yielded as soon
+    as its STOP trigger is read. So only one trial is kept in memory at a time.
+    Rows that are not in any trial are not parsed.
+
+    Parameters
+    ----------
+    file_path: str
+        The path of recorded data
+
+    channels_cols: Tuple[int, int]
+        The start column and end column number of channels.
+        For example [1, 16] means column 1 to 16 in the csv file includes channels data
+
+    triger_col: int
+        The column number of trigger
+
+    time_stamp_col: int, default: None
+        The column number of time stamp. Time stamps are not read if it is None.
+
+    time_format: str, default: None
+        The format of recorded times. It's needed if time_stamp_col is given.
+
+    has_header: bool, default: True
+        If True, the first line of the file is skipped
+
+    chunk_size: int, default: 100000
+        Number of lines that are read at once
+
+    Returns
+    ---------
+    Iterator[Tuple[int, numpy.ndarray, numpy.ndarray]]
+        The trial number, a 2D float32 array of the trial's data (samples * channels), and
+        an array of the trial's time stamps (numpy.datetime64), or None if time_stamp_col
+        is None
+    '''
+    assert time_stamp_col is None or time_format is not None
+    # Parts of the started trial, from the previous chunks
+    data_parts: List[np.ndarray] = []
+    times_parts: List[np.ndarray] = []
+    started = False
+    with open(file_path, 'r') as file:
+        if has_header:
+            next(file, None)
+        while True:
+            lines = list(itertools.islice(file, chunk_size))
+            if len(lines) == 0:
+                break
+            trials, start = \
+                _find_trials(_find_triggers(lines, triger_col), 0 if started else None)
+            for trial_number, first_row, end_row in trials:
+                data, times = \
+                    _parse_lines(lines[first_row:end_row], channels_cols, time_stamp_col)
+                data_parts.append(data)
+                times_parts.append(times)
+                trial_data = np.concatenate(data_parts)
+                trial_times = None
+                if time_stamp_col is not None:
+                    assert time_format is not None
+                    trial_times = str_to_times(np.concatenate(times_parts), time_format)
+                data_parts = []
+                times_parts = []
+                yield trial_number, trial_data, trial_times
+            started = start is not None
+            if start is not None:
+                data, times = _parse_lines(lines[start:], channels_cols, time_stamp_col)
+                data_parts.append(data)
+                times_parts.append(times)
+
+
+def _parse_lines(lines: List[str], channels_cols: Tuple[int, int],
+                 time_stamp_col: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+    '''Parses the channels and time stamps (or an empty array) of lines in bulk'''
+    if len(lines) == 0:
+        return (np.empty((0, channels_cols[1] - channels_cols[0]), dtype=np.float32),
+                np.empty(0, dtype=str))
+    data = np.loadtxt(lines, delimiter=',', comments=None,
+                      usecols=range(channels_cols[0], channels_cols[1]),
+                      dtype=np.float32, ndmin=2)
+    times = np.empty(0, dtype=str)
+    if time_stamp_col is not None:
+        times = np.loadtxt(lines, delimiter=',', comments=None, usecols=time_stamp_col,
+                           dtype=str, ndmin=1)
+    return data, times
 
 
 def load_all_samples(file_path: str, channels_cols: Tuple[int, int], time_stamp_col: int, time_format: str):
@@ -39,27 +259,17 @@ def load_all_samples(file_path: str, channels_cols: Tuple[int, int], time_stamp_
 
     Returns
     ---------
-    trial_data, converted_times: tuple(List[Any], List[datetime.datetime])
+    trial_data, converted_times: tuple(numpy.ndarray, numpy.ndarray)
 
-    trial_data: List[Any]
-        A list of a trial's data
+    trial_data: numpy.ndarray
+        A 2D array of a trial's data (samples * channels)
     
-    converted_times: List[datetime.datetime]
-        A list of trial's time stamps
+    converted_times: numpy.ndarray
+        An array of trial's time stamps (numpy.datetime64)
 
     '''
-    data = []
-    times = []
-    with open(file_path, 'r') as file:
-        reader = csv.reader(file, delimiter=',')
-        i = 0
-        for row in reader:
-            if i == 0:
-                # Skip header line
-                i += 1
-                continue
-            data.append(np.array(row[channels_cols[0]:channels_cols[1]], dtype=np.float32))
-            times.append(row[time_stamp_col])
+    data, times, _ = load_csv(file_path, channels_cols, time_stamp_col=time_stamp_col)
+    assert times is not None
     converted_times = str_to_times(times, time_format)
     return data, converted_times
 
@@ -89,13 +299,13 @@ def load_all_trials(file_path: str, channels_cols: Tuple[int, int], time_stamp_c
     Returns
     ---------
     all_trials_data, all_trials_times, trial_numbers: 
-        tuple(List[Any], List[List[datetime.datetime]], List[List[int]])
+        tuple(List[numpy.ndarray], List[numpy.ndarray], List[List[int]])
 
-    all_trials_data: List[Any]
-        A list of all trials data
+    all_trials_data: List[numpy.ndarray]
+        A list of all trials data. Each one is a 2D array (samples * channels)
     
-    all_trials_times: List[List[datetime.datetime]]
-        A list of all trials time stamps
+    all_trials_times: List[numpy.ndarray]
+        A list of all trials time stamps (numpy.datetime64)
     
     all_trials_times: List[List[int]]
         A list of all trials IDs
@@ -103,119 +313,222 @@ def load_all_trials(file_path: str, channels_cols: Tuple[int, int], time_stamp_c
     all_trials_data = []
     all_trials_times = []
     trial_numbers = []
-
-    action_flag = None
-    data:List[Any] = []
-    times: List[Any] = []
-    with open(file_path, 'r') as file:
-        reader = csv.reader(file, delimiter=',')
-
-        for i, row in enumerate(reader):
-            if i == 0:
-                # Ignore header
-                continue
-            if len(row) > triger_col:
-                if row[triger_col] not in (None, ''):
-                    triger = row[triger_col]
-                    action = triger[0:4]
-                    trial_number = int(triger[-2:])
-                    if action == "STAR":
-                        action_flag = 1
-                    elif action == "STOP":
-                        action_flag = 0
-                        all_trials_data.append(data)
-                        converted_times = str_to_times(times, time_format)
-                        all_trials_times.append(converted_times)
-                        trial_numbers.append(trial_number)
-                        data = []
-                        times = []
-            if action_flag == 1:
-                data.append(np.array(row[channels_cols[0]:channels_cols[1]], dtype=np.float32))
-                times.append(row[time_stamp_col])
+    for trial_number, data, times in iter_trials(file_path, channels_cols, triger_col,
+                                                 time_stamp_col=time_stamp_col,
+                                                 time_format=time_format):
+        all_trials_data.append(data)
+        all_trials_times.append(times)
+        trial_numbers.append(trial_number)
     return all_trials_data, all_trials_times, trial_numbers
 
 
-def str_to_times(times: List[str], time_format: str):
+def str_to_times(times: Union[List[str], np.ndarray], time_format: str) -> np.ndarray:
     '''
     Convert a list of str times to datetime
 
     Parameters
     ----------
-    times: List[str]
-        A list of times in str format
+    times: Union[List[str], numpy.ndarray]
+        A list (or array) of times in str format
     
     time_format: str:
         Fomatting time style
     
     Returns
     --------
-    List[datetime.datetime]
-        A list of times
+    numpy.ndarray
+        An array of times as numpy.datetime64 in nanoseconds
+
+    Notes
+    -----
+    The common formats (see `FAST_TIME_FORMATS`) are parsed in bulk. The format is
+    detected from the first time, and the times that don't match it are parsed one by
+    one, with `time_format`, `%H:%M:%S` or `%Y-%m-%d %H:%M:%S`, the first that matches.
+    Times without a date are on 1900-01-01, the same as `datetime.datetime.strptime`.
     '''
-    converted_times = []
-    for item in times:
+    converted_times = np.empty(len(times), dtype="datetime64[ns]")
+    if len(times) == 0:
+        return converted_times
+    items = np.asarray(times, dtype=str)
+
+    fast_format = None
+    if time_format in FAST_TIME_FORMATS:
+        # The formats are tried in the same order as parsing one by one
+        for candidate in (time_format, '%H:%M:%S', '%Y-%m-%d %H:%M:%S'):
+            pattern, prefix = FAST_TIME_FORMATS[candidate]
+            if pattern.fullmatch(items[0]):
+                fast_format = (pattern, prefix)
+                break
+
+    parsed = np.zeros(len(times), dtype=bool)
+    if fast_format is not None:
+        pattern, prefix = fast_format
+        # One regex pass over all times. Only if some of them don't match the format,
+        # they are checked one by one.
+        if re.fullmatch("(?:{0}\n)*".format(pattern.pattern), "\n".join(items.tolist()) + "\n"):
+            parsed[:] = True
+        else:
+            parsed = np.array([pattern.fullmatch(item) is not None for item in items])
         try:
-            time = datetime.datetime.strptime(item, time_format)
-        except:
-            try:
-                time = datetime.datetime.strptime(item, '%H:%M:%S')
-            except:
-                time = datetime.datetime.strptime(item, '%Y-%m-%d %H:%M:%S')
-        converted_times.append(time)
+            converted_times[parsed] = \
+                np.char.add(prefix, items[parsed]).astype("datetime64[ns]")
+        except ValueError:
+            # Out of range values, e.g. 25:00:00. Parsing them one by one raises the
+            # same error as strptime.
+            parsed[:] = False
+
+    for i in np.flatnonzero(~parsed):
+        converted_times[i] = _str_to_time(items[i], time_format)
     return converted_times
 
 
-def resample(data: List[Any], times: List[datetime.datetime], sampling_rate: int):
+def _str_to_time(item: str, time_format: str) -> datetime.datetime:
+    try:
+        return datetime.datetime.strptime(item, time_format)
+    except:
+        try:
+            return datetime.datetime.strptime(item, '%H:%M:%S')
+        except:
+            return datetime.datetime.strptime(item, '%Y-%m-%d %H:%M:%S')
+
+
+def resample(data: Union[List[Any], np.ndarray], times: Union[Sequence[Any], np.ndarray],
+             sampling_rate: int, method: str = "repeat"):
     '''
     Resamples data according to time stamps and sampling rate
 
     Parameters
     ----------
-    data: List[Any]
-        data to be resampled
+    data: Union[List[Any], numpy.ndarray]
+        data to be resampled, one sample (or row) per time stamp
     
-    times: List[datetime.datetime]
-        A list of timestamp. There is a timestamp for each sample of data
+    times: Sequence[Any]
+        A timestamp for each sample of data, e.g. the times returned by `str_to_times`.
+        numpy.datetime64 or datetime.datetime
 
     sampling_rate: int
         Data will be resampled to this sampling rate
+
+    method: str, default: "repeat"
+        "repeat" splits data into one second blocks, then repeats the last samples of
+        short blocks and ignores the last samples of long ones, so each block has
+        `sampling_rate` samples. The last block is dropped if it is not more than half
+        full.
+        "polyphase" interpolates data on a uniform time grid at its own sampling rate,
+        then resamples it with a polyphase filter (scipy.signal.resample_poly). It
+        doesn't distort the spectrum, but needs scipy.
     
     Returns
     -------
     numpy.array
         An array of resampled data
     '''
-    i = 0
-    time_delta = datetime.timedelta(0, 1, 0)
-    start_time = times[0]
-    sample_start_time = start_time
-    block: List[Any] = []
-    all_data = []
-    j = 0
-    block_number = 0
-    for item in data:
-        if times[i] - sample_start_time > time_delta:
-            block_number += 1
-            if len(block) < sampling_rate:
-                while len(block) < sampling_rate:
-                    # repeating last item
-                    block.extend(block[-(sampling_rate-len(block)):])
-            elif len(block) > sampling_rate:
-                # Ignoring last items
-                block = block[:sampling_rate]
-            all_data.extend(block)
-            block = []
-            sample_start_time = start_time + (block_number * time_delta)
-        block.append(item)
-        i += 1
-    if len(block) > 0:
-        if len(block) > sampling_rate/2:
-            while len(block) < sampling_rate:
-                # repeating last item
-                block.extend(block[-(sampling_rate-len(block)):])
-            block_number += 1
-            all_data.extend(block)
-    return np.array(all_data)
+    timestamps = np.asarray(times, dtype="datetime64[ns]").astype(np.int64)[:len(data)]
+    if method == "repeat":
+        return _resample_by_repeating(data, timestamps, sampling_rate)
+    elif method == "polyphase":
+        return _resample_polyphase(data, timestamps, sampling_rate)
+    raise ValueError("Unknown resampling method: {0}".format(method))
+
+
+def _resample_by_repeating(data: Union[List[Any], np.ndarray], timestamps: np.ndarray,
+                           sampling_rate: int) -> np.ndarray:
+    starts = _block_starts(timestamps)
+    lengths = np.diff(np.append(starts, len(timestamps)))
+
+    # Index of each output sample in its block. Long blocks are truncated.
+    offsets = np.empty((len(starts) - 1, sampling_rate), dtype=np.int64)
+    is_full = lengths[:-1] >= sampling_rate
+    offsets[is_full] = np.arange(sampling_rate)
+    for length in np.unique(lengths[:-1][~is_full]):
+        offsets[lengths[:-1] == length] = _padding_offsets(int(length), sampling_rate)
+    indexes = [(starts[:-1, np.newaxis] + offsets).ravel()]
+
+    # The last block is kept only if it's more than half full, and it's not truncated
+    last_length = int(lengths[-1])
+    if last_length > sampling_rate / 2:
+        if last_length >= sampling_rate:
+            indexes.append(starts[-1] + np.arange(last_length))
+        else:
+            indexes.append(starts[-1] + _padding_offsets(last_length, sampling_rate))
+
+    all_indexes = np.concatenate(indexes)
+    if len(all_indexes) == 0:
+        return np.array([])
+    return np.asarray(data)[all_indexes]
+
+
+def _block_starts(timestamps: np.ndarray) -> np.ndarray:
+    '''
+    Returns the first sample of each one second block. Block k starts with the first
+    sample after the previous block's start that is more than k + 1 seconds after the
+    first sample. So after a gap, each block has only one sample, until the blocks
+    catch up with the time stamps.
+    '''
+    second = 1_000_000_000
+    start_time = int(timestamps[0])
+    if np.all(timestamps[1:] >= timestamps[:-1]):
+        block_count = -(-(int(timestamps[-1]) - start_time) // second)
+        block_numbers = np.arange(block_count + 1)
+        # The first sample of each block, ignoring that blocks can't be empty
+        first_samples = np.searchsorted(timestamps, start_time + block_numbers * second,
+                                        side="right")
+        first_samples[0] = 0
+        # Each block starts at least one sample after the previous one
+        starts = np.maximum.accumulate(first_samples - block_numbers) + block_numbers
+        return starts[starts < len(timestamps)]
+
+    # Searching doesn't work on unordered time stamps. Checking them one by one.
+    unordered_starts = [0]
+    threshold = start_time + second
+    for i, timestamp in enumerate(timestamps.tolist()):
+        if timestamp > threshold:
+            unordered_starts.append(i)
+            threshold += second
+    return np.array(unordered_starts, dtype=np.int64)
+
+
+@functools.lru_cache(maxsize=None)
+def _padding_offsets(length: int, sampling_rate: int) -> np.ndarray:
+    '''
+    Offsets of samples in a block with `length` samples, after repeating its last samples
+    to have `sampling_rate` samples
+    '''
+    block = list(range(length))
+    while len(block) < sampling_rate:
+        # repeating last item
+        block.extend(block[-(sampling_rate-len(block)):])
+    return np.array(block, dtype=np.int64)
+
+
+def _resample_polyphase(data: Union[List[Any], np.ndarray], timestamps: np.ndarray,
+                        sampling_rate: int) -> np.ndarray:
+    try:
+        from scipy import signal
+    except ImportError:
+        print()
+        print("Polyphase resampling needs scipy. Please install it, or use the 'repeat' method.")
+        print()
+        raise
+
+    samples = np.asarray(data, dtype=np.float64)
+    order = np.argsort(timestamps, kind="stable")
+    seconds = (timestamps[order] - timestamps[order[0]]) / 1e9
+    samples = samples[order]
+    duration = seconds[-1]
+    if duration <= 0:
+        raise ValueError("Time stamps should cover some time for polyphase resampling")
+
+    source_rate = max(int(round((len(seconds) - 1) / duration)), 1)
+    uniform_times = np.arange(int(duration * source_rate) + 1) / source_rate
+    if samples.ndim == 1:
+        uniform = np.interp(uniform_times, seconds, samples)
+    else:
+        uniform = np.column_stack([np.interp(uniform_times, seconds, channel)
+                                   for channel in samples.T])
+    divisor = math.gcd(sampling_rate, source_rate)
+    return signal.resample_poly(uniform, sampling_rate // divisor, source_rate // divisor,
+                                axis=0)
 
 
 def load_all_samples_without_time(file_path: str, channels_cols: Tuple[int, int]):
@@ -234,14 +547,10 @@ def load_all_samples_without_time(file_path: str, channels_cols: Tuple[int, int]
 
     Returns
     ---------
-    trial_data: List[Any]
-        A list of a trial's data
+    trial_data: numpy.ndarray
+        A 2D array of a trial's data (samples * channels)
     '''
-    data = []
-    with open(file_path, 'r') as file:
-        reader = csv.reader(file, delimiter=',')
-        for row in reader:
-            data.append(np.array(row[channels_cols[0]:channels_cols[1]], dtype=np.float32))
+    data, _, _ = load_csv(file_path, channels_cols, has_header=False)
     return data
 
 
@@ -264,35 +573,18 @@ def load_all_trials_without_time(file_path: str, channels_cols: Tuple[int, int],
     Returns
     ---------
     all_trials_data, trial_numbers: 
-        tuple(List[Any], List[List[int]])
+        tuple(List[numpy.ndarray], List[List[int]])
 
-    all_trials_data: List[Any]
-        A list of all trials data
+    all_trials_data: List[numpy.ndarray]
+        A list of all trials data. Each one is a 2D array (samples * channels)
     
     all_trials_times: List[List[int]]
         A list of all trials IDs
     '''
     all_trials_data = []
     trial_numbers = []
-
-    action_flag = None
-    data:List[Any] = []
-    with open(file_path, 'r') as file:
-        reader = csv.reader(file, delimiter=',')
-
-        for i, row in enumerate(reader):
-            if len(row) > triger_col:
-                if row[triger_col] not in (None, ''):
-                    triger = row[triger_col]
-                    action = triger[0:4]
-                    trial_number = int(triger[-2:])
-                    if action == "STAR":
-                        action_flag = 1
-                    elif action == "STOP":
-                        action_flag = 0
-                        all_trials_data.append(data)
-                        trial_numbers.append(trial_number)
-                        data = []
-            if action_flag == 1:
-                data.append(np.array(row[channels_cols[0]:channels_cols[1]], dtype=np.float32))
+    for trial_number, data, _ in iter_trials(file_path, channels_cols, triger_col,
+                                             has_header=False):
+        all_trials_data.append(data)
+        trial_numbers.append(trial_number)
     return all_trials_data, trial_numbers
\ No newline at end of file
@@ -12,23 +12,215 @@
 # You should have received a copy of the GNU General Public License along with Octopus Sensing.
 # If not, see <https://www.gnu.org/licenses/>.
 
-from typing import Optional, Dict, List
+import time
+import threading
+from typing import Any, Optional, Dict, Iterator, List, Tuple
 
-from octopus_sensing.common.endpoint_base import EndpointBase
+from octopus_sensing.common.endpoint_base import EndpointBase, EndpointClientError
+
+# Streams check for new data at most this often (seconds)
+MIN_STREAM_INTERVAL = 0.01
+# If there's no new data for this long (seconds), an empty response is sent, so the
+# stream notices disconnected clients.
+STREAM_HEARTBEAT_INTERVAL = 1.0
+# Image formats of the `format` query parameter
+IMAGE_FORMATS = ("jpeg", "png")
+
+
+def _parse_interval(interval: str) -> float:
+    '''
+    Converts an interval like `50ms` or `0.5s` to seconds. Numbers without a unit are
+    milliseconds.
+    '''
+    try:
+        if interval.endswith("ms"):
+            seconds = float(interval[:-2]) / 1000
+        elif interval.endswith("s"):
+            seconds = float(interval[:-1])
+        else:
+            seconds = float(interval) / 1000
+    except ValueError:
+        raise EndpointClientError("Invalid interval: {0}".format(interval))
+    return max(seconds, MIN_STREAM_INTERVAL)
+
+
+def _parse_number(name: str, value: str, number_type: type = int) -> Any:
+    try:
+        return number_type(value)
+    except ValueError:
+        raise EndpointClientError("Invalid {0}: {1}".format(name, value))
+
+
+def _parse_positive_number(name: str, value: str, number_type: type = int) -> Any:
+    number = _parse_number(name, value, number_type)
+    if number <= 0:
+        raise EndpointClientError("{0} should be positive".format(name))
+    return number
+
+
+def parse_realtime_data_options(query_params: Dict[str, List[str]]) \
+        -> Optional[Dict[str, Any]]:
+    '''
+    Reads the query parameters that are passed to devices as options of the request:
+    `width`, `quality`, `format` and `fps` (see `RealtimeDataEndpoint`)
+
+    Returns
+    -------
+    options: Optional[Dict[str, Any]]
+        The `options` of `DeviceCoordinator.get_realtime_data`, or None if none of them
+        is given
+    '''
+    options: Dict[str, Any] = {}
+    if "width" in query_params:
+        options["width"] = _parse_positive_number("width", query_params["width"][0])
+    if "quality" in query_params:
+        options["quality"] = _parse_positive_number("quality", query_params["quality"][0])
+        if options["quality"] > 100:
+            raise EndpointClientError("quality should be between 1 and 100")
+    if "format" in query_params:
+        options["format"] = query_params["format"][0].lower()
+        if options["format"] not in IMAGE_FORMATS:
+            raise EndpointClientError("format should be one of {0}".format(IMAGE_FORMATS))
+    if "fps" in query_params:
+        options["fps"] = _parse_positive_number("fps", query_params["fps"][0], float)
+    return options or None
+
+
+def parse_realtime_data_query(device_coordinator, query_params: Dict[str, List[str]]) \
+        -> Tuple[int, Optional[List[str]], Optional[Dict[str, int]]]:
+    '''
+    Reads `duration`, `device_list` and `since` query parameters
+    (see `RealtimeDataEndpoint`)
+
+    Returns
+    -------
+    duration, device_list, since: Tuple[int, Optional[List[str]], Optional[Dict[str, int]]]
+        Parameters of `DeviceCoordinator.get_realtime_data`
+    '''
+    duration: int = _parse_number('duration', query_params.get('duration', ["3"])[0])
+
+    device_list_string = query_params.get('device_list', [""])[0]
+    device_list: Optional[List[str]] = None
+    if device_list_string != "":
+        device_list = device_list_string.split(',')
+
+    since: Optional[Dict[str, int]] = None
+    since_string = query_params.get('since', [""])[0]
+    if since_string != "":
+        since = {}
+        for item in since_string.split(','):
+            if ':' in item:
+                device_name, cursor = item.rsplit(':', 1)
+                since[device_name] = _parse_number('since', cursor)
+            else:
+                for device in device_coordinator.get_devices():
+                    since[device.name] = _parse_number('since', item)
+    return duration, device_list, since
+
+
+def stream_realtime_data(device_coordinator, query_params: Dict[str, List[str]],
+                         stop_event: threading.Event) -> Iterator[Dict[str, Any]]:
+    '''
+    Checks devices every `interval` (a query parameter) and yields their new records,
+    until `stop_event` is set
+
+    Parameters
+    ----------
+    device_coordinator: DeviceCoordinator
+        The coordinator to get the realtime data from
+
+    query_params: Dict[str, List[str]]
+        `interval`, and the query parameters of `parse_realtime_data_query` and
+        `parse_realtime_data_options`
+
+    stop_event: threading.Event
+        The stream ends when it's set
+
+    Returns
+    -------
+    Iterator[Dict[str, Any]]
+        New data of each device, the same as `DeviceCoordinator.get_realtime_data`.
+        Devices without new records are left out. It's empty if there's nothing new
+        for `STREAM_HEARTBEAT_INTERVAL`.
+    '''
+    duration, device_list, since = parse_realtime_data_query(device_coordinator, query_params)
+    options = parse_realtime_data_options(query_params)
+    interval = _parse_interval(query_params.get('interval', ["100ms"])[0])
+    return _stream(device_coordinator, duration, device_list, since or {}, options, interval,
+                   stop_event)
+
+
+def _stream(device_coordinator, duration: int, device_list: Optional[List[str]],
+            cursors: Dict[str, int], options: Optional[Dict[str, Any]], interval: float,
+            stop_event: threading.Event) -> Iterator[Dict[str, Any]]:
+    last_sent = time.monotonic()
+    while not stop_event.is_set():
+        started = time.monotonic()
+        realtime_data = device_coordinator.get_realtime_data(
+            duration, device_list, dict(cursors) or None, options=options)
+
+        new_data = {}
+        for device_name, device_data in realtime_data.items():
+            if isinstance(device_data, dict) and "cursor" in device_data:
+                if device_data["cursor"] == cursors.get(device_name):
+                    # Nothing new
+                    continue
+                cursors[device_name] = device_data["cursor"]
+            new_data[device_name] = device_data
+
+        if new_data or started - last_sent >= STREAM_HEARTBEAT_INTERVAL:
+            last_sent = started
+            yield new_data
+
+        time.sleep(max(interval - (time.monotonic() - started), 0))
 
 
 class RealtimeDataEndpoint(EndpointBase):
+    '''
+    Serves realtime data of devices over HTTP. Query parameters are:
+
+    - duration: Seconds of the latest data, default is 3
+    - device_list: Comma separated device names, default is all devices
+    - since: Comma separated `device_name:cursor` pairs. For these devices only the records
+      after the cursor (the `cursor` of the previous response) are returned. A single number
+      is used for all devices.
+
+    Camera frames can be downscaled and compressed in the device's process before they
+    are sent, with these query parameters:
+
+    - width: Width of frames in pixels. Frames are resized keeping their aspect ratio,
+      but never enlarged.
+    - format: `jpeg` (default) or `png`. Frames are sent as encoded images (bytes), if
+      any of `width`, `format` or `quality` is given.
+    - quality: JPEG quality, from 1 to 100. Default is 80.
+    - fps: Number of frames per second of `duration`, default is 1.
+
+    Clients can also subscribe to `/stream` instead of polling. The endpoint then checks
+    devices every `interval` (e.g. `50ms`, default is 100ms) and sends only the new records
+    of each device as soon as they arrive, using the cursors the same way a polling client
+    does. `duration` limits the first response (and how much a slow client can fall
+    behind). Devices that don't have cursors are sent in every response. See
+    `EndpointBase` for the format of the stream.
+
+    Example
+    -------
+    >>> GET /?duration=3&device_list=eeg,gsr&since=eeg:1250,gsr:320
+    >>> GET /stream?device_list=eeg,shimmer&interval=50ms
+    >>> GET /?device_list=camera&duration=1&width=320&quality=70&fps=5
+    '''
 
     def __init__(self, device_coordinator, port: int = 9330):
         super().__init__(endpoint_name="RealtimeDataEndpoint-Thread",
-                         port=port, get_callback=self._get_handler)
+                         port=port, get_callback=self._get_handler,
+                         stream_callback=self._stream_handler)
         self._device_coordinator = device_coordinator
 
     def _get_handler(self, request_reader, query_params: Dict[str, List[str]]):
-        duration: int = int(query_params.get('duration', ["3"])[0])
+        duration, device_list, since = \
+            parse_realtime_data_query(self._device_coordinator, query_params)
+        options = parse_realtime_data_options(query_params)
+        return self._device_coordinator.get_realtime_data(duration, device_list, since,
+                                                          options=options)
 
-        device_list_string = query_params.get('device_list', [""])[0]
-        device_list: Optional[List[str]] = None
-        if device_list_string != "":
-            device_list = device_list_string.split(',')
-        return self._device_coordinator.get_realtime_data(duration, device_list)
+    def _stream_handler(self, query_params: Dict[str, List[str]]) -> Iterator[Dict[str, Any]]:
+        return stream_realtime_data(self._device_coordinator, query_params, self._stop_event)
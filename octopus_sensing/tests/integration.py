@@ -58,7 +58,8 @@ class MockedOpenBCICyton:
 
 class MockedSerial:
     def __init__(self, *args, **kwargs):
-        pass
+        self._pending = b""
+        self._last_frame_time = time.time()
 
     def flushInput(self):
         pass
@@ -72,6 +73,22 @@ class MockedSerial:
     def is_open(self):
         return True
 
+    @property
+    def in_waiting(self):
+        self._receive_frames()
+        return len(self._pending)
+
+    def _receive_frames(self):
+        # Sample rate: 128 per second
+        while time.time() - self._last_frame_time >= 1 / 128:
+            self._last_frame_time += 1 / 128
+            # Data packet type, followed by random timestamp and values
+            frame = [0x00]
+            for _ in range(13):
+                # 48 to 57 are numbers 0 to 9
+                frame.append(random.randint(48, 57))
+            self._pending += bytes(frame)
+
     def read(self, size):
         if size == 1:
             # Asking for ack
@@ -83,15 +100,15 @@ class MockedSerial:
         elif size == 5:
             # Channels
             return b"\x65\x66\x67\x68\x69"
-        elif size == 14:
-            # One frame of data
-            frame = []
-            for _ in range(14):
-                # 48 to 57 are numbers 0 to 9
-                frame.append(random.randint(48, 57))
-            # Sample rate: 128 per second
-            time.sleep(1 / 128)
-            return bytes(frame)
+        else:
+            # Frames of data
+            self._receive_frames()
+            while len(self._pending) < size:
+                time.sleep(1 / 128)
+                self._receive_frames()
+            data = self._pending[:size]
+            self._pending = self._pending[size:]
+            return data
 
 
 @pytest.fixture(scope="module")
@@ -168,8 +185,8 @@ def test_system_health(mocked):
 
         assert isinstance(realtime_data["shimmer"], dict)
         assert len(realtime_data["shimmer"]["data"]) == 3 * 128
-        assert len(realtime_data["shimmer"]["data"][0]) in (8, 9)
-        assert len(realtime_data["shimmer"]["data"][-1]) in (8, 9)
+        assert realtime_data["shimmer"]["data"].shape[1] == 7
+        assert len(realtime_data["shimmer"]["timestamps"]) == 3 * 128
 
     finally:
         coordinator.dispatch(terminate_message())
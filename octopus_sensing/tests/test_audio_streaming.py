@@ -16,7 +16,9 @@ import multiprocessing
 import os
 import time
 import tempfile
+import wave
 
+import numpy as np
 import pytest
 
 import octopus_sensing.devices.audio_streaming as audio_streaming
@@ -24,6 +26,18 @@ from octopus_sensing.common.message_creators import start_message, stop_message,
 from octopus_sensing.tests.test_helpers import wait_until_path_exists
 
 
+# Two seconds of stereo audio
+SAMPLES = np.arange(1000, dtype=np.int16)
+
+
+def read_wav(file_name):
+    with wave.open(file_name, "rb") as wav_file:
+        assert wav_file.getnchannels() == 2
+        assert wav_file.getsampwidth() == 2
+        assert wav_file.getframerate() == 125
+        return np.frombuffer(wav_file.readframes(wav_file.getnframes()), dtype=np.int16)
+
+
 class MockedMiniAudioModule:
 
     def Devices(self):
@@ -32,14 +46,6 @@ class MockedMiniAudioModule:
     def CaptureDevice(self, buffersize_msec, sample_rate, device_id):
         return MockedMiniAudioCapture()
 
-    def DecodedSoundFile(self, name, nchannels, sample_rate, file_format, samples):
-        # Just returning back samples without change!
-        return samples
-
-    def wav_write_file(self, file_name, sound_data):
-        # Just writing our fake data to the file.
-        open(file_name, 'w').write(str(sound_data))
-
 
 class MockedMiniAudioDevices:
 
@@ -51,13 +57,13 @@ class MockedMiniAudioDevices:
 
 class MockedMiniAudioCapture:
 
-    # None of these are important. They will just pass back to our Mock.
-    nchannels = 5
+    nchannels = 2
     sample_rate = 125
-    format = 'wav'
 
     def start(self, recorder):
-        recorder.send(b'123')
+        # Two seconds of audio, in two chunks
+        recorder.send(SAMPLES[:250].tobytes())
+        recorder.send(SAMPLES[250:].tobytes())
 
     def stop(self):
         pass
@@ -121,7 +127,51 @@ def test_happy_path(mocked):
 
     assert os.path.exists(device_output)
     assert os.path.exists(recorded_file)
+    assert np.array_equal(read_wav(recorded_file), SAMPLES)
 
     # Sending terminate and waiting for the device process to exit.
     msg_queue.put(terminate_message())
     device.join()
+
+
+def test_wav_file_rotation():
+    output_dir = tempfile.mkdtemp(prefix="octopus-sensing-test")
+    file_name = os.path.join(output_dir, "audio.wav")
+    # Room for 100 frames (4 bytes each) after the header
+    writer = audio_streaming.WavFileWriter(file_name, 2, 125, max_file_size=444)
+    for chunk in np.split(SAMPLES, 4):
+        writer.write(chunk.tobytes())
+    writer.close()
+
+    assert writer.file_names == [file_name] + \
+        [os.path.join(output_dir, "audio-part{0}.wav".format(i)) for i in range(2, 6)]
+    parts = [read_wav(part) for part in writer.file_names]
+    assert [len(part) for part in parts] == [200, 200, 200, 200, 200]
+    assert all(os.path.getsize(part) == 444 for part in writer.file_names)
+    assert np.array_equal(np.concatenate(parts), SAMPLES)
+
+
+def test_realtime_data(mocked):
+    device = audio_streaming.AudioStreaming(1, name="audio",
+                                            output_path=tempfile.mkdtemp(),
+                                            realtime_buffer_duration=1)
+    device._sampling_rate = 125
+    assert device._get_realtime_data(1)["data"] == []
+
+    device._stream_data = \
+        audio_streaming.RingBuffer(2, 125 * 1, dtype=np.int16)
+    recorder = device._AudioStreaming__stream_loop()
+    next(recorder)
+    MockedMiniAudioCapture().start(recorder)
+
+    # Only the last second is kept
+    realtime_data = device._get_realtime_data(5)
+    assert realtime_data["data"].dtype == np.int16
+    assert np.array_equal(realtime_data["data"], SAMPLES[750:].reshape(-1, 2))
+    assert realtime_data["sequence"] == 375
+    assert realtime_data["cursor"] == 500
+    assert realtime_data["metadata"]["channels"] == 2
+    assert device._stream_data.capacity == 125
+
+    realtime_data = device._get_realtime_data(5, since=400)
+    assert np.array_equal(realtime_data["data"], SAMPLES[800:].reshape(-1, 2))
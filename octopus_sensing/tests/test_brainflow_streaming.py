@@ -3,9 +3,14 @@ import queue
 import os
 import time
 import tempfile
-from brainflow import BoardIds, BrainFlowInputParams
+import threading
+
+import numpy as np
+from brainflow import BoardIds, BrainFlowInputParams, BoardShim
 
 import octopus_sensing.devices.brainflow_streaming as brainflow_streaming
+from octopus_sensing.devices.background_writer import BackgroundWriter
+from octopus_sensing.devices.common import TriggerModeEnum
 from octopus_sensing.common.message_creators import start_message, stop_message, terminate_message
 
 
@@ -55,5 +60,87 @@ def test_system_health():
 
     filecontent = open(os.path.join(brain_output, filename), 'r').read()
     assert len(filecontent) >= 375
-    # TODO: Check if the triggers are there.
+    assert "START-{0}-{1}".format(experiment_id, stimuli_id) in filecontent
+    assert "STOP-{0}-{1}".format(experiment_id, stimuli_id) in filecontent
     # TODO: Use BoardIds.PLAYBACK_FILE_BOARD and check the data is exactly the same as the input file.
+
+
+def test_samples_timestamps_and_trigger():
+    output_dir = tempfile.mkdtemp(prefix="octopus-sensing-test")
+    device = \
+        brainflow_streaming.BrainFlowStreaming(BoardIds.SYNTHETIC_BOARD,
+                                               250,
+                                               brain_flow_input_params=BrainFlowInputParams(),
+                                               name="synthetic",
+                                               output_path=output_dir)
+    # Running the streaming loop in this process
+    device._board = BoardShim(BoardIds.SYNTHETIC_BOARD, BrainFlowInputParams())
+    device._board.prepare_session()
+    loop_thread = threading.Thread(target=device._stream_loop)
+    loop_thread.start()
+    try:
+        time.sleep(0.5)
+        before = time.time()
+        device._BrainFlowStreaming__set_trigger(start_message("exp", "sti"))
+        after = time.time()
+        time.sleep(0.5)
+    finally:
+        device._terminate = True
+        loop_thread.join()
+        device._board.stop_stream()
+        device._board.release_session()
+
+    data, timestamps, triggers = device._stream_data.get_latest(10000)
+    assert len(data) > 100
+    # Every sample has the time of the board's timestamp channel
+    timestamp_channel = BoardShim.get_timestamp_channel(BoardIds.SYNTHETIC_BOARD)
+    assert np.array_equal(timestamps, data[:, timestamp_channel])
+    assert not np.any(np.isnan(timestamps))
+
+    assert list(triggers.values()) == ["START-exp-sti"]
+    row = list(triggers.keys())[0]
+    sample_period = 1 / 250
+    assert before - sample_period <= timestamps[row] <= after + sample_period
+
+
+def test_marker_trigger_mode():
+    output_dir = tempfile.mkdtemp(prefix="octopus-sensing-test")
+    device = \
+        brainflow_streaming.BrainFlowStreaming(BoardIds.SYNTHETIC_BOARD,
+                                               250,
+                                               brain_flow_input_params=BrainFlowInputParams(),
+                                               name="synthetic",
+                                               output_path=output_dir,
+                                               trigger_mode=TriggerModeEnum.MARKER_TRIGGER_MODE)
+    device._board = BoardShim(BoardIds.SYNTHETIC_BOARD, BrainFlowInputParams())
+    device._board.prepare_session()
+    device._writer = BackgroundWriter("synthetic writer")
+    device._writer.start()
+    loop_thread = threading.Thread(target=device._stream_loop)
+    loop_thread.start()
+    try:
+        time.sleep(0.3)
+        device._BrainFlowStreaming__set_trigger(start_message("exp", "sti"))
+        time.sleep(0.3)
+        device._BrainFlowStreaming__set_trigger(stop_message("exp", "sti"))
+        time.sleep(0.3)
+    finally:
+        device._terminate = True
+        loop_thread.join()
+        device._board.stop_stream()
+        device._board.release_session()
+
+    data, _, triggers = device._stream_data.get_latest(10000)
+    # Triggers are in the marker channel instead of the trigger column
+    assert triggers == {}
+    marker_channel = BoardShim.get_marker_channel(BoardIds.SYNTHETIC_BOARD)
+    markers = data[:, marker_channel]
+    assert list(markers[markers != 0]) == [1, 2]
+    assert device._marker_triggers == {1: "START-exp-sti", 2: "STOP-exp-sti"}
+
+    file_name = os.path.join(output_dir, "synthetic-exp.csv")
+    device._save_to_file(file_name)
+    device._writer.stop()
+    with open(os.path.join(output_dir, "synthetic-exp-markers.csv")) as markers_file:
+        assert markers_file.read().splitlines() == \
+            ["code,trigger", "1,START-exp-sti", "2,STOP-exp-sti"]
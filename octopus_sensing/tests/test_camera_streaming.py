@@ -12,13 +12,19 @@
 # You should have received a copy of the GNU General Public License along with Foobar.
 # If not, see <https://www.gnu.org/licenses/>.
 
+import csv
 import multiprocessing
 import os
 import time
 import tempfile
+import threading
 import pytest
+import cv2
+import numpy as np
 
 import octopus_sensing.devices.camera_streaming as camera_streaming
+from octopus_sensing.device_coordinator import DeviceCoordinator
+from octopus_sensing.devices.common import FrameDropPolicyEnum, VideoSavingModeEnum
 from octopus_sensing.common.message_creators import start_message, stop_message, terminate_message
 from octopus_sensing.tests.test_helpers import wait_until_path_exists
 
@@ -40,9 +46,11 @@ class MockedCv2Module:
     def CAP_PROP_FRAME_HEIGHT(self):
         return (float(480.0))
     
-    def imwrite(self, filename, img):
-        a = time.time()
-        open(filename[:-4] + "/" + str(a) + ".jpg", 'w+').write(img)
+    IMWRITE_JPEG_QUALITY = 1
+
+    def imwrite(self, filename, img, params=None):
+        open(filename, 'w+').write(str(img))
+        return True
 
 class MockedVideoCaptureModule:
 
@@ -142,3 +150,233 @@ def test_happy_path(mocked):
     # Sending terminate and waiting for the device process to exit.
     msg_queue.put(terminate_message())
     device.join()
+
+    # Capture time of each frame of the video
+    timestamps_file = os.path.join(device_output, '{}-{}-{}-timestamps.csv'.format(
+        device_name, experiment_id, stimuli_id))
+    with open(timestamps_file) as csv_file:
+        rows = list(csv.reader(csv_file))
+    assert rows[0] == ["frame", "timestamp", "trigger"]
+    assert len(rows) > 10
+    assert [int(row[0]) for row in rows[1:]] == list(range(len(rows) - 1))
+    timestamps = [float(row[1]) for row in rows[1:]]
+    assert timestamps == sorted(timestamps)
+    assert rows[1][2] == "START-{}-{}".format(experiment_id, stimuli_id)
+    assert rows[-1][2] == "STOP-{}-{}".format(experiment_id, stimuli_id)
+    assert all(len(row) == 2 for row in rows[2:-1])
+
+
+class BlockedVideoWriter:
+    '''A video writer that doesn't write anything until it is released'''
+    unblock = threading.Event()
+
+    def __init__(self, file_name, codec, fps, video_size):
+        self.frames = []
+        BlockedVideoWriter.instances.append(self)
+
+    def write(self, frame):
+        BlockedVideoWriter.unblock.wait()
+        self.frames.append(frame)
+
+    def release(self):
+        pass
+
+
+class SlowVideoWriter(MockedVideoWriterModule):
+    '''A video writer that takes a while to close the file'''
+
+    def __init__(self, file_name, codec, fps, video_size):
+        super().__init__(file_name)
+
+    def release(self):
+        time.sleep(0.5)
+        open(self.file_name, 'a').write("released")
+
+
+def test_wait_until_saved(mocked):
+    output_dir = tempfile.mkdtemp(prefix="octopus-sensing-test")
+    camera_streaming.cv2.VideoWriter = SlowVideoWriter
+    coordinator = DeviceCoordinator()
+    try:
+        coordinator.add_device(camera_streaming.CameraStreaming(
+            camera_no=0, output_path=output_dir, name="camera"))
+        time.sleep(0.2)
+        coordinator.dispatch(start_message("exp", "sti"))
+        time.sleep(0.5)
+        coordinator.dispatch(stop_message("exp", "sti"))
+        assert coordinator.wait_until_saved(timeout=5)
+
+        # Both files are complete as soon as it returns
+        device_output = os.path.join(output_dir, "camera")
+        with open(os.path.join(device_output, "camera-exp-sti.avi")) as video_file:
+            assert video_file.read().endswith("released")
+        with open(os.path.join(device_output, "camera-exp-sti-timestamps.csv")) as csv_file:
+            rows = list(csv.reader(csv_file))
+        assert rows[-1][2] == "STOP-exp-sti"
+    finally:
+        coordinator.terminate()
+        del camera_streaming.cv2.VideoWriter
+
+
+def test_image_sequence_saving_mode(mocked):
+    output_dir = tempfile.mkdtemp(prefix="octopus-sensing-test")
+    device = camera_streaming.CameraStreaming(
+        camera_no=0, output_path=output_dir, name="images",
+        video_saving_mode=VideoSavingModeEnum.IMAGE_SEQUENCE_SAVING_MODE,
+        image_encoder_threads=3)
+    msg_queue = multiprocessing.Queue()
+    device.set_queue(msg_queue)
+    device.set_realtime_data_queues(multiprocessing.Queue(), multiprocessing.Queue())
+    device.start()
+    time.sleep(0.2)
+    msg_queue.put(start_message("exp", "sti"))
+    time.sleep(1)
+    msg_queue.put(stop_message("exp", "sti"))
+    msg_queue.put(terminate_message())
+    device.join()
+
+    device_output = os.path.join(output_dir, "images")
+    assert sorted(os.listdir(device_output)) == \
+        ["images-exp-sti", "images-exp-sti-timestamps.csv"]
+
+    images = sorted(os.listdir(os.path.join(device_output, "images-exp-sti")))
+    # The mocked camera gives 20 frames per second
+    assert len(images) >= 10
+    # Files are named by the index of frames, and no frame is dropped
+    assert images == ["{0:06d}.jpg".format(i) for i in range(len(images))]
+
+    with open(os.path.join(device_output, "images-exp-sti-timestamps.csv")) as csv_file:
+        rows = list(csv.reader(csv_file))
+    assert rows[0] == ["frame", "timestamp", "trigger"]
+    assert [int(row[0]) for row in rows[1:]] == list(range(len(images)))
+    timestamps = [float(row[1]) for row in rows[1:]]
+    assert timestamps == sorted(timestamps)
+    assert rows[1][2] == "START-exp-sti"
+    assert rows[-1][2] == "STOP-exp-sti"
+    assert all(len(row) == 2 for row in rows[2:-1])
+
+
+@pytest.mark.parametrize("saving_mode", [VideoSavingModeEnum.VIDEO_FILE_SAVING_MODE,
+                                         VideoSavingModeEnum.IMAGE_SEQUENCE_SAVING_MODE])
+def test_one_frame_recording(mocked, saving_mode):
+    output_dir = tempfile.mkdtemp(prefix="octopus-sensing-test")
+    file_name = os.path.join(output_dir, "test.avi")
+    if saving_mode == VideoSavingModeEnum.VIDEO_FILE_SAVING_MODE:
+        recorder = camera_streaming.FrameRecorder(
+            "test", file_name, (640, 480), 20.0, queue_size=4,
+            drop_policy=FrameDropPolicyEnum.BLOCK_POLICY, start_trigger="START-exp-sti")
+    else:
+        recorder = camera_streaming.ImageSequenceRecorder(
+            "test", file_name[:-4], queue_size=4, drop_policy=FrameDropPolicyEnum.BLOCK_POLICY,
+            encoder_count=2, jpeg_quality=95, start_trigger="START-exp-sti")
+    recorder.submit([[0]], 100.0)
+    recorder.finish("STOP-exp-sti")
+    recorder.join()
+
+    with open(os.path.join(output_dir, "test-timestamps.csv")) as csv_file:
+        rows = list(csv.reader(csv_file))
+    # Both triggers are kept
+    assert rows == [["frame", "timestamp", "trigger"],
+                    ["0", "100.0", "START-exp-sti"],
+                    ["0", "100.0", "STOP-exp-sti"]]
+
+@pytest.mark.parametrize("drop_policy,expected_frames", [
+    (FrameDropPolicyEnum.DROP_NEWEST_POLICY, [0, 1, 2, 3, 4]),
+    (FrameDropPolicyEnum.DROP_OLDEST_POLICY, [0, 16, 17, 18, 19]),
+    (FrameDropPolicyEnum.BLOCK_POLICY, list(range(20))),
+])
+def test_frame_recorder_drop_policy(mocked, drop_policy, expected_frames):
+    BlockedVideoWriter.instances = []
+    BlockedVideoWriter.unblock.clear()
+    camera_streaming.cv2.VideoWriter = BlockedVideoWriter
+    try:
+        file_name = os.path.join(tempfile.mkdtemp(prefix="octopus-sensing-test"), "test.avi")
+        recorder = camera_streaming.FrameRecorder("test", file_name, (640, 480), 20.0,
+                                                   queue_size=4, drop_policy=drop_policy)
+        recorder.submit(0, time.time())
+        # Waiting for the encoder to get blocked on the first frame
+        time.sleep(0.1)
+        submitting = threading.Thread(
+            target=lambda: [recorder.submit(i, time.time()) for i in range(1, 20)])
+        submitting.start()
+        time.sleep(0.2)
+        BlockedVideoWriter.unblock.set()
+        submitting.join()
+        recorder.finish()
+        recorder.join()
+    finally:
+        del camera_streaming.cv2.VideoWriter
+
+    assert BlockedVideoWriter.instances[0].frames == expected_frames
+    assert recorder.captured_frames == 20
+    assert recorder.dropped_frames == 20 - len(expected_frames)
+    assert recorder.written_frames == len(expected_frames)
+
+
+def test_realtime_frames_and_frame_rate(mocked):
+    device = camera_streaming.CameraStreaming(
+        camera_no=0, output_path=tempfile.mkdtemp(prefix="octopus-sensing-test"),
+        name="camera")
+    device._video_capture = MockedVideoCaptureModule(0)
+    capture_thread = threading.Thread(target=device._stream_loop)
+    capture_thread.start()
+    try:
+        time.sleep(1.3)
+        realtime_data = device._get_realtime_data(3)
+    finally:
+        device._terminate = True
+        capture_thread.join()
+
+    # Frames are one second apart, and the latest one is included
+    assert len(realtime_data["data"]) == 2
+    # The mocked camera captures a frame every 50ms
+    assert 15 <= realtime_data["metadata"]["frame_rate"] <= 21
+    assert realtime_data["metadata"]["dropped_frames"] == 0
+    # Only a few latest frames are kept
+    assert len(device._realtime_frames._frames) <= \
+        camera_streaming.REALTIME_FRAME_RATE * camera_streaming.REALTIME_DURATION
+
+
+def test_realtime_thumbnails(monkeypatch):
+    # Frames are encoded with the real OpenCV
+    monkeypatch.setattr(camera_streaming, "cv2", cv2)
+    device = camera_streaming.CameraStreaming(
+        camera_no=0, output_path=tempfile.mkdtemp(prefix="octopus-sensing-test"),
+        name="camera")
+    # About five frames per second
+    now = time.time()
+    for i in range(25):
+        frame = np.full((480, 640, 3), i, dtype=np.uint8)
+        device._realtime_frames.append(i * 6, now - (24 - i) * 0.201, frame)
+
+    realtime_data = device._get_realtime_data(2)
+    assert realtime_data["metadata"]["frame_indexes"] == [114, 144]
+    assert realtime_data["data"][1].shape == (480, 640, 3)
+
+    options = {"width": 160, "quality": 70, "fps": 5}
+    realtime_data = device._get_realtime_data_with_options(1, None, options)
+    assert realtime_data["metadata"]["frame_indexes"] == [120, 126, 132, 138, 144]
+    assert realtime_data["metadata"]["format"] == "jpeg"
+    images = realtime_data["data"]
+    assert all(isinstance(image, bytes) for image in images)
+    image = cv2.imdecode(np.frombuffer(images[-1], dtype=np.uint8), cv2.IMREAD_COLOR)
+    assert image.shape == (120, 160, 3)
+    assert abs(int(image.mean()) - 24) <= 2
+
+    # Encoded frames are cached for the next polls
+    assert device._get_realtime_data_with_options(1, None, options)["data"][0] is images[0]
+    device._realtime_frames.append(150, now + 0.201, np.zeros((480, 640, 3), dtype=np.uint8))
+    realtime_data = device._get_realtime_data_with_options(1, None, options)
+    assert realtime_data["data"][:4] == images[1:]
+    # Frames that are not in the buffer anymore are removed from the cache
+    for i in range(25):
+        device._realtime_frames.append(
+            156 + i * 6, now + 0.402 + i * 0.201, np.zeros((480, 640, 3), dtype=np.uint8))
+    device._get_realtime_data_with_options(1, None, options)
+    encoded_frames = device._realtime_frames._encoded_frames
+    assert sorted(key[0] for key in encoded_frames) == [276, 282, 288, 294, 300]
+
+    png = device._get_realtime_data_with_options(1, None, {"format": "png"})["data"][-1]
+    assert png.startswith(b"\x89PNG")
+    assert cv2.imdecode(np.frombuffer(png, dtype=np.uint8), cv2.IMREAD_COLOR).shape == \
+        (480, 640, 3)
@@ -12,25 +12,45 @@
 # You should have received a copy of the GNU General Public License along with Foobar.
 # If not, see <https://www.gnu.org/licenses/>.
 
+import os
 import time
+import multiprocessing
+import threading
+import tempfile
 import pytest
 
 from octopus_sensing.device_coordinator import RealtimeDataCache, DeviceCoordinator
 from octopus_sensing.devices.device import Device
+from octopus_sensing.devices.realtime_data_device import RealtimeDataDevice
+import octopus_sensing.devices.testdevice_streaming as testdevice_streaming
+from octopus_sensing.common.message_creators import start_message, save_message, MessageType
 
 
 def test_realtime_data_cache():
     cache = RealtimeDataCache()
 
-    data = [1, 2, 3]
+    data = {"data": [1, 2, 3], "metadata": {"sampling_rate": 20}}
 
-    cache.cache(data)
+    cache.cache("eeg", (3, None), data)
 
     time.sleep(0.02)
-    assert cache.get_cache() == data
+    assert cache.get("eeg", (3, None))[1] == data
+    # Different parameters or devices are not cached
+    assert cache.get("eeg", (10, None)) is None
+    assert cache.get("camera", (3, None)) is None
 
+    # TTL is one sample period
+    assert cache.get_ttl("eeg") == 0.05
+    time.sleep(0.05)
+    assert cache.get("eeg", (3, None)) is None
+
+    cache.set_ttl("eeg", 1)
+    cache.cache("eeg", (3, None), data)
     time.sleep(0.1)
-    assert cache.get_cache() is None
+    assert cache.get("eeg", (3, None))[1] == data
+
+    assert cache.get_stats() == {"eeg": {"hits": 2, "misses": 2},
+                                 "camera": {"hits": 0, "misses": 1}}
 
 
 def fake_run():
@@ -52,3 +72,180 @@ def test_should_not_add_duplicated_deivces():
     coordinator.add_device(test_device)
     with pytest.raises(RuntimeError):
         coordinator.add_device(test_device)
+
+
+def test_wait_until_saved():
+    output_dir = tempfile.mkdtemp(prefix="octopus-sensing-test")
+    experiment_id = "test-exp-1"
+    test_device = testdevice_streaming.TestDeviceStreaming(100, name="test_device",
+                                                           output_path=output_dir)
+    coordinator = DeviceCoordinator()
+    coordinator.add_device(test_device)
+    # A device that doesn't report its handled messages shouldn't block the waiting
+    other_device = Device(name="device1")
+    other_device._run = fake_run
+    coordinator.add_device(other_device)
+
+    try:
+        coordinator.dispatch(start_message(experiment_id, "stimulus-1"))
+        time.sleep(0.2)
+        coordinator.dispatch(save_message(experiment_id))
+        assert coordinator.wait_until_saved(timeout=5)
+        assert test_device.get_handled_message_count() == 2
+        assert other_device.get_handled_message_count() is None
+
+        file_path = os.path.join(output_dir, "test_device",
+                                 "test_device-{0}.csv".format(experiment_id))
+        with open(file_path) as csv_file:
+            lines = csv_file.read().splitlines()
+        assert any(line.endswith("START-{0}-stimulus-1".format(experiment_id))
+                   for line in lines)
+
+        # The device keeps recording, and the next save only appends the new samples
+        time.sleep(0.2)
+        coordinator.dispatch(save_message(experiment_id))
+        assert coordinator.wait_until_saved(timeout=5)
+        with open(file_path) as csv_file:
+            assert len(csv_file.read().splitlines()) > len(lines)
+    finally:
+        coordinator.terminate()
+
+
+def test_dispatch_from_several_threads():
+    coordinator = DeviceCoordinator()
+    threads = [threading.Thread(
+        target=lambda: [coordinator.dispatch(save_message("exp")) for _ in range(1000)])
+        for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # No dispatched message is missed, otherwise wait_until_saved returns too early
+    assert coordinator._DeviceCoordinator__dispatched_messages == 8000
+
+
+class SlowRealtimeDevice(RealtimeDataDevice):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Seconds that the replies take
+        self.slow = multiprocessing.Value('d', 0)
+
+    def _run(self):
+        while self.message_queue.get().type != MessageType.TERMINATE:
+            pass
+
+    def _get_realtime_data(self, duration, since=None):
+        # Replies after the coordinator's deadline
+        time.sleep(0.5 if duration == 2 else self.slow.value)
+        return {"data": [duration], "metadata": {"type": "slow"}}
+
+
+def test_realtime_data_timeouts():
+    coordinator = DeviceCoordinator()
+    device = SlowRealtimeDevice(name="slow")
+    coordinator.add_device(device)
+    try:
+        result = coordinator.get_realtime_data(1, None, timeout=2)
+        assert result["slow"]["data"] == [1]
+        assert result["slow"]["metadata"]["stale"] is False
+
+        # Waiting for the cache to expire
+        time.sleep(0.15)
+        device.slow.value = 0.5
+        result = coordinator.get_realtime_data(1, None, timeout=0.1)
+        # The previous data is returned instead
+        assert result["slow"]["data"] == [1]
+        assert result["slow"]["metadata"]["stale"] is True
+        assert result["slow"]["metadata"]["age"] >= 0.15
+
+        # The previous data has another duration, so it can't be returned
+        result = coordinator.get_realtime_data(2, None, timeout=0.1)
+        assert "slow" not in result
+
+        # The late replies of the previous requests should be discarded
+        device.slow.value = 0
+        time.sleep(1.2)
+        result = coordinator.get_realtime_data(3, None, timeout=2)
+        assert result["slow"]["data"] == [3]
+        assert result["slow"]["metadata"]["stale"] is False
+
+        stats = coordinator.get_realtime_data_stats()["slow"]
+        assert stats["requests"] == 4
+        assert stats["timeouts"] == 2
+        assert stats["stale_replies"] == 2
+    finally:
+        coordinator.terminate()
+
+
+def test_coalesced_request_timeout():
+    coordinator = DeviceCoordinator()
+    device = SlowRealtimeDevice(name="slow")
+    coordinator.add_device(device)
+    try:
+        assert coordinator.get_realtime_data(1, None, timeout=2)["slow"]["data"] == [1]
+        # Waiting for the cache to expire
+        time.sleep(0.15)
+        device.slow.value = 2
+        results = []
+        fetching = threading.Thread(
+            target=lambda: results.append(coordinator.get_realtime_data(1, None, timeout=3)))
+        fetching.start()
+        time.sleep(0.05)
+        # It waits for the other call's request, which takes longer than its timeout
+        result = coordinator.get_realtime_data(1, None, timeout=0.1)
+        assert result["slow"]["data"] == [1]
+        assert result["slow"]["metadata"]["stale"] is True
+        fetching.join()
+        assert results[0]["slow"]["metadata"]["stale"] is False
+
+        stats = coordinator.get_realtime_data_stats()["slow"]
+        assert stats["coalesced"] == 1
+        assert stats["timeouts"] == 1
+    finally:
+        coordinator.terminate()
+
+
+def test_concurrent_realtime_requests_are_coalesced():
+    coordinator = DeviceCoordinator()
+    coordinator.add_device(SlowRealtimeDevice(name="slow"))
+    try:
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(coordinator.get_realtime_data(2, None, timeout=2)))
+            for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert [result["slow"]["data"] for result in results] == [[2]] * 4
+        stats = coordinator.get_realtime_data_stats()["slow"]
+        # Only one of them is sent to the device
+        assert stats["requests"] == 1
+        assert stats["coalesced"] == 3
+
+        # It's cached for the next calls
+        assert coordinator.get_realtime_data(2, None)["slow"]["data"] == [2]
+        assert coordinator.get_realtime_data_stats()["slow"]["cache_hits"] == 1
+    finally:
+        coordinator.terminate()
+
+
+class OptionsRealtimeDevice(SlowRealtimeDevice):
+    def _get_realtime_data_with_options(self, duration, since, options):
+        return {"data": [duration, options], "metadata": {"type": "options"}}
+
+
+def test_realtime_data_options():
+    coordinator = DeviceCoordinator()
+    coordinator.add_device(OptionsRealtimeDevice(name="camera"))
+    try:
+        assert coordinator.get_realtime_data(1, None, timeout=2)["camera"]["data"] == [1]
+        result = coordinator.get_realtime_data(1, None, timeout=2, options={"width": 320})
+        assert result["camera"]["data"] == [1, {"width": 320}]
+        # Requests with different options are cached separately
+        result = coordinator.get_realtime_data(1, None, timeout=2, options={"width": 640})
+        assert result["camera"]["data"] == [1, {"width": 640}]
+        assert coordinator.get_realtime_data_stats()["camera"]["requests"] == 3
+    finally:
+        coordinator.terminate()
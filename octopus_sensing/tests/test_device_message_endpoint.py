@@ -77,6 +77,18 @@ def test_type_is_mandatory(fixture):
     assert response.status == 400
 
 
+
+def test_stimulus_id_should_be_a_string(fixture):
+    endpoint, coordinator, test_device, http_client, = fixture
+
+    http_client.request(
+        "POST", "/",
+        body=msgpack.packb({'type': 'START', 'experiment_id': '123', 'stimulus_id': 8}),
+        headers={'Accept': 'application/msgpack'})
+    response = http_client.getresponse()
+    assert response.status == 400
+    assert test_device.message_queue.empty()
+
 def test_json(fixture):
     endpoint, coordinator, test_device, http_client, = fixture
 
@@ -113,6 +125,24 @@ def test_pickle(fixture):
     assert message.payload == {'data': 100}
 
 
+def test_keep_alive(fixture):
+    endpoint, coordinator, test_device, http_client, = fixture
+
+    for message_type in ['START', 'STOP']:
+        http_client.request(
+            "POST", "/",
+            body=json.dumps({'type': message_type, 'experiment_id': '123'}),
+            headers={'Accept': 'application/json'})
+        response = http_client.getresponse()
+        assert response.status == 200
+        assert response.getheader("Content-Type") == "application/json"
+        assert json.loads(response.read()) == "message dispatched"
+        assert not response.will_close
+
+        message = test_device.message_queue.get(timeout=2)
+        assert message.type == message_type
+
+
 def test_bad_content_type(fixture):
     endpoint, coordinator, test_device, http_client, = fixture
 
@@ -111,7 +111,8 @@ def test_lsl_streaming(device: lsl_streaming.LslStreaming):
     filecontent = open(os.path.join(lsl_output, filename), 'r').read()
     print(f"filecontent: {filecontent}, length={len(filecontent)}")
     assert len(filecontent) >= 375
-    # TODO: Check if the triggers are there.
+    assert f"START-{experiment_id}-{stimuli_id}" in filecontent
+    assert f"STOP-{experiment_id}-{stimuli_id}" in filecontent
     # TODO: We can check data in realtime data queues as well.
 
 def test_save_message(device: lsl_streaming.LslStreaming):
@@ -182,3 +183,56 @@ def test_save_message(device: lsl_streaming.LslStreaming):
 
 # TODO: Test non-continuous mode
 # TODO: Test real time data queues
+
+
+class FastLslDevice(threading.Thread):
+    '''Streams 2000 samples per second, in chunks'''
+    def __init__(self, lsl_device_name: str):
+        super().__init__(daemon=True)
+        info = StreamInfo(name=lsl_device_name, type="EEG", channel_count=8,
+                          nominal_srate=2000, channel_format=cf_float32,
+                          source_id="octopus-test-fast-stream")
+        self.outlet = StreamOutlet(info)
+        self.__running_flag = True
+
+    def stop_device(self):
+        self.__running_flag = False
+
+    def run(self):
+        value = 0
+        while self.__running_flag is True:
+            chunk = [[float(value + i)] * 8 for i in range(20)]
+            value += 20
+            self.outlet.push_chunk(chunk)
+            time.sleep(0.01)
+        del self.outlet
+
+
+def test_high_rate_stream():
+    output_dir = tempfile.mkdtemp(prefix="octopus-sensing-test")
+    device_name = f"lsl_fast_test_device-{time.time()}"
+    device = lsl_streaming.LslStreaming(device_name, "name", device_name, 2000,
+                                        output_path=output_dir)
+    remote_lsl_device = FastLslDevice(device_name)
+    remote_lsl_device.start()
+
+    msg_queue: multiprocessing.Queue = multiprocessing.Queue()
+    device.set_queue(msg_queue)
+    device.set_realtime_data_queues(multiprocessing.Queue(), multiprocessing.Queue())
+    device.start()
+    time.sleep(1.5)
+
+    msg_queue.put(start_message("exp", "sti"))
+    time.sleep(1)
+    msg_queue.put(terminate_message())
+    device.join()
+    remote_lsl_device.stop_device()
+    remote_lsl_device.join()
+
+    file_path = os.path.join(device.output_path, f"{device_name}-exp.csv")
+    assert "START-exp-sti" in open(file_path).read()
+    rows = np.loadtxt(file_path, delimiter=",", usecols=range(9))
+    # No sample is lost or repeated
+    assert len(rows) >= 2000
+    assert np.all(np.diff(rows[:, 0]) == 1)
+    assert np.all(np.diff(rows[:, 8]) >= 0)
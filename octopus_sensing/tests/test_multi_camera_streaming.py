@@ -0,0 +1,128 @@
+# This file is part of Octopus Sensing <https://octopus-sensing.nastaran-saffar.me/>
+# Copyright © Nastaran Saffaryazdi 2020-2026
+#
+# Octopus Sensing is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation,
+#  either version 3 of the License, or (at your option) any later version.
+#
+# Octopus Sensing is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Octopus Sensing.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import csv
+import multiprocessing
+import os
+import time
+import tempfile
+
+import cv2
+import numpy as np
+
+from octopus_sensing.devices.common import FrameDropPolicyEnum
+from octopus_sensing.devices.camera_streaming import FrameRecorder
+from octopus_sensing.devices.multi_camera_streaming import MultiCameraStreaming, _Recording
+from octopus_sensing.common.message_creators import start_message, stop_message, terminate_message
+
+
+def make_video(file_name, brightness):
+    '''Frame i of the video is filled with brightness[i]'''
+    writer = cv2.VideoWriter(file_name, cv2.VideoWriter_fourcc(*'MJPG'), 30, (64, 48))
+    for value in brightness:
+        writer.write(np.full((48, 64, 3), value, dtype=np.uint8))
+    writer.release()
+
+
+def read_video(file_name):
+    '''Returns the mean brightness of each frame'''
+    video_capture = cv2.VideoCapture(file_name)
+    brightness = []
+    while True:
+        ret, frame = video_capture.read()
+        if not ret:
+            break
+        brightness.append(frame.mean())
+    video_capture.release()
+    return np.array(brightness)
+
+
+def read_csv(file_name):
+    with open(file_name) as csv_file:
+        return list(csv.reader(csv_file))
+
+
+def test_video_files_are_recorded_in_sync():
+    output_dir = tempfile.mkdtemp(prefix="octopus-sensing-test")
+    face_video = os.path.join(output_dir, "face.avi")
+    body_video = os.path.join(output_dir, "body.avi")
+    # One second of video. Brightness of face goes up, and body goes down.
+    make_video(face_video, range(0, 240, 8))
+    make_video(body_video, range(232, -8, -8))
+
+    device = MultiCameraStreaming(camera_paths=[face_video, body_video],
+                                  camera_names=["face", "body"],
+                                  drop_policy=FrameDropPolicyEnum.BLOCK_POLICY,
+                                  name="cameras",
+                                  output_path=output_dir)
+    msg_queue = multiprocessing.Queue()
+    device.set_queue(msg_queue)
+    device.set_realtime_data_queues(multiprocessing.Queue(), multiprocessing.Queue())
+    # Recording starts as soon as the device starts
+    msg_queue.put(start_message("exp", "sti"))
+    device.start()
+    time.sleep(2)
+    msg_queue.put(stop_message("exp", "sti"))
+    msg_queue.put(terminate_message())
+    device.join()
+    # All messages are acknowledged after the files are written
+    assert device.get_handled_message_count() == 3
+
+    device_output = os.path.join(output_dir, "cameras")
+    assert sorted(os.listdir(device_output)) == \
+        ["cameras-body-exp-sti-timestamps.csv", "cameras-body-exp-sti.avi",
+         "cameras-exp-sti-timestamps.csv",
+         "cameras-face-exp-sti-timestamps.csv", "cameras-face-exp-sti.avi"]
+
+    face = read_video(os.path.join(device_output, "cameras-face-exp-sti.avi"))
+    body = read_video(os.path.join(device_output, "cameras-body-exp-sti.avi"))
+    assert len(face) >= 25
+    assert len(face) == len(body)
+    # Frames of both videos are taken at the same time. Otherwise, the sum would be
+    # 16 more or less.
+    assert np.all(np.abs(face + body - 232) < 8)
+
+    index = read_csv(os.path.join(device_output, "cameras-exp-sti-timestamps.csv"))
+    assert index[0] == ["frame", "timestamp", "face", "body", "trigger"]
+    assert len(index) - 1 == len(face)
+    assert all(row[2] == row[3] == row[0] for row in index[1:])
+    assert index[1][4] == "START-exp-sti"
+    assert index[-1][4] == "STOP-exp-sti"
+
+    # Each video's frames have the same timestamps as the shared index
+    face_timestamps = read_csv(os.path.join(device_output, "cameras-face-exp-sti-timestamps.csv"))
+    body_timestamps = read_csv(os.path.join(device_output, "cameras-body-exp-sti-timestamps.csv"))
+    assert [row[1] for row in face_timestamps[1:]] == [row[1] for row in index[1:]]
+    assert [row[1] for row in body_timestamps[1:]] == [row[1] for row in index[1:]]
+
+
+def test_frames_after_finish_are_ignored():
+    output_dir = tempfile.mkdtemp(prefix="octopus-sensing-test")
+    recorders = [FrameRecorder(name, os.path.join(output_dir, name + ".avi"), (64, 48), 30,
+                               10, FrameDropPolicyEnum.BLOCK_POLICY, start_trigger="START")
+                 for name in ["face", "body"]]
+    recording = _Recording(recorders, os.path.join(output_dir, "index.csv"),
+                           ["face", "body"], "START")
+    frame = np.zeros((48, 64, 3), dtype=np.uint8)
+    for capture_time in [1.0, 2.0, 3.0]:
+        recording.submit([frame, frame], capture_time)
+    recording.finish("STOP")
+    # The capture loop may grab one more set of frames before it sees the end
+    recording.submit([frame, frame], 4.0)
+    recording.join()
+
+    index = read_csv(os.path.join(output_dir, "index.csv"))
+    assert index[1:] == [["0", "1.0", "0", "0", "START"],
+                         ["1", "2.0", "1", "1"],
+                         ["2", "3.0", "2", "2", "STOP"]]
@@ -0,0 +1,65 @@
+# This file is part of Octopus Sensing <https://octopus-sensing.nastaran-saffar.me/>
+# Copyright © Nastaran Saffaryazdi 2020-2026
+#
+# Octopus Sensing is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation,
+#  either version 3 of the License, or (at your option) any later version.
+#
+# Octopus Sensing is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Octopus Sensing.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import msgpack
+import numpy as np
+
+from octopus_sensing.common.ndarray_encoding import \
+    encode_ndarray_response, decode_ndarray_response, msgpack_ext_default, msgpack_ext_hook
+
+
+def make_response():
+    return {"eeg": {"data": np.arange(15, dtype=np.float32).reshape(5, 3),
+                    "timestamps": np.linspace(0, 1, 5),
+                    "triggers": {"2": "START-exp-01"},
+                    "cursor": np.int64(5),
+                    "metadata": {"sampling_rate": 128}},
+            "gsr": {"data": np.arange(7, dtype=np.int16)[::2],
+                    "empty": np.empty((0, 4)),
+                    "names": np.array(["a", "b"])}}
+
+
+def check_decoded(decoded):
+    assert decoded["eeg"]["data"].dtype == np.float32
+    assert np.array_equal(decoded["eeg"]["data"], np.arange(15).reshape(5, 3))
+    assert np.array_equal(decoded["eeg"]["timestamps"], np.linspace(0, 1, 5))
+    assert decoded["eeg"]["triggers"] == {"2": "START-exp-01"}
+    assert decoded["eeg"]["cursor"] == 5
+    assert decoded["eeg"]["metadata"] == {"sampling_rate": 128}
+    assert np.array_equal(decoded["gsr"]["data"], [0, 2, 4, 6])
+    assert decoded["gsr"]["empty"].shape == (0, 4)
+    assert list(decoded["gsr"]["names"]) == ["a", "b"]
+
+
+def test_ndarray_response_roundtrip():
+    response = make_response()
+    buffers = encode_ndarray_response(response)
+    # Contiguous arrays are not copied
+    assert any(isinstance(buffer, memoryview) and buffer.obj is response["eeg"]["data"]
+               for buffer in buffers)
+
+    body = b"".join(buffers)
+    assert len(body) % 8 == 0
+    check_decoded(decode_ndarray_response(body))
+
+
+def test_bytes_are_uint8_arrays():
+    decoded = decode_ndarray_response(b"".join(encode_ndarray_response({"image": b"\xff\xd8"})))
+    assert decoded["image"].dtype == np.uint8
+    assert decoded["image"].tobytes() == b"\xff\xd8"
+
+
+def test_msgpack_ext_roundtrip():
+    body = msgpack.packb(make_response(), default=msgpack_ext_default)
+    check_decoded(msgpack.unpackb(body, ext_hook=msgpack_ext_hook))
@@ -13,10 +13,13 @@
 # If not, see <https://www.gnu.org/licenses/>.
 import os
 
+import pytest
+
 from octopus_sensing.devices.shimmer3_streaming import Shimmer3Streaming
 from octopus_sensing.devices.openbci_streaming import OpenBCIStreaming
 from octopus_sensing.devices.common import SavingModeEnum
-from octopus_sensing.preprocessing.preprocess_devices import preprocess_devices
+from octopus_sensing.preprocessing.preprocess_devices import preprocess_devices, \
+    run_preprocessing_jobs, PreprocessingJob
 from octopus_sensing.device_coordinator import DeviceCoordinator
 
 RECORDED_FILES_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)),
@@ -136,10 +139,13 @@ def test_preprocess_seperated_saving_mode():
     device_coordinator.add_devices([openbci16, openbci8, shimmer])
 
     preprocess_file_path = "/tmp/preprocess"
+    # Files are preprocessed in parallel. The output should be the same.
     preprocess_devices(device_coordinator, preprocess_file_path,
                        openbci_sampling_rate=6,
                        shimmer3_sampling_rate=6,
-                       signal_preprocess=False)
+                       signal_preprocess=False,
+                       workers=2,
+                       max_pending_jobs=3)
 
     expected_openbci16_path = \
         os.path.join(os.path.dirname(os.path.realpath(__file__)),
@@ -168,6 +174,24 @@ def test_preprocess_seperated_saving_mode():
     check_files(preprocess_shimmer_path, expected_shimmer_path)
 
 
+def failing_job(file_name):
+    raise ValueError("Can't preprocess " + file_name)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_preprocessing_errors(workers):
+    output_path = "/tmp/preprocess/errors"
+    os.makedirs(output_path, exist_ok=True)
+    jobs = [PreprocessingJob("bad1", failing_job, ("bad1",), {}),
+            PreprocessingJob("good", os.makedirs, (os.path.join(output_path, str(workers)),),
+                             dict(exist_ok=True)),
+            PreprocessingJob("bad2", failing_job, ("bad2",), {})]
+    # The other jobs run, and the failed ones are reported at the end
+    with pytest.raises(RuntimeError, match="bad1, bad2"):
+        run_preprocessing_jobs(jobs, workers=workers)
+    assert os.path.exists(os.path.join(output_path, str(workers)))
+
+
 def check_files(preprocess_path, expected_path):
     expected_files = os.listdir(expected_path)
     preprocess_files = os.listdir(preprocess_path)
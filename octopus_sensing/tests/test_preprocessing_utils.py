@@ -0,0 +1,126 @@
+# This file is part of Octopus Sensing <https://octopus-sensing.nastaran-saffar.me/>
+# Copyright © Nastaran Saffaryazdi 2020-2026
+#
+# Octopus Sensing is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation,
+#  either version 3 of the License, or (at your option) any later version.
+#
+# Octopus Sensing is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Octopus Sensing.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import csv
+import datetime
+import os
+
+import numpy as np
+import pytest
+
+from octopus_sensing.preprocessing.utils import load_csv, split_trials, load_all_trials, str_to_times, \
+    resample, iter_trials
+
+RECORDED_FILES_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                   "data/recorded")
+SHIMMER_FILE = os.path.join(RECORDED_FILES_PATH, "Shimmer_continuous", "Shimmer-20-cont.csv")
+
+
+def test_load_csv():
+    with open(SHIMMER_FILE) as csv_file:
+        rows = list(csv.reader(csv_file))[1:]
+
+    data, times, triggers = load_csv(SHIMMER_FILE, (5, 7), time_stamp_col=7, triger_col=8)
+    assert data.dtype == np.float32
+    assert data.shape == (len(rows), 2)
+    assert np.array_equal(data, np.array([row[5:7] for row in rows], dtype=np.float32))
+    assert times.tolist() == [row[7] for row in rows]
+    assert triggers == {i: row[8] for i, row in enumerate(rows) if row[8] != ''}
+
+
+def test_split_trials():
+    triggers = {2: "START-20-00-00", 5: "START-20-00-00", 8: "STOP-20-00-00",
+                9: "STOP-20-00-07", 12: "START-20-00-01", 15: "STOP-20-00-01",
+                20: "START-20-00-02"}
+    # A repeated START is ignored, a STOP without START is an empty trial, and a trial
+    # without STOP is dropped.
+    assert split_trials(triggers) == [(0, 2, 8), (7, 9, 9), (1, 12, 15)]
+
+    trials_data, trials_times, trial_numbers = \
+        load_all_trials(SHIMMER_FILE, (5, 7), 7, 8, '%Y-%m-%d %H:%M:%S.%f')
+    assert trial_numbers == [0, 1, 2]
+    assert [len(trial) for trial in trials_data] == [len(times) for times in trials_times]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 100000])
+def test_iter_trials(chunk_size):
+    data, times, triggers = load_csv(SHIMMER_FILE, (5, 7), time_stamp_col=7, triger_col=8)
+    trials = list(iter_trials(SHIMMER_FILE, (5, 7), 8, time_stamp_col=7,
+                              time_format='%Y-%m-%d %H:%M:%S.%f', chunk_size=chunk_size))
+    # Trials spanning several chunks are the same as splitting the whole file
+    expected_trials = split_trials(triggers)
+    assert len(trials) == len(expected_trials)
+    for (trial_number, trial, trial_times), (expected_number, start, end) in \
+            zip(trials, expected_trials):
+        assert trial_number == expected_number
+        assert trial.dtype == np.float32
+        assert np.array_equal(trial, data[start:end])
+        assert np.array_equal(trial_times,
+                              str_to_times(times[start:end], '%Y-%m-%d %H:%M:%S.%f'))
+
+
+def test_iter_trials_without_time(tmp_path):
+    file_path = str(tmp_path / "recorded.csv")
+    triggers = {1: "STOP-20-00-07", 2: "START-20-00-00", 4: "START-20-00-00",
+                6: "STOP-20-00-00", 8: "START-20-00-01"}
+    with open(file_path, 'w') as csv_file:
+        for i in range(10):
+            # Rows without trigger don't have the trigger column
+            csv_file.write("{0},{1}{2}\n".format(i, i * 10,
+                                                 "," + triggers[i] if i in triggers else ""))
+    trials = list(iter_trials(file_path, (0, 2), 2, has_header=False, chunk_size=3))
+    # The same rules as split_trials
+    assert [(number, trial[:, 0].tolist(), times) for number, trial, times in trials] == \
+        [(7, [], None), (0, [2, 3, 4, 5], None)]
+
+
+def test_str_to_times():
+    times = ["13:16:06.111111", "13:16:08", "9:05:03.5", "2020-11-03 13:16:06"]
+    converted_times = str_to_times(times, '%H:%M:%S.%f')
+    assert converted_times.dtype == np.dtype("datetime64[ns]")
+    # The same as parsing them one by one
+    expected = [datetime.datetime(1900, 1, 1, 13, 16, 6, 111111),
+                datetime.datetime(1900, 1, 1, 13, 16, 8),
+                datetime.datetime(1900, 1, 1, 9, 5, 3, 500000),
+                datetime.datetime(2020, 11, 3, 13, 16, 6)]
+    assert np.array_equal(converted_times, np.array(expected, dtype="datetime64[ns]"))
+
+
+def test_resample():
+    start = np.datetime64("2020-11-03T13:16:06", "ns")
+    seconds = np.array([0, 0.2, 0.4, 0.6, 1.5, 1.6, 1.7, 1.8, 1.9, 4.5, 4.6, 4.7, 5.0])
+    times = start + (seconds * 1e9).astype("timedelta64[ns]")
+    data = np.arange(len(seconds), dtype=np.float32)
+    resampled = resample(data, times, 3)
+    # Short blocks are padded by repeating their last samples, long ones are truncated.
+    # After the gap, blocks have only one sample until they catch up with the time.
+    # The last block (4.7 to 5.0) is more than half full, so it's kept.
+    assert resampled.tolist() == [0, 1, 2, 4, 5, 6, 9, 9, 9, 10, 10, 10, 11, 12, 12]
+    # With a higher sampling rate, the last block is dropped
+    assert len(resample(data, times, 8)) == 4 * 8
+
+
+def test_polyphase_resample():
+    pytest.importorskip("scipy")
+    # Ten seconds of a 5 Hz sine, sampled at irregular times around 250 Hz
+    rng = np.random.default_rng(0)
+    seconds = np.cumsum(rng.uniform(0.002, 0.006, 2500))
+    times = np.datetime64("2020-11-03T13:16:06", "ns") + (seconds * 1e9).astype("timedelta64[ns]")
+    data = np.sin(2 * np.pi * 5 * seconds)
+
+    resampled = resample(data, times, 64, method="polyphase")
+    assert abs(len(resampled) - (seconds[-1] - seconds[0]) * 64) < 2
+    spectrum = np.abs(np.fft.rfft(resampled))
+    frequencies = np.fft.rfftfreq(len(resampled), 1 / 64)
+    assert abs(frequencies[np.argmax(spectrum)] - 5) < 0.2
@@ -0,0 +1,217 @@
+# This file is part of Octopus Sensing <https://octopus-sensing.nastaran-saffar.me/>
+# Copyright © Nastaran Saffaryazdi 2020-2026
+#
+# Octopus Sensing is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation,
+#  either version 3 of the License, or (at your option) any later version.
+#
+# Octopus Sensing is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Octopus Sensing.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import gzip
+import zlib
+import http.client
+import json
+
+import pytest
+import msgpack
+import numpy as np
+
+from octopus_sensing.common.endpoint_base import read_stream_frames
+from octopus_sensing.common.ndarray_encoding import \
+    NDARRAY_CONTENT_TYPE, decode_ndarray_response
+from octopus_sensing.devices.device import Device
+from octopus_sensing.realtime_data_endpoint import RealtimeDataEndpoint
+
+
+class FakeCoordinator:
+    def __init__(self):
+        self.calls = []
+        self.options = []
+
+    def get_devices(self):
+        return [Device(name="eeg"), Device(name="gsr")]
+
+    def get_realtime_data(self, duration, device_list, since=None, options=None):
+        self.calls.append((duration, device_list, since))
+        self.options.append(options)
+        return {"eeg": {"data": [[1, 2]], "cursor": 11}}
+
+
+@pytest.fixture()
+def fixture():
+    coordinator = FakeCoordinator()
+    endpoint = RealtimeDataEndpoint(coordinator)
+    endpoint.start()
+
+    time.sleep(0.5)
+
+    http_client = http.client.HTTPConnection("127.0.0.1:9330", timeout=2)
+
+    yield (coordinator, http_client)
+
+    endpoint.stop()
+
+
+def test_default_params(fixture):
+    coordinator, http_client = fixture
+
+    http_client.request("GET", "/", headers={"Accept": "application/json"})
+    response = http_client.getresponse()
+    assert response.status == 200
+    assert json.loads(response.read()) == {"eeg": {"data": [[1, 2]], "cursor": 11}}
+    assert coordinator.calls == [(3, None, None)]
+
+
+def test_since_cursor_per_device(fixture):
+    coordinator, http_client = fixture
+
+    http_client.request("GET", "/?duration=5&device_list=eeg,gsr&since=eeg:10,gsr:7",
+                        headers={"Accept": "application/json"})
+    response = http_client.getresponse()
+    assert response.status == 200
+    response.read()
+    assert coordinator.calls == [(5, ["eeg", "gsr"], {"eeg": 10, "gsr": 7})]
+
+
+def test_one_cursor_for_all_devices(fixture):
+    coordinator, http_client = fixture
+
+    http_client.request("GET", "/?since=42", headers={"Accept": "application/json"})
+    response = http_client.getresponse()
+    assert response.status == 200
+    response.read()
+    assert coordinator.calls == [(3, None, {"eeg": 42, "gsr": 42})]
+
+
+
+@pytest.mark.parametrize("query", ["since=abc", "since=eeg:1,gsr:", "duration=x"])
+def test_invalid_query(fixture, query):
+    coordinator, http_client = fixture
+
+    http_client.request("GET", "/?" + query, headers={"Accept": "application/json"})
+    response = http_client.getresponse()
+    assert response.status == 400
+    response.read()
+    assert coordinator.calls == []
+
+def test_ndarray_content_type(fixture):
+    coordinator, http_client = fixture
+    coordinator.get_realtime_data = \
+        lambda duration, device_list, since=None, options=None: {"eeg": {"data": np.ones((4, 2)), "cursor": 4}}
+
+    http_client.request("GET", "/", headers={"Accept": NDARRAY_CONTENT_TYPE})
+    response = http_client.getresponse()
+    assert response.status == 200
+    data = decode_ndarray_response(response.read())
+    assert np.array_equal(data["eeg"]["data"], np.ones((4, 2)))
+    assert data["eeg"]["cursor"] == 4
+
+
+def test_keep_alive_and_compression(fixture):
+    coordinator, http_client = fixture
+    coordinator.get_realtime_data = \
+        lambda duration, device_list, since=None, options=None: {"eeg": {"data": np.zeros((500, 8))}}
+
+    http_client.request("GET", "/", headers={"Accept": "application/json",
+                                             "Accept-Encoding": "gzip"})
+    response = http_client.getresponse()
+    assert response.status == 200
+    assert response.getheader("Content-Type") == "application/json"
+    assert response.getheader("Content-Encoding") == "gzip"
+    body = response.read()
+    assert int(response.getheader("Content-Length")) == len(body)
+    assert json.loads(gzip.decompress(body))["eeg"]["data"] == np.zeros((500, 8)).tolist()
+    sock = http_client.sock
+
+    # The same connection is used for the next request
+    http_client.request("GET", "/", headers={"Accept": "application/json",
+                                             "Accept-Encoding": "gzip;q=0, deflate"})
+    response = http_client.getresponse()
+    assert response.status == 200
+    assert response.getheader("Content-Encoding") == "deflate"
+    assert json.loads(zlib.decompress(response.read()))["eeg"]["data"][0] == [0.0] * 8
+    assert http_client.sock is sock
+
+
+def test_stream(fixture):
+    coordinator, http_client = fixture
+    calls = []
+
+    def get_realtime_data(duration, device_list, since=None, options=None):
+        calls.append(since)
+        # A new record in every other call
+        cursor = len(calls) // 2
+        return {"eeg": {"data": [[cursor]], "cursor": cursor}}
+
+    coordinator.get_realtime_data = get_realtime_data
+
+    http_client.request("GET", "/stream?device_list=eeg&interval=20ms",
+                        headers={"Accept": "application/msgpack"})
+    response = http_client.getresponse()
+    assert response.status == 200
+    frames = read_stream_frames(response)
+    received = [msgpack.unpackb(next(frames)) for _ in range(3)]
+    http_client.close()
+
+    assert [frame["eeg"]["cursor"] for frame in received] == [0, 1, 2]
+    # Cursors of the previous responses are used for the next requests
+    assert calls[:3] == [None, {"eeg": 0}, {"eeg": 1}]
+
+
+def test_stream_server_sent_events(fixture):
+    coordinator, http_client = fixture
+
+    http_client.request("GET", "/stream?interval=0.05s",
+                        headers={"Accept": "text/event-stream"})
+    response = http_client.getresponse()
+    assert response.status == 200
+    assert response.getheader("Content-Type") == "text/event-stream"
+    line = response.readline()
+    assert line.startswith(b"data: ")
+    assert json.loads(line[6:]) == {"eeg": {"data": [[1, 2]], "cursor": 11}}
+    http_client.close()
+
+
+def test_stream_bad_interval(fixture):
+    coordinator, http_client = fixture
+
+    http_client.request("GET", "/stream?interval=soon", headers={"Accept": "application/json"})
+    response = http_client.getresponse()
+    assert response.status == 400
+
+
+def test_realtime_data_options(fixture):
+    coordinator, http_client = fixture
+
+    http_client.request("GET", "/?width=320&quality=70&fps=5&format=JPEG",
+                        headers={"Accept": "application/json"})
+    response = http_client.getresponse()
+    assert response.status == 200
+    response.read()
+    assert coordinator.options == [{"width": 320, "quality": 70, "fps": 5.0, "format": "jpeg"}]
+
+    http_client.request("GET", "/", headers={"Accept": "application/json"})
+    http_client.getresponse().read()
+    assert coordinator.options[-1] is None
+
+    for query in ["width=0", "quality=101", "fps=fast", "format=gif"]:
+        http_client.request("GET", "/?" + query, headers={"Accept": "application/json"})
+        response = http_client.getresponse()
+        response.read()
+        assert response.status == 400
+
+
+def test_bytes_in_json(fixture):
+    coordinator, http_client = fixture
+    coordinator.get_realtime_data = \
+        lambda duration, device_list, since=None, options=None: {"camera": {"data": [b"\xff\xd8"]}}
+
+    http_client.request("GET", "/", headers={"Accept": "application/json"})
+    response = http_client.getresponse()
+    assert json.loads(response.read()) == {"camera": {"data": ["/9g="]}}
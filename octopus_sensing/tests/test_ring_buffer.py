@@ -0,0 +1,169 @@
+# This file is part of Octopus Sensing <https://octopus-sensing.nastaran-saffar.me/>
+# Copyright © Nastaran Saffaryazdi 2020-2026
+#
+# Octopus Sensing is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation,
+#  either version 3 of the License, or (at your option) any later version.
+#
+# Octopus Sensing is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Octopus Sensing.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import pickle
+
+import numpy as np
+
+from octopus_sensing.devices.background_writer import BackgroundWriter
+from octopus_sensing.devices.ring_buffer import RingBuffer, iter_rows
+
+
+def test_latest_is_a_contiguous_view():
+    buffer = RingBuffer(2, 10)
+    for i in range(25):
+        buffer.append([i, i * 10], timestamp=i)
+        # Marking everything as saved, so the buffer doesn't grow.
+        buffer.mark_saved(buffer.sample_count)
+
+    data, timestamps, triggers = buffer.get_latest(7)
+    assert data.base is not None
+    assert data.flags['C_CONTIGUOUS']
+    assert data[:, 0].tolist() == list(range(18, 25))
+    assert data[:, 1].tolist() == [i * 10 for i in range(18, 25)]
+    assert timestamps.tolist() == list(range(18, 25))
+    assert triggers == {}
+    assert buffer.capacity == 10
+    assert len(buffer) == 10
+
+    # Asking for more than capacity
+    data, _, _ = buffer.get_latest(100)
+    assert data[:, 0].tolist() == list(range(15, 25))
+
+
+def test_extend_and_triggers():
+    buffer = RingBuffer(3, 8)
+    buffer.append([0, 0, 0])
+    buffer.mark_saved(buffer.sample_count)
+    block = np.arange(18).reshape(6, 3)
+    buffer.extend(block, np.arange(6), {5: "START-exp-01"})
+    buffer.extend(block + 100, 1.5, {0: "STOP-exp-01"})
+
+    data, timestamps, triggers = buffer.get_latest(4)
+    assert data.tolist() == (block + 100)[2:].tolist()
+    assert timestamps.tolist() == [1.5] * 4
+    assert triggers == {}
+
+    data, timestamps, triggers = buffer.get_latest(8)
+    assert data.tolist() == np.vstack([block[4:], block + 100]).tolist()
+    assert triggers == {1: "START-exp-01", 2: "STOP-exp-01"}
+
+
+def test_unsaved_samples_are_not_overwritten():
+    buffer = RingBuffer(1, 4)
+    for i in range(10):
+        buffer.append([i], timestamp=i, trigger="t{}".format(i) if i % 3 == 0 else None)
+
+    # The buffer should grow instead of losing unsaved samples.
+    assert buffer.capacity >= 10
+    data, timestamps, triggers, end = buffer.take_unsaved()
+    assert data[:, 0].tolist() == list(range(10))
+    assert triggers == {0: "t0", 3: "t3", 6: "t6", 9: "t9"}
+
+    # Taken samples are still protected while they are being written
+    capacity = buffer.capacity
+    for i in range(10, 10 + capacity):
+        buffer.append([i], timestamp=i)
+    assert data[:, 0].tolist() == list(range(10))
+    assert buffer.capacity > capacity
+    buffer.mark_saved(end)
+
+    # Only the samples appended after the previous hand-over are taken
+    data, timestamps, triggers, end = buffer.take_unsaved()
+    assert data[:, 0].tolist() == list(range(10, 10 + capacity))
+    buffer.mark_saved(end)
+
+    buffer.append([100], timestamp=100)
+    data, timestamps, triggers, end = buffer.take_unsaved()
+    assert data[:, 0].tolist() == [100]
+    assert timestamps.tolist() == [100]
+    assert end == 11 + capacity
+
+    # Saved samples are still available for realtime data
+    data, _, triggers = buffer.get_latest(3)
+    assert data[:, 0].tolist() == [8 + capacity, 9 + capacity, 100]
+    assert triggers == {}
+
+
+def test_failed_saving_releases_samples(capsys):
+    def failing_write(file_name, data, timestamps, triggers):
+        raise OSError("No space left on device")
+
+    buffer = RingBuffer(1, 4)
+    writer = BackgroundWriter("test writer")
+    writer.start()
+    for i in range(3):
+        buffer.append([i], timestamp=i)
+    writer.submit_unsaved(buffer, failing_write, "output.csv")
+    writer.stop()
+    assert "3 samples are lost" in capsys.readouterr().err
+
+    # The samples of the failed job are released, so the buffer doesn't grow to keep them
+    for i in range(3, 7):
+        buffer.append([i], timestamp=i)
+    assert buffer.capacity == 4
+    data, _, _, _ = buffer.take_unsaved()
+    assert data[:, 0].tolist() == [3, 4, 5, 6]
+
+
+def test_get_since():
+    buffer = RingBuffer(1, 10)
+    for i in range(25):
+        buffer.append([i], timestamp=i, trigger="t{}".format(i) if i == 23 else None)
+        buffer.mark_saved(buffer.sample_count)
+
+    data, timestamps, triggers, sequence = buffer.get_since(20, 100)
+    assert data[:, 0].tolist() == [20, 21, 22, 23, 24]
+    assert sequence == 20
+    assert triggers == {3: "t23"}
+
+    # Limited by count
+    data, _, _, sequence = buffer.get_since(20, 2)
+    assert data[:, 0].tolist() == [23, 24]
+    assert sequence == 23
+
+    # Older samples are not in the buffer anymore
+    data, _, _, sequence = buffer.get_since(3, 100)
+    assert data[:, 0].tolist() == list(range(15, 25))
+    assert sequence == 15
+
+    # Nothing new
+    data, _, _, sequence = buffer.get_since(25, 100)
+    assert len(data) == 0
+    assert sequence == 25
+
+
+def test_empty_buffer():
+    buffer = RingBuffer(4, 10)
+    data, timestamps, triggers = buffer.get_latest(5)
+    assert data.shape == (0, 4)
+    assert len(timestamps) == 0
+    assert triggers == {}
+
+    # It should be picklable, so it can be passed to the device's process
+    buffer.append([1, 2, 3, 4])
+    copied = pickle.loads(pickle.dumps(buffer))
+    copied.append([5, 6, 7, 8])
+    assert copied.get_latest(2)[0].tolist() == [[1, 2, 3, 4], [5, 6, 7, 8]]
+
+
+def test_iter_rows():
+    buffer = RingBuffer(2, 10)
+    buffer.append([1, 2], timestamp=100)
+    buffer.append([3, 4], timestamp=101, trigger="START-exp-01")
+    rows = list(iter_rows(*buffer.get_latest(2)))
+    assert rows == [[1.0, 2.0, 100.0], [3.0, 4.0, 101.0, "START-exp-01"]]
+
+    rows = list(iter_rows(*buffer.get_latest(2), format_timestamp=lambda t: []))
+    assert rows == [[1.0, 2.0], [3.0, 4.0, "START-exp-01"]]
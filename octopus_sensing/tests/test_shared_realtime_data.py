@@ -0,0 +1,108 @@
+# This file is part of Octopus Sensing <https://octopus-sensing.nastaran-saffar.me/>
+# Copyright © Nastaran Saffaryazdi 2020-2026
+#
+# Octopus Sensing is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation,
+#  either version 3 of the License, or (at your option) any later version.
+#
+# Octopus Sensing is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Octopus Sensing.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import pickle
+import time
+import tempfile
+
+import numpy as np
+
+from octopus_sensing.device_coordinator import DeviceCoordinator
+from octopus_sensing.devices.shared_realtime_data import \
+    SharedRealtimeData, SharedRealtimeDataReader, SharedRealtimeDataWriter
+import octopus_sensing.devices.testdevice_streaming as testdevice_streaming
+
+
+def test_publish_and_read():
+    writer = SharedRealtimeDataWriter()
+    reader = SharedRealtimeDataReader()
+    try:
+        data = np.arange(750 * 16, dtype=np.float64).reshape(750, 16)
+        frames = [np.full((48, 64, 3), i, dtype=np.uint8) for i in range(3)]
+        realtime_data = {"data": data,
+                         "frames": frames,
+                         "timestamps": np.arange(4.0),
+                         "triggers": {3: "START-exp-01"},
+                         "metadata": {"sampling_rate": 250}}
+
+        message = writer.publish(realtime_data)
+        assert isinstance(message, SharedRealtimeData)
+        # Only the small parts are pickled
+        assert len(pickle.dumps(message)) < 1024
+
+        result = reader.read(pickle.loads(pickle.dumps(message)))
+        assert result is not None
+        assert result["data"].tolist() == data.tolist()
+        assert result["data"].dtype == np.float64
+        assert [frame.tolist() for frame in result["frames"]] == \
+            [frame.tolist() for frame in frames]
+        assert result["timestamps"].tolist() == [0, 1, 2, 3]
+        assert result["triggers"] == {3: "START-exp-01"}
+        assert result["metadata"] == {"sampling_rate": 250}
+
+        # The old message is not valid after the segment is overwritten
+        newer = writer.publish(realtime_data)
+        assert newer.segment_name == message.segment_name
+        assert reader.read(message) is None
+        assert reader.read(newer) is not None
+
+        # A larger message needs a new segment
+        larger = writer.publish({"data": np.ones((2000, 16))})
+        assert larger.segment_name != message.segment_name
+        assert reader.read(larger)["data"].shape == (2000, 16)
+
+        # Arrays in nested dictionaries are shared too, e.g. frames of each camera
+        message = writer.publish({"data": {"face": frames, "body": [data]},
+                                  "metadata": {}})
+        assert len(pickle.dumps(message)) < 1024
+        result = reader.read(message)
+        assert [frame.tolist() for frame in result["data"]["face"]] == \
+            [frame.tolist() for frame in frames]
+        assert result["data"]["body"][0].tolist() == data.tolist()
+
+        # Data without large arrays is sent as is
+        small = {"data": [], "metadata": {}}
+        assert writer.publish(small) is small
+        assert reader.read(small) is small
+    finally:
+        reader.close()
+        writer.close()
+
+
+def test_realtime_data_through_shared_memory():
+    output_dir = tempfile.mkdtemp(prefix="octopus-sensing-test")
+    device = testdevice_streaming.TestDeviceStreaming(1000, name="test_device",
+                                                      output_path=output_dir)
+    coordinator = DeviceCoordinator()
+    coordinator.add_device(device)
+    try:
+        time.sleep(0.5)
+        result = coordinator.get_realtime_data(1, None)
+        data = result["test_device"]["data"]
+        assert isinstance(data, np.ndarray)
+        assert data.shape[1] == 2
+        assert len(data) > 100
+        assert len(result["test_device"]["timestamps"]) == len(data)
+        assert result["test_device"]["metadata"]["sampling_rate"] == 1000
+        assert result["test_device"]["cursor"] == \
+            result["test_device"]["sequence"] + len(data)
+
+        # Only the new records after the cursor
+        cursor = result["test_device"]["cursor"]
+        time.sleep(0.1)
+        result = coordinator.get_realtime_data(1, None, {"test_device": cursor})
+        assert result["test_device"]["sequence"] == cursor
+        assert 0 < len(result["test_device"]["data"]) < len(data)
+    finally:
+        coordinator.terminate()
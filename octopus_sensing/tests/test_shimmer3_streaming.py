@@ -0,0 +1,130 @@
+# This file is part of Octopus Sensing <https://octopus-sensing.nastaran-saffar.me/>
+# Copyright © Nastaran Saffaryazdi 2020-2026
+#
+# Octopus Sensing is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation,
+#  either version 3 of the License, or (at your option) any later version.
+#
+# Octopus Sensing is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Octopus Sensing.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import struct
+import random
+import os
+import csv
+import tempfile
+import threading
+
+import numpy as np
+
+from octopus_sensing.devices.shimmer3_streaming import \
+    Shimmer3Streaming, decode_frames, FRAME_SIZE
+
+
+def make_frame(timestamp, x, y, z, ppg, gsr):
+    return struct.pack("<B", 0) + timestamp.to_bytes(3, "little") + \
+        struct.pack("<HHHHH", x, y, z, ppg, gsr)
+
+
+def decode_frame(frame):
+    '''Decodes one frame, the same way the firmware's manual does'''
+    timestamp0, timestamp1, timestamp2 = struct.unpack('BBB', frame[1:4])
+    x, y, z, ppg_raw, gsr_raw = struct.unpack('<HHHHH', frame[4:FRAME_SIZE])
+    rf = [40.2, 287.0, 1000.0, 3300.0][(gsr_raw >> 14) & 0xff]
+    gsr_to_volts = (gsr_raw & 0x3fff) * (3.0/4095.0)
+    return [frame[0], timestamp0 + timestamp1*256 + timestamp2*65536, x, y, z,
+            rf/((gsr_to_volts / 0.5) - 1.0), ppg_raw * (3000.0/4095.0)]
+
+
+def random_frame(index):
+    # Timestamps are ticks of a 32768 Hz clock, and wrap around (128 Hz sampling rate)
+    # GSR values that would make the denominator zero are avoided
+    return make_frame((index * 256 + 2**24 - 1000) % 2**24, random.randrange(2**16),
+                      random.randrange(2**16), random.randrange(2**16),
+                      random.randrange(2**16),
+                      (random.randrange(4) << 14) | random.randrange(700, 2**14))
+
+
+def test_decode_frames():
+    frames = [random_frame(i) for i in range(200)]
+    buffer = b"".join(frames) + frames[0][:5]
+
+    records, consumed = decode_frames(buffer)
+    assert consumed == 200 * FRAME_SIZE
+    assert records.shape == (200, 7)
+    assert np.allclose(records, [decode_frame(frame) for frame in frames])
+
+
+def test_decode_frames_resynchronizes():
+    # 128 Hz
+    frames = [make_frame(i * 256, i, 2, 3, 4, 1000) for i in range(1, 10)]
+    # Some bytes of the third frame are lost
+    buffer = b"".join(frames[:2]) + frames[2][:9] + b"".join(frames[3:])
+
+    records, consumed = decode_frames(buffer)
+    assert consumed == len(buffer)
+    assert list(records[:, 2]) == [1, 2, 4, 5, 6, 7, 8, 9]
+
+
+class FakeSerial:
+    def __init__(self, frames):
+        self._pending = b"".join(frames)
+
+    @property
+    def in_waiting(self):
+        return len(self._pending)
+
+    def read(self, size):
+        if size == 1:
+            # Ack
+            return b"\xff"
+        data = self._pending[:size]
+        self._pending = self._pending[size:]
+        if len(data) == 0:
+            time.sleep(0.01)
+        return data
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_stream_loop():
+    frames = [random_frame(i) for i in range(1000)]
+    device = Shimmer3Streaming(name="shimmer", output_path=tempfile.mkdtemp())
+    device._serial = FakeSerial(frames)
+    device._trigger = "START-exp-01"
+
+    loop_thread = threading.Thread(target=device._stream_loop)
+    loop_thread.start()
+    time.sleep(0.5)
+    device._break_loop = True
+    loop_thread.join()
+
+    data, timestamps, triggers = device._stream_data.get_latest(2000)
+    assert np.allclose(data, [decode_frame(frame) for frame in frames])
+    assert np.all(np.diff(timestamps) > 0)
+    assert triggers == {0: "START-exp-01"}
+
+
+def test_write_to_file():
+    frames = [make_frame(i * 256, i, 2, 3, 4, 1000) for i in range(1, 4)]
+    records, _ = decode_frames(b"".join(frames))
+    device = Shimmer3Streaming(name="shimmer", output_path=tempfile.mkdtemp())
+    file_name = os.path.join(device.output_path, "shimmer.csv")
+    device._write_to_file(file_name, records, np.array([1.0, 2.0, 3.0]), {1: "START-exp-01"})
+
+    with open(file_name) as csv_file:
+        rows = list(csv.reader(csv_file))
+    assert rows[0][:5] == ["type", "time stamp", "Acc_x", "Acc_y", "Acc_z"]
+    assert [row[:5] for row in rows[1:]] == [["0", str(i * 256), str(i), "2", "3"]
+                                             for i in range(1, 4)]
+    assert float(rows[1][5]) == records[0, 5]
+    assert rows[2][-1] == "START-exp-01"
@@ -0,0 +1,126 @@
+# This file is part of Octopus Sensing <https://octopus-sensing.nastaran-saffar.me/>
+# Copyright © Nastaran Saffaryazdi 2020-2026
+#
+# Octopus Sensing is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation,
+#  either version 3 of the License, or (at your option) any later version.
+#
+# Octopus Sensing is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Octopus Sensing.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import json
+import struct
+
+import pytest
+import msgpack
+import numpy as np
+
+from octopus_sensing.common.ndarray_encoding import msgpack_ext_hook
+from octopus_sensing.common.websocket import connect, OPCODE_CLOSE, OPCODE_TEXT, \
+    CLOSE_PROTOCOL_ERROR
+from octopus_sensing.websocket_endpoint import WebSocketEndpoint
+
+
+class FakeCoordinator:
+    def __init__(self):
+        self.messages = []
+        self.realtime_calls = []
+
+    def get_devices(self):
+        return []
+
+    def dispatch(self, message):
+        self.messages.append(message)
+
+    def get_realtime_data(self, duration, device_list, since=None, options=None):
+        self.realtime_calls.append(since)
+        cursor = len(self.realtime_calls)
+        return {"eeg": {"data": np.full((2, 3), cursor, dtype=np.float32),
+                        "cursor": cursor}}
+
+
+@pytest.fixture()
+def fixture():
+    coordinator = FakeCoordinator()
+    endpoint = WebSocketEndpoint(coordinator)
+    endpoint.start()
+
+    time.sleep(0.5)
+
+    yield coordinator
+
+    endpoint.stop()
+
+
+def test_send_messages(fixture):
+    coordinator = fixture
+    websocket = connect("127.0.0.1", 9332, "/?encoding=json", timeout=2)
+
+    websocket.send(json.dumps({"type": "START", "experiment_id": "123",
+                               "stimulus_id": "s8"}))
+    assert json.loads(websocket.receive()) == {"reply": "message dispatched"}
+
+    websocket.send(msgpack.packb({"type": "STOP", "experiment_id": "123"}))
+    assert json.loads(websocket.receive()) == {"reply": "message dispatched"}
+
+    websocket.send(json.dumps({"experiment_id": "123"}))
+    assert "error" in json.loads(websocket.receive())
+    websocket.close()
+
+    assert [message.type for message in coordinator.messages] == ["START", "STOP"]
+    assert coordinator.messages[0].stimulus_id == "s8"
+
+
+def test_receive_realtime_data(fixture):
+    coordinator = fixture
+    websocket = connect("127.0.0.1", 9332, "/?device_list=eeg&interval=20ms", timeout=2)
+
+    received = []
+    while len(received) < 3:
+        message = msgpack.unpackb(websocket.receive(), ext_hook=msgpack_ext_hook)
+        received.append(message["realtime_data"]["eeg"])
+
+    # Messages can be sent while receiving realtime data
+    websocket.send(msgpack.packb({"type": "START", "experiment_id": "123"}))
+    while True:
+        message = msgpack.unpackb(websocket.receive(), ext_hook=msgpack_ext_hook)
+        if "reply" in message:
+            break
+    websocket.close()
+
+    assert [data["cursor"] for data in received] == [1, 2, 3]
+    assert np.array_equal(received[2]["data"], np.full((2, 3), 3))
+    assert coordinator.realtime_calls[:3] == [None, {"eeg": 1}, {"eeg": 2}]
+    assert coordinator.messages[0].type == "START"
+
+
+def test_unknown_encoding(fixture):
+    websocket = connect("127.0.0.1", 9332, "/?encoding=xml", timeout=2)
+    assert websocket.receive() is None
+
+
+def read_close_code(websocket):
+    fin, opcode, payload = websocket._read_frame()
+    assert opcode == OPCODE_CLOSE
+    return struct.unpack("!H", payload[:2])[0]
+
+
+def test_invalid_utf8(fixture):
+    websocket = connect("127.0.0.1", 9332, "/?encoding=json", timeout=2)
+    websocket._send_frame(OPCODE_TEXT, [b"\xff\xfe"])
+    assert read_close_code(websocket) == CLOSE_PROTOCOL_ERROR
+
+
+def test_unmasked_frame(fixture):
+    coordinator = fixture
+    websocket = connect("127.0.0.1", 9332, "/?encoding=json", timeout=2)
+    message = json.dumps({"type": "START", "experiment_id": "123"}).encode("UTF-8")
+    # A text frame without mask
+    websocket._wfile.write(bytes([0x80 | OPCODE_TEXT, len(message)]) + message)
+    assert read_close_code(websocket) == CLOSE_PROTOCOL_ERROR
+    assert coordinator.messages == []
@@ -0,0 +1,155 @@
+# This file is part of Octopus Sensing <https://octopus-sensing.nastaran-saffar.me/>
+# Copyright © Nastaran Saffaryazdi 2020-2026
+#
+# Octopus Sensing is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software Foundation,
+#  either version 3 of the License, or (at your option) any later version.
+#
+# Octopus Sensing is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with Octopus Sensing.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import sys
+import json
+import threading
+import traceback
+from typing import Any, Dict, List
+
+import msgpack
+
+from octopus_sensing.common.endpoint_base import \
+    EndpointBase, EndpointClientError, serialize_response
+from octopus_sensing.common.ndarray_encoding import NDARRAY_CONTENT_TYPE
+from octopus_sensing.common.websocket import WebSocket, CLOSE_POLICY_VIOLATION, CLOSE_PROTOCOL_ERROR
+from octopus_sensing.device_message_endpoint import make_message
+from octopus_sensing.realtime_data_endpoint import stream_realtime_data
+
+# Encodings of the messages that are sent to the clients, and their equivalent Accept header
+_ENCODINGS = {
+    "msgpack": "application/msgpack; ndarray=ext",
+    "json": "application/json",
+    "ndarray": NDARRAY_CONTENT_TYPE,
+}
+
+
+class WebSocketEndpoint(EndpointBase):
+    '''
+    A WebSocket endpoint that clients can both send messages to the devices through it
+    (like DeviceMessageHTTPEndpoint), and receive realtime data of devices from it
+    (like the `/stream` of RealtimeDataEndpoint), over one connection.
+
+    Query parameters of the connection's URL are:
+
+    - encoding: Encoding of the messages that the endpoint sends. One of `msgpack` (default),
+      `json` or `ndarray` (`application/x-octopus-ndarray`). In msgpack, NumPy arrays are
+      encoded as ext types (see `octopus_sensing.common.ndarray_encoding`).
+    - interval: If it's given, the endpoint sends the new realtime data of devices every
+      interval (e.g. `50ms`). `device_list`, `duration` and `since` are the same as
+      RealtimeDataEndpoint.
+
+    Clients send messages in JSON (text messages) or msgpack (binary messages). Their
+    format is the same as the body of DeviceMessageHTTPEndpoint's requests. The endpoint
+    replies to each of them with `{"reply": "message dispatched"}`, or `{"error": ...}`.
+    Realtime data is sent as `{"realtime_data": ...}`.
+
+    Parameters
+    ----------
+    device_coordinator
+        An instance of DeviceCoordinator class.
+    port
+        Port to listen on. Default is: 9332
+
+    Examples
+    --------
+    >>> websocket_endpoint = WebSocketEndpoint(device_coordinator)
+    >>> websocket_endpoint.start()
+
+    A Python client (`octopus_sensing.common.websocket` is a minimal WebSocket client):
+
+    >>> from octopus_sensing.common.websocket import connect
+    >>> websocket = connect("127.0.0.1", 9332, "/?encoding=msgpack&device_list=eeg&interval=50ms")
+    >>> websocket.send(msgpack.packb({'type': 'START', 'experiment_id': '123',
+    ...                               'stimulus_id': 's8'}))
+    >>> message = msgpack.unpackb(websocket.receive(), ext_hook=msgpack_ext_hook)
+    '''
+
+    def __init__(self, device_coordinator, port: int = 9332):
+        super().__init__(endpoint_name="WebSocketEndpoint-Thread",
+                         port=port, websocket_callback=self._websocket_handler)
+        self._device_coordinator = device_coordinator
+
+    def _websocket_handler(self, websocket: WebSocket, query_params: Dict[str, List[str]]):
+        encoding = query_params.get("encoding", ["msgpack"])[0]
+        if encoding not in _ENCODINGS:
+            websocket.close(CLOSE_POLICY_VIOLATION,
+                            "Unknown encoding. Should be one of {0}".format(list(_ENCODINGS)))
+            return
+
+        closed = threading.Event()
+        if "interval" in query_params:
+            try:
+                stream = stream_realtime_data(self._device_coordinator, query_params, closed)
+            except (EndpointClientError, ValueError) as error:
+                websocket.close(CLOSE_POLICY_VIOLATION, str(error))
+                return
+            threading.Thread(target=self._push_realtime_data,
+                             args=(websocket, encoding, stream),
+                             name="WebSocketEndpoint realtime data thread",
+                             daemon=True).start()
+
+        try:
+            while True:
+                message = websocket.receive()
+                if message is None:
+                    break
+                self._send(websocket, encoding, self._handle_message(message))
+        except UnicodeDecodeError:
+            # A text message that is not valid UTF-8
+            websocket.close(CLOSE_PROTOCOL_ERROR)
+        except OSError:
+            # Client is disconnected
+            pass
+        finally:
+            closed.set()
+
+    def _handle_message(self, message: Any) -> Dict[str, Any]:
+        try:
+            if isinstance(message, str):
+                request_body = json.loads(message)
+            else:
+                request_body = msgpack.unpackb(message)
+        except ValueError:
+            return {"error": "Messages should be JSON (text) or msgpack (binary)"}
+
+        try:
+            self._device_coordinator.dispatch(make_message(request_body))
+        except EndpointClientError as client_error:
+            return {"error": str(client_error)}
+        return {"reply": "message dispatched"}
+
+    def _push_realtime_data(self, websocket: WebSocket, encoding: str, stream) -> None:
+        try:
+            for realtime_data in stream:
+                self._send(websocket, encoding, {"realtime_data": realtime_data})
+                if self._stop_event.is_set():
+                    websocket.close()
+                    break
+        except OSError:
+            # Client is disconnected
+            pass
+        except Exception:
+            print("Error in sending realtime data", file=sys.stderr)
+            traceback.print_exc()
+        finally:
+            stream.close()
+
+    def _send(self, websocket: WebSocket, encoding: str, response: Dict[str, Any]) -> None:
+        buffers = serialize_response(response, _ENCODINGS[encoding])
+        assert buffers is not None
+        if encoding == "json":
+            websocket.send(b"".join(buffers).decode("UTF-8"))
+        else:
+            websocket.send(buffers)